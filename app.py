@@ -17,370 +17,52 @@
 
 """A build watch - watch for builds and submit images to Thoth for analysis."""
 
+import glob
 import os
 import sys
 import logging
-import time
-from typing import Any
-from typing import Dict
+import socket
 from typing import Optional
-from multiprocessing import Process
 from multiprocessing import Queue
-from multiprocessing import Manager
-from requests.exceptions import HTTPError
 
 import click
 
-from thamos.lib import build_analysis
-from thamos.config import config as configuration
-from thamos import __version__ as __thamos_version__
-from thoth.common import init_logging
-from thoth.common import OpenShift
-from thoth.common import __version__ as __common_version__
-from thoth.analyzer import __version__ as __analyzer_version__
-from thoth.analyzer import run_command
-from thoth.analyzer import CommandError
-from prometheus_client import CollectorRegistry, Counter, push_to_gateway
-
-init_logging()
-prometheus_registry = CollectorRegistry()
+# Only lightweight modules are imported here, the rest is imported by cli once options are validated. Modules
+# defining metrics are not imported here either, see _clear_multiprocess_metrics.
+from thoth.build_watcher.profiling import configure_profiling
+from thoth.build_watcher.recorder import configure_recording
 
 __version__ = "0.8.0"
-__component_version__ = (
-    f"{__version__}+" f"common.{__common_version__}." f"analyzer.{__analyzer_version__}." f"thamos.{__thamos_version__}"
-)
 
 _LOGGER = logging.getLogger("thoth.build_watcher")
 
-_HERE_DIR = os.path.dirname(os.path.abspath(__file__))
-_SKOPEO_EXEC_PATH = os.getenv("SKOPEO_EXEC_PATH", os.path.join(_HERE_DIR, "bin", "skopeo"))
-_THOTH_METRICS_PUSHGATEWAY_URL = os.getenv("PROMETHEUS_PUSHGATEWAY_HOST")
-
-_METRIC_IMAGES_SUBMITTED = Counter(
-    "build_watcher_image_submission_total", "Number of images submitted for analysis.", [], registry=prometheus_registry
-)
-_METRIC_IMAGES_PUSHED_REGISTRY = Counter(
-    "build_watcher_image_pushed_registry_total",
-    "Number of images push to external registry.",
-    [],
-    registry=prometheus_registry,
-)
-_METRIC_BUILD_LOGS_SUBMITTED = Counter(
-    "build_watcher_build_log_submission_total",
-    "Number of build logs submitted for analysis.",
-    [],
-    registry=prometheus_registry,
-)
-_METRIC_BUILDS_FAILED = Counter(
-    "build_watcher_builds_failed_total", "Number of builds failed.", [], registry=prometheus_registry
-)
-
-
-def _buildlog_metadata(api_endpoint: Optional[str] = None, build_log: str = None) -> Dict[str, str]:
-    """Gather metadata for the build log."""
-    # Update the metadata with more details
-    if not build_log:
-        return {}
-    return {"apiversion": api_endpoint, "kind": "BuildLog", "log": build_log}
-
-
-def _existing_producer(queue: Queue, build_watcher_namespace: str) -> None:
-    """Query for existing images in image streams and queue them for analysis."""
-    openshift = OpenShift()
-    v1_imagestreams = openshift.ocp_client.resources.get(api_version="image.openshift.io/v1", kind="ImageStream")
-    for item in v1_imagestreams.get(namespace=build_watcher_namespace).items:
-        _LOGGER.debug("Found imagestream item: %s", str(item))
-        _LOGGER.debug("Listing tags available for %r", item["metadata"]["name"])
-        for tag_info in item.status.tags or []:
-            output_reference = f"{item.status.dockerImageRepository}:{tag_info.tag}"
-            _LOGGER.info("Queueing already existing image %r for analysis", output_reference)
-            queue.put(output_reference)
-
-    _LOGGER.info("Queuing existing images for analyses has finished, all of them were scheduled for analysis")
-
-
-def _get_build(
-    openshift, strategy: Dict[str, Any], build_reference: Dict[str, Any], event_metadata: Dict[str, Any]
-) -> dict:
-    """Gather Build log and Base Image based upon the strategy of the build."""
-    if strategy.get("sourceStrategy"):
-        build_reference["base_input_reference"] = strategy.get("sourceStrategy", {}).get("from", {}).get("name", None)
-    elif strategy.get("dockerStrategy") and strategy.get("dockerStrategy", {}).get("from", {}):
-        build_reference["base_input_reference"] = strategy.get("dockerStrategy", {}).get("from", {}).get("name", None)
-    else:
-        build_reference["base_input_reference"] = None
-    try:
-        build_log = openshift.get_build_log(
-            build_id=event_metadata.get("name"), namespace=event_metadata.get("namespace")
-        )
-    except HTTPError as exc:
-        _LOGGER.warning("Failed to get the log for build %s: %s", event_metadata.get("name"), str(exc))
-        build_log = None
-    except Exception as exc:
-        _LOGGER.exception("Failed to get the log for build %s: %s", event_metadata.get("name"), str(exc))
-        build_log = None
-    build_reference["build_log_reference"] = _buildlog_metadata(event_metadata.get("selfLink"), build_log)
-
-    return build_reference
-
-
-def _event_producer(queue: Queue, build_watcher_namespace: str) -> None:
-    """Accept events from the cluster and queue them into work queue processed by the main process."""
-    _LOGGER.info("Starting event producer")
-    openshift = OpenShift()
-    v1_build = openshift.ocp_client.resources.get(api_version="build.openshift.io/v1", kind="Build")
-    for event in v1_build.watch(namespace=build_watcher_namespace):
-        event_name = event["object"].metadata.name
-        build_reference = {
-            "build_log_reference": _buildlog_metadata(),
-            "base_input_reference": None,
-            "output_reference": None,
-        }
-        if event["object"].status.phase != "Complete":
-            _LOGGER.debug(
-                "Ignoring build event for %r - not completed phase %r", event_name, event["object"].status.phase
-            )
-            continue
-        elif event["object"].status.phase == "Failed":
-            _LOGGER.debug(
-                "Submitting base_image and build_log as build event for %r - the phase is %r",
-                event_name,
-                event["object"].status.phase,
-            )
-            strategy = event["object"].spec.strategy
-            build_reference = _get_build(openshift, strategy, build_reference, event["object"].metadata)
-            _LOGGER.info("Queueing build log based on build event %r for further processing", event_name)
-            _METRIC_BUILDS_FAILED.inc()
-            try:
-                _LOGGER.info("Submitting metrics to Prometheus pushgateway %r", _THOTH_METRICS_PUSHGATEWAY_URL)
-                push_to_gateway(_THOTH_METRICS_PUSHGATEWAY_URL, job="build-watcher", registry=prometheus_registry)
-            except Exception as e:
-                _LOGGER.exception(f"An error occurred pushing the metrics: {str(e)}")
-            queue.put(build_reference)
-            continue
-
-        _LOGGER.debug("New build event: %s", str(event))
-        build_reference["output_reference"] = event["object"].status.outputDockerImageReference
-        strategy = event["object"].spec.strategy
-        build_reference = _get_build(openshift, strategy, build_reference, event["object"].metadata)
-        _LOGGER.info("Queueing build log based on build event %r for further processing", event_name)
-        queue.put(build_reference)
-
-
-def _do_analyze_build(
-    output_reference: Optional[str] = None,
-    build_log_reference: Optional[str] = None,
-    base_input_reference: Optional[str] = None,
-    push_registry: Optional[str] = None,
-    *,
-    environment_type: Optional[str] = None,
-    src_registry_user: Optional[str] = None,
-    src_registry_password: Optional[str] = None,
-    dst_registry_user: Optional[str] = None,
-    dst_registry_password: Optional[str] = None,
-    src_verify_tls: bool = True,
-    dst_verify_tls: bool = True,
-    debug: bool = False,
-    force: bool = False,
-) -> None:
-    if push_registry:
-        _LOGGER.info("Pushing output image %r to an external push registry %r", output_reference, push_registry)
-        output_reference = _push_image(
-            output_reference,
-            push_registry,
-            src_registry_user,
-            src_registry_password,
-            dst_registry_user,
-            dst_registry_password,
-            src_verify_tls=src_verify_tls,
-            dst_verify_tls=dst_verify_tls,
-        )
-        if output_reference:
-            _METRIC_IMAGES_PUSHED_REGISTRY.inc()
-            _LOGGER.info("Successfully pushed output image to %r", output_reference)
-
-        if base_input_reference:
-            _LOGGER.info("Pushing base image %r to an external push registry %r", base_input_reference, push_registry)
-            base_input_reference = _push_image(
-                base_input_reference,
-                push_registry,
-                src_registry_user,
-                src_registry_password,
-                dst_registry_user,
-                dst_registry_password,
-                src_verify_tls=src_verify_tls,
-                dst_verify_tls=dst_verify_tls,
-            )
-            if base_input_reference:
-                _METRIC_IMAGES_PUSHED_REGISTRY.inc()
-                _LOGGER.info("Successfully pushed base image to %r", base_input_reference)
-
-    analysis_response = build_analysis(
-        build_log=build_log_reference,
-        base_image=base_input_reference,
-        base_registry_password=src_registry_password,
-        base_registry_user=src_registry_user,
-        base_registry_verify_tls=src_verify_tls,
-        environment_type=environment_type,
-        nowait=True,
-        output_image=output_reference,
-        output_registry_password=dst_registry_password,
-        output_registry_user=dst_registry_user,
-        output_registry_verify_tls=dst_verify_tls,
-        force=force,
-        debug=debug,
-    )
-
-    if analysis_response.base_image_analysis and analysis_response.base_image_analysis.analysis_id:
-        _METRIC_IMAGES_SUBMITTED.inc()
-    if analysis_response.buildlog_analysis and analysis_response.buildlog_analysis.analysis_id:
-        _METRIC_BUILD_LOGS_SUBMITTED.inc()
-    if analysis_response.output_image_analysis and analysis_response.output_image_analysis.analysis_id:
-        _METRIC_IMAGES_SUBMITTED.inc()
-
-    if _THOTH_METRICS_PUSHGATEWAY_URL:
-        try:
-            _LOGGER.info("Submitting metrics to Prometheus pushgateway %r", _THOTH_METRICS_PUSHGATEWAY_URL)
-            push_to_gateway(_THOTH_METRICS_PUSHGATEWAY_URL, job="build-watcher", registry=prometheus_registry)
-        except Exception as e:
-            _LOGGER.exception(f"An error occurred pushing the metrics: {str(e)}")
-    else:
-        _LOGGER.info("Not pushing metrics as Prometheus pushgateway was not provided")
-
-    _LOGGER.info(
-        "Successfully submitted %r, %r, build log, build log analysis to Thoth for analysis; "
-        "analysis ids respectively: %r, %r, %r, %r",
-        output_reference,
-        base_input_reference,
-        analysis_response.output_image_analysis.analysis_id if analysis_response.output_image_analysis else None,
-        analysis_response.base_image_analysis.analysis_id if analysis_response.base_image_analysis else None,
-        analysis_response.buildlog_document_id,
-        analysis_response.buildlog_analysis.analysis_id if analysis_response.buildlog_analysis else None,
-    )
-
-
-def _push_image(
-    image: str,
-    push_registry: str,
-    src_registry_user: Optional[str] = None,
-    src_registry_password: Optional[str] = None,
-    dst_registry_user: Optional[str] = None,
-    dst_registry_password: Optional[str] = None,
-    src_verify_tls: bool = True,
-    dst_verify_tls: bool = True,
-) -> Optional[str]:
-    """Push the given image (fully specified with registry info) into another registry."""
-    cmd = f"{_SKOPEO_EXEC_PATH} --insecure-policy copy "
-
-    if not src_verify_tls:
-        cmd += "--src-tls-verify=false "
-
-    if not dst_verify_tls:
-        cmd += "--dest-tls-verify=false "
-
-    if dst_registry_user or dst_registry_password:
-        dst_registry_user = dst_registry_user or "build-watcher"
-        cmd += f"--dest-creds={dst_registry_user}"
 
-        if dst_registry_password:
-            cmd += f":{dst_registry_password}"
+def _clear_multiprocess_metrics() -> None:
+    """Remove metric values left in PROMETHEUS_MULTIPROC_DIR by a previous run, they would be aggregated otherwise.
 
-        cmd += " "
+    Metrics without labels create their values in files of this process once thoth.build_watcher.metrics is
+    imported, so this needs to be done before that.
+    """
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        return
 
-    if src_registry_user or src_registry_password:
-        src_registry_user = src_registry_user or "build-watcher"
-        cmd += f"--src-creds={src_registry_user}"
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
 
-        if dst_registry_password:
-            cmd += f":{src_registry_password}"
 
-        cmd += " "
+def _component_version() -> str:
+    """Get version of build-watcher including versions of Thoth libraries used."""
+    from thamos import __version__ as __thamos_version__
+    from thoth.common import __version__ as __common_version__
+    from thoth.analyzer import __version__ as __analyzer_version__
 
-    image_name = image.rsplit("/", maxsplit=1)[1]
-    if "quay.io" in push_registry:
-        image_name = image_name.replace("@sha256", "")
-        output = f"{push_registry}:{image_name.replace(':','-')}"
-    else:
-        output = f"{push_registry}/{image_name}"
-    _LOGGER.debug("Pushing image %r from %r to registry %r, output is %r", image_name, image, push_registry, output)
-    cmd += f"docker://{image} docker://{output}"
-
-    _LOGGER.debug("Running: %s", cmd)
-    try:
-        command = run_command(cmd)
-        _LOGGER.debug("%s stdout:\n%s\n%s", _SKOPEO_EXEC_PATH, command.stdout, command.stderr)
-    except CommandError as exc:
-        if "Error determining manifest MIME type" in exc.stderr:
-            # Manifest MIME type error is caused by the way image is build. we have no control over it.
-            _LOGGER.warning("Ignoring error caused by invalid manifest MIME type during push: %s", str(exc))
-            return None
-        else:
-            _LOGGER.exception("Failed to push image %r to external registry: %s", image_name, str(exc))
-    return output
-
-
-def _submitter(
-    queue: Queue,
-    push_registry: str,
-    environment_type: str,
-    src_registry_user: Optional[str] = None,
-    src_registry_password: Optional[str] = None,
-    dst_registry_user: Optional[str] = None,
-    dst_registry_password: Optional[str] = None,
-    no_src_registry_tls_verify: bool = False,
-    no_dst_registry_tls_verify: bool = False,
-    no_base: bool = False,
-    no_output: bool = False,
-    no_build_log: bool = False,
-    debug: bool = False,
-    force: bool = False,
-) -> None:
-    """Read messages from queue and submit each message with image to Thoth for analysis."""
-    while True:
-        reference = queue.get()
-        if isinstance(reference, dict):
-            build_log_reference = reference.get("build_log_reference", _buildlog_metadata())
-            base_input_reference = reference.get("base_input_reference", None)
-            output_reference = reference.get("output_reference", None)
-        else:
-            output_reference = reference
-            build_log_reference = _buildlog_metadata()
-            base_input_reference = None
-            _LOGGER.info("Handling analysis of image %r", reference)
-
-        output = output_reference if not no_output else None
-        build_log = build_log_reference if not no_build_log else None
-        base = base_input_reference if not no_base else None
-
-        if not output and not build_log and not base:
-            _LOGGER.warning(
-                "Skipping %r as no input for build analysis would be sent based on limitations on "
-                "data to be sent; no base: %r, no output: %r, no build log: %r",
-                output_reference,
-                no_base,
-                no_output,
-                no_build_log,
-            )
-            continue
-
-        try:
-            _do_analyze_build(
-                output,
-                build_log,
-                base,
-                push_registry,
-                environment_type=environment_type,
-                src_registry_user=src_registry_user if base else None,
-                src_registry_password=src_registry_password if base else None,
-                dst_registry_user=dst_registry_user if output else None,
-                dst_registry_password=dst_registry_password if output else None,
-                src_verify_tls=not no_src_registry_tls_verify,
-                dst_verify_tls=not no_dst_registry_tls_verify,
-                debug=debug,
-                force=force,
-            )
-        except Exception as exc:
-            _LOGGER.exception("Failed to submit image %r for analysis to Thoth: %s", output_reference, str(exc))
+    return (
+        f"{__version__}+"
+        f"common.{__common_version__}."
+        f"analyzer.{__analyzer_version__}."
+        f"thamos.{__thamos_version__}"
+    )
 
 
 @click.command()
@@ -391,9 +73,41 @@ def _submitter(
     "--build-watcher-namespace",
     "-n",
     type=str,
-    required=True,
     envvar="THOTH_WATCHED_NAMESPACE",
-    help="Namespace to connect to to wait for events.",
+    help="Namespace to connect to to wait for events, multiple namespaces can be separated by comma.",
+)
+@click.option(
+    "--namespace-selector",
+    type=str,
+    envvar="THOTH_WATCHED_NAMESPACE_SELECTOR",
+    help="Watch builds in all the namespaces matching the given label selector instead of listing namespaces.",
+)
+@click.option(
+    "--all-namespaces",
+    is_flag=True,
+    envvar="THOTH_WATCH_ALL_NAMESPACES",
+    help="Watch builds in all the namespaces in the cluster using one cluster-wide watch.",
+)
+@click.option(
+    "--namespace-refresh-interval",
+    type=float,
+    default=60.0,
+    show_default=True,
+    envvar="THOTH_WATCHED_NAMESPACE_REFRESH_INTERVAL",
+    help="Number of seconds after which namespaces matching the namespace selector are listed again.",
+)
+@click.option(
+    "--build-label-selector",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_BUILD_LABEL_SELECTOR",
+    help="Watch only builds matching the given label selector, e.g. buildconfig=my-app.",
+)
+@click.option(
+    "--server-side-filter",
+    is_flag=True,
+    envvar="THOTH_BUILD_WATCHER_SERVER_SIDE_FILTER",
+    help="Let the API server filter the build watch using a field selector so that events of builds which did "
+    "not finish yet are not sent; bookmarks keep the watch position up to date.",
 )
 @click.option(
     "--thoth-api-host",
@@ -489,7 +203,40 @@ def _submitter(
     default=1,
     show_default=True,
     envvar="THOTH_BUILD_WATCHER_WORKERS",
-    help="Number of worker processes to submit image analysis in parallel.",
+    help="Number of worker processes to submit image analysis in parallel, the maximum if workers are scaled.",
+)
+@click.option(
+    "--workers-min",
+    type=int,
+    envvar="THOTH_BUILD_WATCHER_WORKERS_MIN",
+    help="Minimum number of worker processes. If lower than --workers-count, workers are added when the work queue "
+    "grows and retired when they are idle [default: --workers-count].",
+)
+@click.option(
+    "--scale-interval",
+    type=float,
+    default=30.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SCALE_INTERVAL",
+    help="Number of seconds between decisions to add or retire a worker process.",
+)
+@click.option(
+    "--scale-latency-target",
+    type=float,
+    default=60.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SCALE_LATENCY_TARGET",
+    help="Number of seconds in which workers should process the work queued, based on the observed duration of "
+    "submissions; a worker is added if the work queued would take longer.",
+)
+@click.option(
+    "--drain-timeout",
+    type=float,
+    default=25.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_DRAIN_TIMEOUT",
+    help="Number of seconds producers and workers are given to finish the work queued on SIGTERM before they are "
+    "terminated.",
 )
 @click.option(
     "--environment-type",
@@ -535,8 +282,336 @@ def _submitter(
     envvar="THOTH_BUILD_ANALYSIS_FORCE",
     help="Do not use cached results, always force analysis on the backend.",
 )
+@click.option(
+    "--dedup-cache-size",
+    type=int,
+    default=4096,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_DEDUP_CACHE_SIZE",
+    help="Number of already submitted images and build logs remembered to avoid submitting them again, "
+    "set to 0 to turn off the deduplication.",
+)
+@click.option(
+    "--dedup-cache-ttl",
+    type=int,
+    default=86400,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_DEDUP_CACHE_TTL",
+    help="Number of seconds an already submitted image or build log is not submitted again.",
+)
+@click.option(
+    "--dedup-cache-path",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_DEDUP_CACHE_PATH",
+    help="Path to an SQLite database used to share the cache of already submitted images and build logs "
+    "across workers and restarts.",
+)
+@click.option(
+    "--worker-mode",
+    type=click.Choice(["process", "async"]),
+    default="process",
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_WORKER_MODE",
+    help="Submit one image at a time in each worker process (process) or submit multiple images concurrently "
+    "in each worker process using an event loop (async), see --max-in-flight.",
+)
+@click.option(
+    "--max-in-flight",
+    type=int,
+    default=16,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_MAX_IN_FLIGHT",
+    help="Maximum number of concurrent submissions done by one worker process in the async worker mode.",
+)
+@click.option(
+    "--push-engine",
+    type=click.Choice(["skopeo", "native"]),
+    default="skopeo",
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_PUSH_ENGINE",
+    help="Copy images to the push registry using skopeo or talking to registries directly (native), "
+    "the native engine skips layers already present and reuses connections across pushes.",
+)
+@click.option(
+    "--push-cache-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_PUSH_CACHE_SIZE",
+    help="Number of base images pushed to the push registry remembered not to push them again, 0 disables "
+    "the cache; the cache is shared by workers if --dedup-cache-path is set.",
+)
+@click.option(
+    "--push-cache-ttl",
+    type=int,
+    default=86400,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_PUSH_CACHE_TTL",
+    help="Number of seconds for which a pushed base image is not pushed again.",
+)
+@click.option(
+    "--log-fetchers",
+    type=int,
+    default=4,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_LOG_FETCHERS",
+    help="Number of threads in the event producer fetching build logs concurrently.",
+)
+@click.option(
+    "--coalesce-window",
+    type=float,
+    default=5.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_COALESCE_WINDOW",
+    help="Number of seconds for which repeated events of a completed build are coalesced before the build is "
+    "processed, each build is processed once regardless of this setting.",
+)
+@click.option(
+    "--metrics-mode",
+    type=click.Choice(["push", "flusher", "endpoint"]),
+    default="push",
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_METRICS_MODE",
+    help="Push metrics of each process to Prometheus pushgateway on each change (push), push metrics aggregated "
+    "across processes on an interval (flusher) or expose them on a /metrics endpoint (endpoint); the last two "
+    "require PROMETHEUS_MULTIPROC_DIR environment variable pointing to an empty directory.",
+)
+@click.option(
+    "--metrics-push-interval",
+    type=float,
+    default=30.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_METRICS_PUSH_INTERVAL",
+    help="Number of seconds between pushes of metrics in the flusher metrics mode.",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=8080,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_METRICS_PORT",
+    help="Port on which metrics are exposed in the endpoint metrics mode.",
+)
+@click.option(
+    "--record",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_RECORD",
+    help="Append build events, build log sizes and stage timings to the given JSON lines file; the trace can be "
+    "replayed against local stand-ins using benchmarks/replay.py.",
+)
+@click.option(
+    "--profile-dir",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_PROFILE_DIR",
+    help="Directory to which profiles are written. If set, SIGUSR1 takes a CPU profile and SIGUSR2 a memory "
+    "profile of the process receiving it (of all the processes if sent to the main process) and items being "
+    "processed are dumped.",
+)
+@click.option(
+    "--profile-window",
+    type=float,
+    default=30.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_PROFILE_WINDOW",
+    help="Number of seconds for which CPU and memory profiles are taken.",
+)
+@click.option(
+    "--sharding",
+    type=click.Choice(["none", "lease", "directory"]),
+    default="none",
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SHARDING",
+    help="Split builds across replicas watching the same namespace, replicas coordinate using Lease objects in "
+    "the watched namespace (lease) or files on a volume shared by replicas (directory).",
+)
+@click.option(
+    "--shard-identity",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_SHARD_IDENTITY",
+    help="Identity of this replica in the sharded mode, defaults to the host name.",
+)
+@click.option(
+    "--shard-group",
+    type=str,
+    default="build-watcher",
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SHARD_GROUP",
+    help="Name of the group of replicas splitting builds in the sharded mode.",
+)
+@click.option(
+    "--shard-directory",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_SHARD_DIRECTORY",
+    help="Directory shared by replicas used for coordination in the directory sharding mode.",
+)
+@click.option(
+    "--shard-lease-duration",
+    type=float,
+    default=30.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SHARD_LEASE_DURATION",
+    help="Number of seconds after which a replica which did not renew its membership is considered gone.",
+)
+@click.option(
+    "--build-log-max-bytes",
+    type=int,
+    default=2097152,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_BUILD_LOG_MAX_BYTES",
+    help="Maximum size of a build log kept in memory and submitted for analysis. If a build log is larger, "
+    "only its beginning and end are kept and the build log is marked as truncated. Set to 0 for no limit.",
+)
+@click.option(
+    "--build-log-reduce",
+    is_flag=True,
+    envvar="THOTH_BUILD_WATCHER_BUILD_LOG_REDUCE",
+    help="Submit only sections of build logs analyzed by Thoth - installation of Python dependencies, tracebacks "
+    "and errors; image pulls, pushes and other build steps are left out.",
+)
+@click.option(
+    "--build-log-spool-dir",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_BUILD_LOG_SPOOL_DIR",
+    help="Directory used to pass large build logs from the event producer to workers by reference "
+    "[default: a directory in the system temporary directory].",
+)
+@click.option(
+    "--build-log-spool-threshold",
+    type=int,
+    default=65536,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_BUILD_LOG_SPOOL_THRESHOLD",
+    help="Size of build logs (in characters) from which build logs are passed to workers through a spool file "
+    "instead of the work queue.",
+)
+@click.option(
+    "--checkpoint-path",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_CHECKPOINT_PATH",
+    help="Path to a file where the last processed resourceVersion of the build watch is stored. If set, "
+    "build-watcher resumes watching builds from the stored position after a restart instead of listing "
+    "all the builds in the namespace again.",
+)
+@click.option(
+    "--existing-page-size",
+    type=int,
+    default=100,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_EXISTING_PAGE_SIZE",
+    help="Number of image streams listed in one request when analyzing existing images.",
+)
+@click.option(
+    "--existing-scan-rate",
+    type=float,
+    default=10.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_EXISTING_SCAN_RATE",
+    help="Maximum number of existing images queued for analysis per second, set to 0 for no limit.",
+)
+@click.option(
+    "--existing-history-depth",
+    type=int,
+    default=1,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_EXISTING_HISTORY_DEPTH",
+    help="Number of images in the history of each image stream tag analyzed when analyzing existing images, "
+    "set to 0 to analyze the whole history.",
+)
+@click.option(
+    "--existing-scan-workers",
+    type=int,
+    default=4,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_EXISTING_SCAN_WORKERS",
+    help="Number of namespaces scanned in parallel when analyzing existing images.",
+)
+@click.option(
+    "--spool-path",
+    type=str,
+    envvar="THOTH_BUILD_WATCHER_SPOOL_PATH",
+    help="Path to an SQLite database used as a durable work queue between the watch and workers. If set, builds "
+    "not submitted yet survive restarts and failed submissions are retried with backoff; see spool.py to inspect "
+    "and replay submissions which ran out of attempts.",
+)
+@click.option(
+    "--spool-max-attempts",
+    type=int,
+    default=8,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SPOOL_MAX_ATTEMPTS",
+    help="Number of attempts to submit an entry of the work spool before it is moved to the dead letter table.",
+)
+@click.option(
+    "--spool-backoff",
+    type=float,
+    default=10.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SPOOL_BACKOFF",
+    help="Number of seconds before the first retry of a failed submission, doubled on each subsequent attempt.",
+)
+@click.option(
+    "--spool-lease-duration",
+    type=float,
+    default=900.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_SPOOL_LEASE_DURATION",
+    help="Number of seconds after which an entry of the work spool taken by a worker which did not finish it is "
+    "handed to another worker.",
+)
+@click.option(
+    "--thoth-api-rate",
+    type=float,
+    default=0.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_API_RATE",
+    help="Maximum number of analysis requests per second sent to Thoth User API by all the workers, set to 0 "
+    "for no limit.",
+)
+@click.option(
+    "--thoth-api-burst",
+    type=int,
+    default=5,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_API_BURST",
+    help="Number of analysis requests which can be sent at once on top of the rate limit.",
+)
+@click.option(
+    "--thoth-api-max-concurrency",
+    type=int,
+    default=16,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_API_MAX_CONCURRENCY",
+    help="Maximum number of concurrent analysis requests of a worker, in the process worker mode also limited by "
+    "the batch size; the actual limit is adjusted based on latency and errors of Thoth User API.",
+)
+@click.option(
+    "--thoth-api-latency-target",
+    type=float,
+    default=10.0,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_API_LATENCY_TARGET",
+    help="Number of seconds of an analysis request after which Thoth User API is considered overloaded and the "
+    "concurrency of requests is lowered.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_BATCH_SIZE",
+    help="Maximum number of items a worker in the process worker mode takes from the work queue at once and "
+    "submits concurrently over its pool of connections to Thoth User API.",
+)
+@click.option(
+    "--batch-wait",
+    type=float,
+    default=0.05,
+    show_default=True,
+    envvar="THOTH_BUILD_WATCHER_BATCH_WAIT",
+    help="Maximum number of seconds a worker waits for more items to fill a batch once it took the first one.",
+)
 def cli(
-    build_watcher_namespace: str,
+    build_watcher_namespace: Optional[str] = None,
     thoth_api_host: Optional[str] = None,
     verbose: bool = False,
     no_tls_verify: bool = False,
@@ -550,17 +625,63 @@ def cli(
     push_registry: Optional[str] = None,
     analyze_existing: bool = False,
     workers_count: int = 1,
+    workers_min: Optional[int] = None,
+    scale_interval: float = 30.0,
+    scale_latency_target: float = 60.0,
+    drain_timeout: float = 25.0,
     environment_type: Optional[str] = None,
     no_base: bool = False,
     no_output: bool = False,
     no_build_log: bool = False,
     debug: bool = False,
     force: bool = False,
+    checkpoint_path: Optional[str] = None,
+    dedup_cache_size: int = 4096,
+    dedup_cache_ttl: int = 86400,
+    dedup_cache_path: Optional[str] = None,
+    worker_mode: str = "process",
+    max_in_flight: int = 16,
+    push_engine: str = "skopeo",
+    push_cache_size: int = 1024,
+    push_cache_ttl: int = 86400,
+    build_log_spool_dir: Optional[str] = None,
+    build_log_spool_threshold: int = 65536,
+    build_log_max_bytes: int = 2097152,
+    build_log_reduce: bool = False,
+    log_fetchers: int = 4,
+    coalesce_window: float = 5.0,
+    metrics_mode: str = "push",
+    metrics_push_interval: float = 30.0,
+    metrics_port: int = 8080,
+    record: Optional[str] = None,
+    profile_dir: Optional[str] = None,
+    profile_window: float = 30.0,
+    sharding: str = "none",
+    shard_identity: Optional[str] = None,
+    shard_group: str = "build-watcher",
+    shard_directory: Optional[str] = None,
+    shard_lease_duration: float = 30.0,
+    namespace_selector: Optional[str] = None,
+    all_namespaces: bool = False,
+    namespace_refresh_interval: float = 60.0,
+    build_label_selector: Optional[str] = None,
+    server_side_filter: bool = False,
+    existing_page_size: int = 100,
+    existing_scan_rate: float = 10.0,
+    existing_history_depth: int = 1,
+    existing_scan_workers: int = 4,
+    spool_path: Optional[str] = None,
+    spool_max_attempts: int = 8,
+    spool_backoff: float = 10.0,
+    spool_lease_duration: float = 900.0,
+    thoth_api_rate: float = 0.0,
+    thoth_api_burst: int = 5,
+    thoth_api_max_concurrency: int = 16,
+    thoth_api_latency_target: float = 10.0,
+    batch_size: int = 1,
+    batch_wait: float = 0.05,
 ):
     """Build watcher bot for analyzing image builds done in cluster."""
-    if verbose:
-        _LOGGER.setLevel(logging.DEBUG)
-
     if no_base and no_output and no_build_log:
         _LOGGER.error(
             "At least one of base container image, output container image and build log needs to "
@@ -568,26 +689,101 @@ def cli(
         )
         sys.exit(1)
 
-    _LOGGER.info("This is build-watcher in version %r", __component_version__)
+    namespaces = None
+    if build_watcher_namespace:
+        namespaces = [namespace.strip() for namespace in build_watcher_namespace.split(",") if namespace.strip()]
+
+    if sum((bool(namespaces), bool(namespace_selector), all_namespaces)) != 1:
+        _LOGGER.error("Exactly one of namespaces to watch, a namespace selector or all namespaces needs to be set")
+        sys.exit(1)
+
+    _clear_multiprocess_metrics()
+
+    from thamos.config import config as configuration
+    from thoth.common import init_logging
+    from thoth.build_watcher.buildlog import BuildLogFetcher
+    from thoth.build_watcher.buildlog import BuildLogSpool
+    from thoth.build_watcher.cluster import warm_up
+    from thoth.build_watcher.limiter import TokenBucket
+    from thoth.build_watcher.metrics import configure_metrics
+    from thoth.build_watcher.producer import event_producer
+    from thoth.build_watcher.producer import existing_producer
+    from thoth.build_watcher.submitter import discover_thoth_api
+    from thoth.build_watcher.submitter import submitter
+    from thoth.build_watcher.supervisor import Supervisor
+    from thoth.build_watcher.workspool import WorkSpool
+
+    init_logging()
+    if verbose:
+        _LOGGER.setLevel(logging.DEBUG)
+
+    _LOGGER.info("This is build-watcher in version %r", _component_version())
+
+    # Set up before any process is forked so that all of them report to the same metrics pipeline.
+    configure_metrics(metrics_mode, push_interval=metrics_push_interval, port=metrics_port)
+    configure_recording(record)
+    configure_profiling(profile_dir, profile_window)
 
     _LOGGER.info(
-        "Build watcher is watching namespace %r and submitting resulting images to Thoth at %r",
-        build_watcher_namespace,
+        "Build watcher is watching %s and submitting resulting images to Thoth at %r",
+        (
+            f"namespaces {namespaces!r}"
+            if namespaces
+            else f"namespaces matching {namespace_selector!r}" if namespace_selector else "all namespaces"
+        ),
         thoth_api_host,
     )
 
     # All the images to be processed are submitted onto this queue by producers.
-    manager = Manager()
-    queue = manager.Queue()
+    if spool_path:
+        queue = WorkSpool(
+            spool_path,
+            lease_duration=spool_lease_duration,
+            max_attempts=spool_max_attempts,
+            backoff_base=spool_backoff,
+        )
+        _LOGGER.info("Using work spool %r, %d entries were left by the previous run", spool_path, queue.qsize())
+        queue.recover()
+        # Build logs are stored in the work spool directly.
+        build_log_spool_threshold = sys.maxsize
+    else:
+        queue = Queue()
+    build_log_fetcher = BuildLogFetcher(
+        build_log_max_bytes, BuildLogSpool(build_log_spool_dir, build_log_spool_threshold), reduce=build_log_reduce
+    )
 
-    if analyze_existing:
-        # We do this in a standalone process, but reuse worker queue to process images.
-        existing_producer = Process(target=_existing_producer, args=(queue, build_watcher_namespace))
-        existing_producer.start()
+    supervisor = Supervisor(
+        queue,
+        min_workers=workers_min or workers_count,
+        max_workers=workers_count,
+        worker_concurrency=max_in_flight if worker_mode == "async" else batch_size,
+        scale_interval=scale_interval,
+        latency_target=scale_latency_target,
+        drain_timeout=drain_timeout,
+    )
 
     configuration.explicit_host = thoth_api_host
     configuration.tls_verify = not no_tls_verify
-    openshift = OpenShift()
+    # Processes are forked only once the cluster client and Thoth API are discovered, children inherit them.
+    openshift = warm_up()
+    try:
+        discover_thoth_api()
+    except Exception as exc:
+        _LOGGER.warning("Failed to discover Thoth User API, workers will retry on their first submission: %s", exc)
+
+    if analyze_existing:
+        # We do this in a standalone process, but reuse worker queue to process images.
+        scan_options = {
+            "state_path": f"{checkpoint_path}.existing" if checkpoint_path else None,
+            "page_size": existing_page_size,
+            "rate": existing_scan_rate,
+            "history_depth": existing_history_depth,
+            "workers": existing_scan_workers,
+        }
+        # The scan is resumed if the process fails, it is not restarted once the scan is done.
+        supervisor.add_service(
+            "existing", existing_producer, (queue, namespaces, namespace_selector, scan_options), restart=False
+        )
 
     if not push_registry and (src_registry_password or src_registry_user):
         raise ValueError("Source credentials can be used only if push registry is configured")
@@ -606,8 +802,33 @@ def cli(
             dst_registry_user = "build-watcher"
             dst_registry_password = openshift.token
 
-    producer = Process(target=_event_producer, args=(queue, build_watcher_namespace))
-    producer.start()
+    shard_options = None
+    if sharding != "none":
+        shard_options = dict(
+            mode=sharding,
+            identity=shard_identity or os.getenv("HOSTNAME") or socket.gethostname(),
+            directory=shard_directory,
+            group=shard_group,
+            lease_duration=shard_lease_duration,
+        )
+        _LOGGER.info("Builds are split across replicas, this replica is %r", shard_options["identity"])
+
+    supervisor.add_service(
+        "producer",
+        event_producer,
+        (
+            queue,
+            namespaces,
+            build_log_fetcher,
+            checkpoint_path,
+            log_fetchers,
+            coalesce_window,
+            shard_options,
+            namespace_selector,
+            namespace_refresh_interval,
+            {"label_selector": build_label_selector, "server_side_filter": server_side_filter},
+        ),
+    )
 
     args = [
         queue,
@@ -624,30 +845,32 @@ def cli(
         no_build_log,
         debug,
         force,
+        dedup_cache_size,
+        dedup_cache_ttl,
+        dedup_cache_path,
+        worker_mode,
+        max_in_flight,
+        push_engine,
+        push_cache_size,
+        push_cache_ttl,
+        # Shared by all the workers, the rate is kept regardless of the number of workers running.
+        TokenBucket(thoth_api_rate, thoth_api_burst, shared=True),
+        thoth_api_max_concurrency,
+        thoth_api_latency_target,
+        batch_size,
+        batch_wait,
     ]
-    # We do not use multiprocessing's Pool here as we manage lifecycle of workers on our own. If any fails, give
-    # up and report errors.
-    process_pool = []
+    # We do not use multiprocessing's Pool here as we manage lifecycle of workers on our own - failed processes
+    # are restarted and workers are scaled based on the load.
     _LOGGER.info(
-        "Starting worker processes, number of workers is set to: %d, environment type of images submitted is %s",
-        workers_count,
+        "Starting worker processes, number of workers is set to: %d-%d, worker mode is %r, environment type of "
+        "images submitted is %s",
+        supervisor.min_workers,
+        supervisor.max_workers,
+        worker_mode,
         environment_type,
     )
-    for worker in range(workers_count):
-        p = Process(target=_submitter, args=args)
-        p.start()
-        _LOGGER.info("Started a new worker with PID: %d", p.pid)
-        process_pool.append(p)
-
-    # Check if all the processes is still alive.
-    while True:
-        if any(not process.is_alive() for process in process_pool):
-            raise RuntimeError("One of the processes failed")
-
-        time.sleep(5)
-
-    # Always fail, this should be run forever.
-    sys.exit(1)
+    supervisor.run(submitter, args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Local stand-ins for OpenShift and Thoth User API used by benchmarks."""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from multiprocessing import Queue
+from types import SimpleNamespace
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from openshift.dynamic.resource import ResourceInstance
+
+# Builds produce images tagged with their index so that submissions can be matched with watch events.
+_OUTPUT_IMAGE = "image-registry.openshift-image-registry.svc:5000/{namespace}/app:build-{index}"
+_BASE_IMAGE = "registry.access.redhat.com/ubi8/python-38:latest"
+
+
+def build_name(index: int) -> str:
+    """Get name of the build with the given index."""
+    return f"app-{index}"
+
+
+def build_event(index: int, namespace: str, phase: str = "Complete") -> Dict[str, Any]:
+    """Create a watch event of a finished build with the given index, failed builds produce no image."""
+    name = build_name(index)
+    build = {
+        "apiVersion": "build.openshift.io/v1",
+        "kind": "Build",
+        "metadata": {
+            "name": name,
+            "namespace": namespace,
+            "uid": f"00000000-0000-0000-0000-{index:012d}",
+            "resourceVersion": str(index + 1),
+            "selfLink": f"/apis/build.openshift.io/v1/namespaces/{namespace}/builds/{name}",
+            "annotations": {},
+        },
+        "spec": {"strategy": {"sourceStrategy": {"from": {"kind": "DockerImage", "name": _BASE_IMAGE}}}},
+        "status": {
+            "phase": phase,
+            "completionTimestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+    }
+    if phase == "Complete":
+        build["status"]["outputDockerImageReference"] = _OUTPUT_IMAGE.format(namespace=namespace, index=index)
+        build["status"]["output"] = {"to": {"imageDigest": f"sha256:{index:064x}"}}
+    return {"type": "ADDED", "object": ResourceInstance(None, build), "raw_object": build}
+
+
+def build_index(output_image: Optional[str]) -> Optional[int]:
+    """Get index of the build which produced the given image, the image might have been pushed elsewhere."""
+    if not output_image or "build-" not in output_image:
+        return None
+
+    return int(output_image.rsplit("build-", maxsplit=1)[1])
+
+
+class FakeBuildResource:
+    """Build resource of the dynamic client emitting a fixed number of completed builds on watch.
+
+    Emission time of each event is reported to the results queue. Once all the events were emitted, watches block as
+    a watch on a quiet namespace would.
+    """
+
+    def __init__(self, results: Queue, events: int, namespaces: int = 1, rate: float = 0.0) -> None:
+        """Configure the resource, events are spread across namespaces bench-0 .. bench-N."""
+        self.results = results
+        self.events = events
+        self.namespaces = [f"bench-{i}" for i in range(namespaces)]
+        self.rate = rate
+
+    def watch(self, namespace: Optional[str] = None, **_: Any) -> Iterator[Dict[str, Any]]:
+        """Emit events of builds in the given namespace, or in all namespaces if None."""
+        for index in range(self.events):
+            event_namespace = self.namespaces[index % len(self.namespaces)]
+            if namespace and event_namespace != namespace:
+                continue
+
+            if self.rate > 0:
+                time.sleep(len(self.namespaces) / self.rate if namespace else 1 / self.rate)
+
+            self.results.put(("emitted", index, time.time()))
+            yield build_event(index, event_namespace)
+
+        while True:
+            time.sleep(3600)
+
+
+class TraceBuildResource(FakeBuildResource):
+    """Build resource of the dynamic client emitting builds of a recorded trace.
+
+    Builds are emitted at their recorded offsets (in seconds from the first build) divided by speed, or as fast as
+    possible if speed is 0. Build with index i is the i-th build of the trace.
+    """
+
+    def __init__(self, results: Queue, builds: List[Dict[str, Any]], speed: float = 1.0) -> None:
+        """Configure the resource with builds parsed from a trace."""
+        super().__init__(results, len(builds), 1)
+        self.builds = builds
+        self.namespaces = sorted({build["namespace"] for build in builds})
+        self.speed = speed
+
+    def watch(self, namespace: Optional[str] = None, **_: Any) -> Iterator[Dict[str, Any]]:
+        """Emit events of recorded builds in the given namespace, or in all namespaces if None."""
+        started = time.monotonic()
+        for index, build in enumerate(self.builds):
+            if namespace and build["namespace"] != namespace:
+                continue
+
+            if self.speed > 0:
+                delay = build["offset"] / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.results.put(("emitted", index, time.time()))
+            yield build_event(index, build["namespace"], "Complete" if build["output"] else "Failed")
+
+        while True:
+            time.sleep(3600)
+
+
+class FakeOpenShift:
+    """Stand-in for thoth.common.OpenShift, build logs are served by a local log server."""
+
+    def __init__(self, build_resource: FakeBuildResource, log_server_url: str) -> None:
+        """Wire the fake client to the given resource and log server."""
+        self.openshift_api_url = log_server_url
+        self.token = "benchmark"
+        self.kubernetes_verify_tls = False
+        self.ocp_client = SimpleNamespace(resources=SimpleNamespace(get=lambda **_: build_resource))
+
+
+def start_log_server(log_size: int, sizes: Optional[Dict[str, int]] = None) -> ThreadingHTTPServer:
+    """Serve build logs of the given size on a local port in a background thread, sizes can be set per build name."""
+    line = b"Collecting package==1.0.0 from https://pypi.org/simple (from -r requirements.txt (line 1))\n"
+
+    def make_log(size: int) -> bytes:
+        return (line * (size // len(line) + 1))[:size]
+
+    default_log = make_log(log_size)
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa: N802
+            # The path is .../builds/<name>/log
+            name = self.path.rstrip("/").split("/")[-2]
+            log = make_log(sizes[name]) if sizes and name in sizes else default_log
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(log)))
+            self.end_headers()
+            self.wfile.write(log)
+
+        def log_message(self, *_: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="log-server", daemon=True).start()
+    return server
+
+
+class FakeBuildAnalysis:
+    """Stand-in for thamos.lib.build_analysis answering after the configured latency.
+
+    Arrival of each submission is reported to the results queue together with the size of the build log submitted.
+    """
+
+    def __init__(self, results: Queue, latency: float = 0.0, latencies: Optional[Dict[int, float]] = None) -> None:
+        """Configure latency of the fake User API, latencies can be set per build index."""
+        self.results = results
+        self.latency = latency
+        self.latencies = latencies or {}
+
+    def __call__(self, **parameters: Any) -> Any:
+        """Accept a build analysis request."""
+        index = build_index(parameters.get("output_image"))
+        self.results.put(("submitted", index, time.time(), len((parameters.get("build_log") or {}).get("log") or "")))
+        time.sleep(self.latencies.get(index, self.latency))
+        analysis = SimpleNamespace(analysis_id="benchmark")
+        return SimpleNamespace(
+            output_image_analysis=analysis,
+            base_image_analysis=analysis,
+            buildlog_analysis=analysis,
+            buildlog_document_id="benchmark",
+        )
+
+    def __wrapped__(self, _api_client: Any, **parameters: Any) -> Any:
+        """Accept a build analysis request done using a shared API client."""
+        return self(**parameters)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Replay a trace recorded by build-watcher (--record) through the pipeline against local stand-ins."""
+
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+from collections import defaultdict
+from multiprocessing import Queue
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import click
+
+from run import run_pipeline  # Sets up the import path and the stub skopeo.
+from fakes import FakeBuildAnalysis
+from fakes import TraceBuildResource
+from fakes import build_name
+from fakes import start_log_server
+from thoth.build_watcher import submitter
+
+_LOGGER = logging.getLogger("thoth.build_watcher.benchmarks")
+
+
+def load_trace(path: str) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, List[float]]]]:
+    """Load builds ordered by the time they were queued and durations of stages recorded for each build name."""
+    builds = []
+    stages: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+    with open(path) as trace_file:
+        for line_number, line in enumerate(trace_file, start=1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                _LOGGER.warning("Skipping malformed line %d of the trace", line_number)
+                continue
+
+            if record.get("kind") == "build":
+                builds.append(record)
+            elif record.get("kind") == "stage" and record.get("name"):
+                stages[record["name"]][record["stage"]].append(record["duration"])
+
+    builds.sort(key=lambda build: build["t"])
+    for build in builds:
+        build["offset"] = build["t"] - builds[0]["t"]
+
+    return builds, stages
+
+
+def _recorded_durations(
+    builds: List[Dict[str, Any]], stages: Dict[str, Dict[str, List[float]]], stage: str
+) -> Dict[int, float]:
+    """Assign durations of the given stage to builds by their index, repeated build names take them in order."""
+    durations = {}
+    for index, build in enumerate(builds):
+        recorded = stages.get(build["name"], {}).get(stage)
+        if recorded:
+            durations[index] = recorded.pop(0)
+
+    return durations
+
+
+@click.command()
+@click.argument("trace", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--speed",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Replay speed relative to the recorded pace of builds, e.g. 10 for ten times faster; 0 emits all the "
+    "builds at once.",
+)
+@click.option("--workers-count", type=int, default=1, show_default=True, help="Number of worker processes.")
+@click.option(
+    "--worker-mode", type=click.Choice(["process", "async"]), default="process", show_default=True, help="Worker mode."
+)
+@click.option("--max-in-flight", type=int, default=16, show_default=True, help="Submissions in flight per worker.")
+@click.option(
+    "--batch-size", type=int, default=1, show_default=True, help="Batch size of a worker in the process mode."
+)
+@click.option(
+    "--batch-wait", type=float, default=0.05, show_default=True, help="Time to fill a batch of a worker in seconds."
+)
+@click.option("--log-fetchers", type=int, default=4, show_default=True, help="Number of build log fetchers.")
+@click.option(
+    "--coalesce-window", type=float, default=0.0, show_default=True, help="Coalescing window of build events."
+)
+@click.option(
+    "--push-registry",
+    type=str,
+    help="Push images to this registry using the stub skopeo taking the recorded push durations, images are not "
+    "pushed if not set.",
+)
+@click.option("--timeout", type=float, default=3600.0, show_default=True, help="Maximum duration of the replay.")
+@click.option("--output", type=click.Path(dir_okay=False), help="Append results as JSON lines to the given file.")
+@click.option("--verbose", "-v", is_flag=True, help="Show logs of build-watcher.")
+def cli(
+    trace: str,
+    speed: float,
+    workers_count: int,
+    worker_mode: str,
+    max_in_flight: int,
+    batch_size: int,
+    batch_wait: float,
+    log_fetchers: int,
+    coalesce_window: float,
+    push_registry: Optional[str],
+    timeout: float,
+    output: Optional[str],
+    verbose: bool,
+) -> None:
+    """Replay builds of a recorded trace with their build log sizes and recorded push and analysis latencies."""
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    builds, stages = load_trace(trace)
+    if not builds:
+        raise click.ClickException(f"No builds recorded in {trace!r}")
+
+    analysis_latencies = _recorded_durations(builds, stages, "analysis")
+    push_latencies = _recorded_durations(builds, stages, "push")
+    # Builds without recorded timings (and base image pushes) take the median of the recorded ones.
+    analysis_latency = statistics.median(analysis_latencies.values()) if analysis_latencies else 0.0
+    os.environ["SKOPEO_STUB_DELAY"] = str(statistics.median(push_latencies.values()) if push_latencies else 0.0)
+    with tempfile.NamedTemporaryFile("w", prefix="skopeo-delays-", suffix=".txt", delete=False) as delays_file:
+        delays_file.writelines(f"{index} {delay}\n" for index, delay in push_latencies.items())
+    os.environ["SKOPEO_STUB_DELAYS"] = delays_file.name
+
+    results = Queue()
+    submitter.build_analysis = FakeBuildAnalysis(results, analysis_latency, analysis_latencies)
+    try:
+        result = run_pipeline(
+            results,
+            TraceBuildResource(results, builds, speed),
+            start_log_server(0, {build_name(index): build["log_size"] for index, build in enumerate(builds)}),
+            # Failed builds produce no image, they are replayed but their submissions are not matched.
+            sum(1 for build in builds if build["output"]),
+            workers_count=workers_count,
+            worker_mode=worker_mode,
+            max_in_flight=max_in_flight,
+            batch_size=batch_size,
+            batch_wait=batch_wait,
+            log_fetchers=log_fetchers,
+            coalesce_window=coalesce_window,
+            push_registry=push_registry,
+            timeout=timeout,
+        )
+    finally:
+        os.remove(delays_file.name)
+
+    result.update(trace=trace, speed=speed, recorded_duration=builds[-1]["offset"])
+    click.echo(json.dumps(result, indent=2))
+    if output:
+        with open(output, "a") as output_file:
+            output_file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure throughput of the build-watcher pipeline against local stand-ins for OpenShift, Thoth and skopeo."""
+
+import json
+import logging
+import os
+import queue as queue_module
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+from multiprocessing import Queue
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import click
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_HERE))
+# Read by the submitter on import.
+os.environ.setdefault("SKOPEO_EXEC_PATH", os.path.join(_HERE, "bin", "skopeo"))
+
+from fakes import FakeBuildAnalysis  # noqa: E402
+from fakes import FakeBuildResource  # noqa: E402
+from fakes import FakeOpenShift  # noqa: E402
+from fakes import start_log_server  # noqa: E402
+from thoth.build_watcher import producer  # noqa: E402
+from thoth.build_watcher import submitter  # noqa: E402
+from thoth.build_watcher.buildlog import BuildLogFetcher  # noqa: E402
+from thoth.build_watcher.buildlog import BuildLogSpool  # noqa: E402
+
+_LOGGER = logging.getLogger("thoth.build_watcher.benchmarks")
+
+
+def _percentile(values: List[float], percentile: float) -> Optional[float]:
+    """Compute the given percentile using the nearest rank method."""
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(percentile / 100 * len(values))) - 1))]
+
+
+def _peak_rss(pids: List[int]) -> Optional[int]:
+    """Sum peak resident set sizes of the given processes in bytes, None if not available on this platform."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            return None
+
+    return total
+
+
+def _collect(results: Queue, events: int, timeout: float) -> Tuple[Dict[int, float], Dict[int, float], int]:
+    """Collect emission and submission times of builds until all of them were submitted or the timeout elapses."""
+    emitted: Dict[int, float] = {}
+    submitted: Dict[int, float] = {}
+    log_bytes = 0
+    deadline = time.monotonic() + timeout
+    while len(submitted) < events and time.monotonic() < deadline:
+        try:
+            record = results.get(timeout=1)
+        except queue_module.Empty:
+            continue
+
+        if record[0] == "emitted":
+            emitted[record[1]] = record[2]
+        elif record[1] is not None and record[1] not in submitted:
+            submitted[record[1]] = record[2]
+            log_bytes += record[3]
+
+    return emitted, submitted, log_bytes
+
+
+def run_pipeline(
+    results: Queue,
+    build_resource: Any,
+    log_server: Any,
+    expected: int,
+    *,
+    workers_count: int,
+    worker_mode: str,
+    max_in_flight: int,
+    batch_size: int,
+    batch_wait: float,
+    log_fetchers: int,
+    coalesce_window: float,
+    push_registry: Optional[str],
+    timeout: float,
+) -> Dict[str, Any]:
+    """Run the event producer and workers against the given stand-ins until the expected builds were submitted.
+
+    Thoth User API is expected to be already replaced by a stand-in reporting to the results queue.
+    """
+    # Processes are forked, the fakes are inherited by the producer and workers.
+    fake_openshift = FakeOpenShift(build_resource, f"http://127.0.0.1:{log_server.server_port}")
+    producer.openshift_client = lambda: fake_openshift
+    submitter.thoth_api_client = lambda: None
+
+    work_queue = Queue()
+    spool_dir = tempfile.mkdtemp(prefix="build-watcher-benchmark-")
+    processes = [
+        Process(
+            target=producer.event_producer,
+            args=(
+                work_queue,
+                build_resource.namespaces,
+                BuildLogFetcher(2097152, BuildLogSpool(spool_dir)),
+                None,
+                log_fetchers,
+                coalesce_window,
+            ),
+        )
+    ]
+    for _ in range(workers_count):
+        processes.append(
+            Process(
+                target=submitter.submitter,
+                kwargs=dict(
+                    queue=work_queue,
+                    push_registry=push_registry,
+                    environment_type=None,
+                    dedup_cache_size=0,
+                    worker_mode=worker_mode,
+                    max_in_flight=max_in_flight,
+                    push_cache_size=0,
+                    batch_size=batch_size,
+                    batch_wait=batch_wait,
+                ),
+            )
+        )
+
+    for process in processes:
+        process.start()
+
+    try:
+        emitted, submitted, log_bytes = _collect(results, expected, timeout)
+        peak_rss = _peak_rss([process.pid for process in processes])
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        log_server.shutdown()
+
+    latencies = [submitted[index] - emitted[index] for index in submitted if index in emitted]
+    duration = max(submitted.values()) - min(emitted.values()) if submitted and emitted else None
+    return {
+        "workers_count": workers_count,
+        "worker_mode": worker_mode,
+        "batch_size": batch_size,
+        "events": expected,
+        "submitted": len(submitted),
+        "events_per_second": len(submitted) / duration if duration else None,
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p99": _percentile(latencies, 99),
+        "peak_rss": peak_rss,
+        "log_bytes_submitted": log_bytes,
+    }
+
+
+def run_once(
+    *,
+    events: int,
+    workers_count: int,
+    log_size: int,
+    namespaces: int,
+    rate: float,
+    analysis_latency: float,
+    **options: Any,
+) -> Dict[str, Any]:
+    """Run the pipeline once with synthetic builds and report its performance, see run_pipeline for options."""
+    results = Queue()
+    submitter.build_analysis = FakeBuildAnalysis(results, analysis_latency)
+    result = run_pipeline(
+        results,
+        FakeBuildResource(results, events, namespaces, rate),
+        start_log_server(log_size),
+        events,
+        workers_count=workers_count,
+        **options,
+    )
+    result["log_size"] = log_size
+    return result
+
+
+def _format(value: Optional[float], unit: str = "", scale: float = 1.0) -> str:
+    """Format a measured value for the report."""
+    return "n/a" if value is None else f"{value / scale:.2f}{unit}"
+
+
+@click.command()
+@click.option("--events", type=int, default=500, show_default=True, help="Number of build events emitted.")
+@click.option(
+    "--workers-count",
+    type=int,
+    multiple=True,
+    default=(1, 4),
+    show_default=True,
+    help="Number of worker processes, can be given multiple times.",
+)
+@click.option(
+    "--log-size",
+    type=int,
+    multiple=True,
+    default=(4096, 1048576),
+    show_default=True,
+    help="Size of build logs in bytes, can be given multiple times.",
+)
+@click.option("--namespaces", type=int, default=1, show_default=True, help="Number of namespaces watched.")
+@click.option(
+    "--rate", type=float, default=0.0, show_default=True, help="Build events emitted per second, 0 for no limit."
+)
+@click.option(
+    "--analysis-latency", type=float, default=0.05, show_default=True, help="Latency of the fake User API in seconds."
+)
+@click.option(
+    "--skopeo-latency",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Duration of an image copy done by the stub skopeo in seconds.",
+)
+@click.option(
+    "--push-registry",
+    type=str,
+    help="Push images to this registry using the stub skopeo, images are not pushed if not set.",
+)
+@click.option(
+    "--worker-mode", type=click.Choice(["process", "async"]), default="process", show_default=True, help="Worker mode."
+)
+@click.option("--max-in-flight", type=int, default=16, show_default=True, help="Submissions in flight per worker.")
+@click.option(
+    "--batch-size", type=int, default=1, show_default=True, help="Batch size of a worker in the process mode."
+)
+@click.option(
+    "--batch-wait", type=float, default=0.05, show_default=True, help="Time to fill a batch of a worker in seconds."
+)
+@click.option("--log-fetchers", type=int, default=4, show_default=True, help="Number of build log fetchers.")
+@click.option(
+    "--coalesce-window", type=float, default=0.0, show_default=True, help="Coalescing window of build events."
+)
+@click.option("--timeout", type=float, default=300.0, show_default=True, help="Maximum duration of one run.")
+@click.option("--output", type=click.Path(dir_okay=False), help="Append results as JSON lines to the given file.")
+@click.option("--verbose", "-v", is_flag=True, help="Show logs of build-watcher.")
+def cli(
+    events: int,
+    workers_count: Tuple[int, ...],
+    log_size: Tuple[int, ...],
+    namespaces: int,
+    rate: float,
+    analysis_latency: float,
+    skopeo_latency: float,
+    push_registry: Optional[str],
+    worker_mode: str,
+    max_in_flight: int,
+    batch_size: int,
+    batch_wait: float,
+    log_fetchers: int,
+    coalesce_window: float,
+    timeout: float,
+    output: Optional[str],
+    verbose: bool,
+) -> None:
+    """Measure events/sec, event to submission latency and peak RSS of build-watcher with local stand-ins."""
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    os.environ["SKOPEO_STUB_DELAY"] = str(skopeo_latency)
+
+    click.echo("workers  mode     log size  submitted  events/s  p50 [s]  p99 [s]  peak RSS [MiB]")
+    for workers in workers_count:
+        for size in log_size:
+            result = run_once(
+                events=events,
+                workers_count=workers,
+                log_size=size,
+                namespaces=namespaces,
+                rate=rate,
+                analysis_latency=analysis_latency,
+                worker_mode=worker_mode,
+                max_in_flight=max_in_flight,
+                batch_size=batch_size,
+                batch_wait=batch_wait,
+                log_fetchers=log_fetchers,
+                coalesce_window=coalesce_window,
+                push_registry=push_registry,
+                timeout=timeout,
+            )
+            click.echo(
+                f"{workers:>7}  {worker_mode:<7}  {size:>8}  {result['submitted']:>9}  "
+                f"{_format(result['events_per_second']):>8}  {_format(result['latency_p50']):>7}  "
+                f"{_format(result['latency_p99']):>7}  {_format(result['peak_rss'], scale=1048576):>14}"
+            )
+            if output:
+                with open(output, "a") as output_file:
+                    output_file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -4,7 +4,8 @@ set -x
 
 oc status
 
-THOTH_WATCHED_NAMESPACE="thoth-test-core"  # Namespace where builds are done.
+THOTH_WATCHED_NAMESPACE="thoth-test-core"  # Namespace where build-watcher is deployed.
+THOTH_WATCHED_NAMESPACES="$THOTH_WATCHED_NAMESPACE"  # Comma separated namespaces where builds are done.
 THOTH_INFRA_NAMESPACE="thoth-test-core"  # Namespace where build-watcher container image lives in.
 THOTH_LOGGING_NO_JSON="1"  # Do not use structured JSON logging.
 
@@ -43,6 +44,7 @@ oc process -f openshift/buildConfig-template.yaml | oc apply -f -
 oc start-build thoth-build-watcher
 oc process -f openshift/deployment-template.yaml \
   -p THOTH_WATCHED_NAMESPACE="$THOTH_WATCHED_NAMESPACE" \
+  -p THOTH_WATCHED_NAMESPACES="$THOTH_WATCHED_NAMESPACES" \
   -p THOTH_INFRA_NAMESPACE="$THOTH_INFRA_NAMESPACE" \
   -p THOTH_LOGGING_NO_JSON="$THOTH_LOGGING_NO_JSON" \
   -p THOTH_SRC_REGISTRY_USER="$THOTH_SRC_REGISTRY_USER" \
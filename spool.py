@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Inspect and replay submissions in the work spool of build-watcher."""
+
+import json
+import sys
+import time
+from typing import Tuple
+
+import click
+
+from thoth.build_watcher.workspool import WorkSpool
+
+
+@click.group()
+@click.option(
+    "--spool-path",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    envvar="THOTH_BUILD_WATCHER_SPOOL_PATH",
+    help="Path to the SQLite database used as the work spool by build-watcher.",
+)
+@click.pass_context
+def cli(ctx: click.Context, spool_path: str) -> None:
+    """Inspect and replay submissions in the work spool of build-watcher."""
+    ctx.obj = WorkSpool(spool_path)
+
+
+@cli.command("stats")
+@click.pass_obj
+def stats(spool: WorkSpool) -> None:
+    """Print number of entries waiting in the spool and in the dead letter table."""
+    click.echo(f"waiting: {spool.qsize()}")
+    click.echo(f"dead letters: {spool.dead_letter_count()}")
+
+
+@cli.command("list")
+@click.option("--limit", type=int, default=100, show_default=True, help="Maximum number of entries listed.")
+@click.option("--json", "as_json", is_flag=True, help="Print entries as JSON, including references.")
+@click.pass_obj
+def list_(spool: WorkSpool, limit: int, as_json: bool) -> None:
+    """List entries in the dead letter table, the most recently failed first."""
+    entries = spool.dead_letters(limit=limit)
+    if as_json:
+        click.echo(json.dumps(entries, indent=2))
+        return
+
+    for entry in entries:
+        reference = entry["reference"]
+        if isinstance(reference, dict):
+            reference = reference.get("name") or reference.get("output_reference")
+
+        failed = time.ctime(entry["failed"])
+        click.echo(f"{entry['id']}\t{failed}\tattempts: {entry['attempts']}\t{reference}\t{entry['error']}")
+
+
+@cli.command("replay")
+@click.argument("entry_ids", nargs=-1, type=int)
+@click.option("--all", "replay_all", is_flag=True, help="Replay all the entries in the dead letter table.")
+@click.pass_obj
+def replay(spool: WorkSpool, entry_ids: Tuple[int, ...], replay_all: bool) -> None:
+    """Move the given entries from the dead letter table back to the spool so that they are submitted again."""
+    if not entry_ids and not replay_all:
+        raise click.UsageError("No entries to replay given, pass entry ids or --all")
+
+    replayed = spool.replay(None if replay_all else list(entry_ids))
+    click.echo(f"Replayed {replayed} entries")
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
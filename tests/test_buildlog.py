@@ -0,0 +1,271 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of bounded reading and reduction of build logs."""
+
+import pytest
+
+from thoth.build_watcher.buildlog import build_log_digest
+from thoth.build_watcher.buildlog import normalize_build_log
+from thoth.build_watcher.buildlog import read_bounded
+from thoth.build_watcher.buildlog import read_reduced
+from thoth.build_watcher.buildlog import reduce_build_log
+
+_BUILD_LOG = """\
+Cloning "https://github.com/thoth-station/s2i-example" ...
+\tCommit:\t1234567 (Initial commit)
+---> Installing application source ...
+---> Installing dependencies ...
+Collecting flask==1.1.2
+  Downloading Flask-1.1.2-py2.py3-none-any.whl (94 kB)
+████████ 94 kB 1.2 MB/s
+Installing collected packages: flask
+Successfully installed flask-1.1.2
+STEP 9: COMMIT temp.builder.openshift.io/app:1234
+Getting image source signatures
+Traceback (most recent call last):
+  File "app.py", line 1, in <module>
+    import missing
+ModuleNotFoundError: No module named 'missing'
+Writing manifest to image destination
+"""
+
+_LINES = b"line1\nline2\nline3\nline4\n"
+
+
+def test_read_bounded_no_cap() -> None:
+    """Test the whole build log is read if there is no cap."""
+    assert read_bounded([_LINES, _LINES], 0) == (_LINES * 2, 48, 0)
+
+
+@pytest.mark.parametrize("max_bytes", [24, 100])
+def test_read_bounded_within_cap(max_bytes: int) -> None:
+    """Test build logs not exceeding the cap are read unchanged."""
+    assert read_bounded([_LINES[:10], _LINES[10:]], max_bytes) == (_LINES, 24, 0)
+
+
+@pytest.mark.parametrize(
+    "max_bytes,expected,omitted",
+    [
+        # The tail window holds no complete line, so its partial line is kept rather than emptying the tail.
+        (10, b"line1\n... [14 bytes of build log omitted] ...\nine4\n", 14),
+        (16, b"line1\n... [12 bytes of build log omitted] ...\nline4\n", 12),
+        (23, b"line1\n... [6 bytes of build log omitted] ...\nline3\nline4\n", 6),
+    ],
+)
+def test_read_bounded_over_cap(max_bytes: int, expected: bytes, omitted: int) -> None:
+    """Test head and tail windows are aligned to line boundaries when they hold a complete line."""
+    assert read_bounded([_LINES], max_bytes) == (expected, 24, omitted)
+
+
+def test_read_bounded_single_line() -> None:
+    """Test a single line exceeding the cap is cut, the marker is placed on a line of its own."""
+    content, size, omitted = read_bounded([b"a" * 50 + b"b" * 50], 10)
+
+    assert content == b"aaaaa\n... [90 bytes of build log omitted] ...\nbbbbb"
+    assert (size, omitted) == (100, 90)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 10, 24])
+def test_read_bounded_chunk_boundaries(chunk_size: int) -> None:
+    """Test the result does not depend on how the build log is split into chunks."""
+    build_log = b"".join(b"line%d\n" % number for number in range(100))
+    chunks = [build_log[offset : offset + chunk_size] for offset in range(0, len(build_log), chunk_size)]
+
+    assert read_bounded(chunks, 40) == read_bounded([build_log], 40)
+    content, size, omitted = read_bounded(chunks, 40)
+    assert content.startswith(b"line0\nline1\n")
+    assert content.endswith(b"\nline98\nline99\n")
+    assert size - omitted == len(content) - len(b"... [%d bytes of build log omitted] ...\n" % omitted)
+
+
+def test_reduce_sections() -> None:
+    """Test dependencies and traceback sections are kept, everything else is dropped."""
+    reduced, sections = reduce_build_log(_BUILD_LOG)
+
+    assert [section["kind"] for section in sections] == ["dependencies", "traceback"]
+    dependencies = reduced[sections[0]["start"] : sections[0]["end"]]
+    assert dependencies.startswith("---> Installing dependencies ...\n")
+    assert "Successfully installed flask-1.1.2\n" in dependencies
+    # Progress bars are dropped, the section ends with the next build step.
+    assert "94 kB 1.2 MB/s" not in dependencies
+    assert "STEP 9" not in reduced
+    assert reduced[sections[1]["start"] : sections[1]["end"]] == (
+        "Traceback (most recent call last):\n"
+        '  File "app.py", line 1, in <module>\n'
+        "    import missing\n"
+        "ModuleNotFoundError: No module named 'missing'\n"
+    )
+    assert sections[0]["line"] == 4
+    assert sections[1]["line"] == 12
+    assert "Cloning" not in reduced
+    assert "Writing manifest" not in reduced
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "error: subprocess-exited-with-error",
+        "Error: foo",
+        "ERROR: Could not find a version that satisfies the requirement flask==99",
+        "FATAL: build failed",
+        "Failed to pull image",
+    ],
+)
+def test_reduce_error_lines(line: str) -> None:
+    """Test error lines outside of sections are kept as sections of their own."""
+    reduced, sections = reduce_build_log(f"Cloning ...\n{line}\nPushing image ...\n")
+
+    assert reduced == f"{line}\n"
+    assert sections == [{"kind": "error", "start": 0, "end": len(line) + 1, "line": 2}]
+
+
+def test_reduce_no_section() -> None:
+    """Test build logs without any section recognized are returned unchanged."""
+    build_log = "Cloning ...\nBuilding ...\nPush successful\n"
+
+    assert reduce_build_log(build_log) == (build_log, [])
+
+
+def _chunked(content: bytes, chunk_size: int) -> list:
+    """Split content into chunks of the given size."""
+    return [content[i : i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 4096])
+def test_read_reduced_same_as_reduce(chunk_size: int) -> None:
+    """Test build logs reduced while streamed match build logs reduced at once, regardless of chunks."""
+    build_log, size, omitted, sections = read_reduced(_chunked(_BUILD_LOG.encode(), chunk_size))
+
+    assert (build_log, sections) == reduce_build_log(_BUILD_LOG)
+    assert size == len(_BUILD_LOG.encode())
+    assert omitted == 0
+
+
+def test_read_reduced_cap_after_reduction() -> None:
+    """Test sections in the middle of a build log larger than the cap are kept, the cap applies to the result."""
+    noise = "".join(f"Copying blob {index}\n" for index in range(20000)).encode()
+    content = noise + _BUILD_LOG.encode() + noise
+    build_log, size, omitted, sections = read_reduced(_chunked(content, 65536), 4096)
+
+    assert size == len(content)
+    assert omitted == 0
+    assert build_log == reduce_build_log(_BUILD_LOG)[0]
+    assert [section["line"] for section in sections] == [
+        section["line"] + 20000 for section in reduce_build_log(_BUILD_LOG)[1]
+    ]
+
+
+def test_read_reduced_over_cap() -> None:
+    """Test the reduced build log is cut between lines keeping its beginning and end."""
+    content = "".join(f"ERROR: step {index} failed\n" for index in range(1000)).encode()
+    build_log, size, omitted, sections = read_reduced(_chunked(content, 100), 200)
+
+    head, marker, tail = build_log.partition(f"... [{omitted} bytes of build log omitted] ...\n")
+    assert marker
+    assert head.startswith("ERROR: step 0 failed\n") and head.endswith(" failed\n")
+    assert tail.endswith("ERROR: step 999 failed\n") and tail.startswith("ERROR: step ")
+    assert len((head + tail).encode()) <= 200
+    assert len((head + tail).encode()) + omitted == len(content)
+    assert sections[0] == {"kind": "error", "start": 0, "end": len("ERROR: step 0 failed\n"), "line": 1}
+
+
+def test_read_reduced_long_line() -> None:
+    """Test a line longer than the cap is cut, so that it is not kept in memory as a whole."""
+    content = b"ERROR: " + b"x" * 100000 + b"\nERROR: done\n"
+    build_log, _, omitted, _ = read_reduced(_chunked(content, 1000), 64)
+
+    assert omitted == 0
+    assert build_log == "ERROR: " + "x" * 24 + "\nERROR: done\n"
+
+
+def test_read_reduced_no_section() -> None:
+    """Test build logs without any section are read as by read_bounded."""
+    content = b"".join(f"Copying blob {index}\n".encode() for index in range(100))
+
+    content_read, size, omitted = read_bounded([content], 256)
+
+    assert read_reduced(_chunked(content, 10), 256) == (content_read.decode(), size, omitted, None)
+
+
+_LOG_TEMPLATE = """\
+{timestamp} Cloning "https://github.com/thoth-station/app" ...
+Pulling image "quay.io/thoth/base@sha256:{digest}" ...
+Running in pod {pod}, build started at {time}
+Collecting flask==1.1.2
+  Downloading flask-1.1.2-py2.py3-none-any.whl (94 kB)
+Successfully installed flask-1.1.2
+Storing signatures into /tmp/{tmp}
+Writing manifest to image destination
+Pushed sha256:{digest} in {duration}
+"""
+
+
+def _build_log(**kwargs: str) -> str:
+    """Create a build log of one build of the same application."""
+    values = {
+        "timestamp": "2021-03-04T10:11:12.345Z",
+        "digest": "a" * 64,
+        "pod": "app-1-build",
+        "time": "10:11:12",
+        "tmp": "buildah123456",
+        "duration": "1.5s",
+    }
+    values.update(kwargs)
+    return _LOG_TEMPLATE.format(**values)
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        {"timestamp": "2021-05-06 01:02:03+02:00"},
+        {"digest": "0123456789abcdef" * 4},
+        {"pod": "app-42-build"},
+        {"time": "23:59:01.123"},
+        {"tmp": "buildah987654"},
+        {"duration": "250ms"},
+        {
+            "timestamp": "2022-01-01T00:00:00Z",
+            "digest": "f" * 64,
+            "pod": "app-7-build",
+            "time": "00:00:01",
+            "tmp": "buildah-x",
+            "duration": "12 s",
+        },
+    ],
+)
+def test_build_log_digest_volatile(changes: dict) -> None:
+    """Test build logs differing only in timestamps, pod names, digests and similar parts share the digest."""
+    build_log = _build_log(**changes)
+
+    assert build_log != _build_log()
+    assert normalize_build_log(build_log) == normalize_build_log(_build_log())
+    assert build_log_digest(build_log) == build_log_digest(_build_log())
+
+
+@pytest.mark.parametrize(
+    "build_log",
+    [
+        _build_log().replace("flask==1.1.2", "flask==2.0.0").replace("flask-1.1.2", "flask-2.0.0"),
+        _build_log().replace("Collecting flask==1.1.2\n", "Collecting flask==1.1.2\nCollecting requests\n"),
+        _build_log().replace("Successfully installed", "ERROR: Could not install"),
+        _build_log().replace("thoth-station/app", "thoth-station/other"),
+        "",
+    ],
+)
+def test_build_log_digest_different(build_log: str) -> None:
+    """Test build logs installing different dependencies or failing differently do not share the digest."""
+    assert build_log_digest(build_log) != build_log_digest(_build_log())
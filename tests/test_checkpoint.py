@@ -0,0 +1,70 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the build watch checkpoint."""
+
+import json
+
+from thoth.build_watcher.checkpoint import WatchCheckpoint
+
+
+def test_checkpoint_persisted(tmp_path) -> None:
+    """Test resourceVersions are kept per namespace and loaded back after a restart."""
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = WatchCheckpoint(path)
+    checkpoint.set("first", "10")
+    checkpoint.set("second", "20", bookmark=True)
+    checkpoint.set("first", "11")
+    checkpoint.set("first", None)
+
+    restored = WatchCheckpoint(path)
+    assert restored.get("first") == "11"
+    assert restored.get("second") == "20"
+    assert restored.get("third") is None
+    with open(path) as checkpoint_file:
+        assert json.load(checkpoint_file)["resource_versions"]["second"]["bookmark"] is True
+
+
+def test_checkpoint_reset(tmp_path) -> None:
+    """Test a reset namespace starts from scratch after a restart too."""
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = WatchCheckpoint(path)
+    checkpoint.set("first", "10")
+    checkpoint.reset("first")
+
+    assert checkpoint.get("first") is None
+    assert WatchCheckpoint(path).get("first") is None
+
+
+def test_checkpoint_corrupted(tmp_path) -> None:
+    """Test a corrupted checkpoint is ignored and overwritten."""
+    path = tmp_path / "checkpoint.json"
+    path.write_text("{")
+
+    checkpoint = WatchCheckpoint(str(path))
+    assert checkpoint.get("first") is None
+
+    checkpoint.set("first", "10")
+    assert WatchCheckpoint(str(path)).get("first") == "10"
+
+
+def test_checkpoint_in_memory() -> None:
+    """Test the checkpoint without a path is kept only in memory."""
+    checkpoint = WatchCheckpoint()
+    checkpoint.set("first", "10")
+
+    assert checkpoint.get("first") == "10"
+    assert WatchCheckpoint().get("first") is None
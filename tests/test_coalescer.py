@@ -0,0 +1,123 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of coalescing of repeated build events."""
+
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from thoth.build_watcher.coalescer import EventCoalescer
+
+
+class _FakePool:
+    """Record calls done to the fetcher pool."""
+
+    def __init__(self) -> None:
+        """Start with no calls recorded."""
+        self.calls: List[tuple] = []
+        self._sequence = 0
+
+    def submit(
+        self, namespace: str, resource_version: Optional[str], descriptor: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Record an event handed over."""
+        self.calls.append(("submit", namespace, resource_version, descriptor))
+
+    def defer(self, namespace: str, resource_version: Optional[str]) -> int:
+        """Record a held event and give it a position."""
+        self._sequence += 1
+        self.calls.append(("defer", namespace, resource_version, self._sequence))
+        return self._sequence
+
+    def release(self, namespace: str, sequence: int, descriptor: Optional[Dict[str, Any]] = None) -> None:
+        """Record a held event released."""
+        self.calls.append(("release", namespace, sequence, descriptor))
+
+    def reset(self, namespace: str) -> None:
+        """Record a reset of the namespace."""
+        self.calls.append(("reset", namespace))
+
+
+def _wait_for(pool: _FakePool, kind: str, timeout: float = 5.0) -> None:
+    """Wait until the pool was called with the given kind of call."""
+    deadline = time.monotonic() + timeout
+    while not any(call[0] == kind for call in pool.calls):
+        assert time.monotonic() < deadline, f"No {kind} call in {pool.calls}"
+        time.sleep(0.01)
+
+
+def test_repeated_events_suppressed() -> None:
+    """Test only the first event of a build is handed over without a window, later ones only move the position."""
+    pool = _FakePool()
+    coalescer = EventCoalescer(pool, window=0)
+    build = {"build_uid": "uid", "name": "build-1"}
+
+    coalescer.submit("namespace", "1", build)
+    coalescer.submit("namespace", "2", build)
+
+    assert pool.calls == [("submit", "namespace", "1", build), ("submit", "namespace", "2", None)]
+
+
+def test_events_without_build_passed() -> None:
+    """Test events which do not describe a build are passed to the pool as they are."""
+    pool = _FakePool()
+    coalescer = EventCoalescer(pool, window=0)
+
+    coalescer.submit("namespace", "1")
+    coalescer.submit("namespace", "1")
+
+    assert pool.calls == [("submit", "namespace", "1", None)] * 2
+
+
+def test_window_keeps_last_event() -> None:
+    """Test events within the window are coalesced, the descriptor of the last one is handed over once."""
+    pool = _FakePool()
+    coalescer = EventCoalescer(pool, window=0.2)
+    first = {"build_uid": "uid", "name": "build-1", "phase": "Running"}
+    last = {"build_uid": "uid", "name": "build-1", "phase": "Complete"}
+
+    coalescer.submit("namespace", "1", first)
+    coalescer.submit("namespace", "2", last)
+    coalescer.submit("namespace", "2", last)
+    _wait_for(pool, "release")
+
+    assert pool.calls[0] == ("defer", "namespace", "1", 1)
+    assert pool.calls[-1] == ("release", "namespace", 1, last)
+    assert [call[0] for call in pool.calls] == ["defer", "submit", "submit", "release"]
+
+    coalescer.submit("namespace", "3", last)
+    assert pool.calls[-1] == ("submit", "namespace", "3", None)
+
+
+def test_reset_defers_held_events_again() -> None:
+    """Test events held when the namespace is reset get a new position in the pool."""
+    pool = _FakePool()
+    coalescer = EventCoalescer(pool, window=0.2)
+    build = {"build_uid": "uid", "name": "build-1"}
+
+    coalescer.submit("namespace", "1", build)
+    coalescer.reset("namespace")
+    _wait_for(pool, "release")
+
+    assert pool.calls == [
+        ("defer", "namespace", "1", 1),
+        ("reset", "namespace"),
+        ("defer", "namespace", "1", 2),
+        ("release", "namespace", 2, build),
+    ]
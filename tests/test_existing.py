@@ -0,0 +1,133 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the scan of existing images."""
+
+import queue
+import threading
+from types import SimpleNamespace
+from typing import Any
+from typing import List
+from typing import Optional
+
+from kubernetes.client.rest import ApiException
+from openshift.dynamic.exceptions import GoneError
+from openshift.dynamic.resource import ResourceInstance
+
+from thoth.build_watcher import existing
+from thoth.build_watcher.existing import ExistingImageScanner
+
+
+def _page(images: List[str], continue_token: Optional[str]) -> ResourceInstance:
+    """Construct a page of image streams, each with one tag pointing to one of the given images."""
+    return ResourceInstance(
+        None,
+        {
+            "apiVersion": "image.openshift.io/v1",
+            "kind": "ImageStreamList",
+            "metadata": {"continue": continue_token},
+            "items": [
+                {
+                    "metadata": {"name": f"app-{image}", "namespace": "thoth"},
+                    "status": {
+                        "tags": [
+                            {
+                                "tag": "latest",
+                                "items": [
+                                    {
+                                        "image": f"sha256:{image}",
+                                        "created": "2021-01-01T00:00:00Z",
+                                        "dockerImageReference": f"quay.io/thoth/app@sha256:{image}",
+                                    }
+                                ],
+                            }
+                        ]
+                    },
+                }
+                for image in images
+            ],
+        },
+    )
+
+
+class _ImageStreams:
+    """Image streams listed in pages, listing with a continue token fails with 410 the given number of times."""
+
+    def __init__(self, gone: int) -> None:
+        """Set up the fake resource."""
+        self.gone = gone
+        self.requests: List[Optional[str]] = []
+
+    def get(self, namespace: Optional[str], limit: int, _continue: Optional[str]) -> Any:
+        """List one page of image streams."""
+        self.requests.append(_continue)
+        if _continue is None:
+            return _page(["1", "2"], "next")
+        if self.gone:
+            self.gone -= 1
+            raise GoneError(ApiException(status=410, reason="Gone"))
+        return _page(["3"], None)
+
+
+def _scanner(image_streams: _ImageStreams, work_queue: queue.Queue, monkeypatch, sleeps: List[float]) -> Any:
+    """Create a scanner with sleeping recorded instead of done."""
+    monkeypatch.setattr(existing, "time", SimpleNamespace(time=existing.time.time, sleep=sleeps.append))
+    return ExistingImageScanner(work_queue, image_streams, page_size=2, max_restarts=3, restart_backoff=1.0)
+
+
+def test_scan_restarted_on_gone(monkeypatch) -> None:
+    """Test a scan whose continue token expired is restarted with backoff and each image is queued once."""
+    work_queue: queue.Queue = queue.Queue()
+    sleeps: List[float] = []
+    image_streams = _ImageStreams(gone=2)
+
+    assert _scanner(image_streams, work_queue, monkeypatch, sleeps).run(["thoth"]) is True
+    assert image_streams.requests == [None, "next", None, "next", None, "next"]
+    assert sleeps == [1.0, 2.0]
+    assert sorted(work_queue.get_nowait()["output_digest"] for _ in range(3)) == ["sha256:1", "sha256:2", "sha256:3"]
+    assert work_queue.empty()
+
+
+def test_scan_left_unfinished_after_restarts(monkeypatch) -> None:
+    """Test a namespace whose continue token keeps expiring is given up after the maximum number of restarts."""
+    work_queue: queue.Queue = queue.Queue()
+    sleeps: List[float] = []
+    image_streams = _ImageStreams(gone=100)
+
+    assert _scanner(image_streams, work_queue, monkeypatch, sleeps).run(["thoth"]) is False
+    assert len(image_streams.requests) == 8
+    assert sleeps == [1.0, 2.0, 4.0]
+
+
+def test_scan_stopped_and_resumed(tmp_path) -> None:
+    """Test a stopped scan is left unfinished after the page being processed and is resumed by the next scan."""
+    state_path = str(tmp_path / "state.json")
+    work_queue: queue.Queue = queue.Queue()
+    image_streams = _ImageStreams(gone=0)
+    stop = threading.Event()
+    scanner = ExistingImageScanner(work_queue, image_streams, state_path=state_path, page_size=2, stop=stop)
+    # Stop is requested while the first page is being processed.
+    scanner._queue_image_stream = lambda item, since: (stop.set(), work_queue.put(item.metadata.name))
+
+    assert scanner.run(["thoth"]) is False
+    assert image_streams.requests == [None]
+    assert [work_queue.get_nowait() for _ in range(2)] == ["app-1", "app-2"]
+
+    image_streams.requests.clear()
+    assert ExistingImageScanner(work_queue, image_streams, state_path=state_path, page_size=2).run(["thoth"]) is True
+    assert image_streams.requests == ["next"]
+    assert work_queue.get_nowait()["output_digest"] == "sha256:3"
+    assert work_queue.empty()
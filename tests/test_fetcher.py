@@ -0,0 +1,117 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the pool of build log fetchers."""
+
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+
+from thoth.build_watcher.checkpoint import WatchCheckpoint
+from thoth.build_watcher.fetcher import FetcherPool
+
+
+def _wait_for(condition: Any, timeout: float = 5.0) -> None:
+    """Wait until the given condition holds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Condition not met in time"
+        time.sleep(0.01)
+
+
+def test_checkpoint_advanced_in_order() -> None:
+    """Test the checkpoint is not advanced past a slow fetch even if later fetches finished before it."""
+    release_first = threading.Event()
+    fetched: List[str] = []
+
+    def fetch(descriptor: Dict[str, Any]) -> None:
+        if descriptor["name"] == "slow":
+            release_first.wait(timeout=10)
+        fetched.append(descriptor["name"])
+
+    checkpoint = WatchCheckpoint()
+    pool = FetcherPool(fetch, 2, checkpoint)
+    pool.submit("thoth", "1", {"name": "slow", "namespace": "thoth"})
+    pool.submit("thoth", "2", {"name": "fast", "namespace": "thoth"})
+    pool.submit("thoth", "3")
+
+    _wait_for(lambda: fetched == ["fast"])
+    time.sleep(0.05)
+    assert checkpoint.get("thoth") is None
+
+    release_first.set()
+    _wait_for(lambda: checkpoint.get("thoth") == "3")
+    assert fetched == ["fast", "slow"]
+
+
+def test_checkpoint_per_namespace() -> None:
+    """Test a slow fetch in one namespace does not hold the checkpoint of another namespace."""
+    release_first = threading.Event()
+
+    def fetch(descriptor: Dict[str, Any]) -> None:
+        if descriptor["namespace"] == "slow":
+            release_first.wait(timeout=10)
+
+    checkpoint = WatchCheckpoint()
+    pool = FetcherPool(fetch, 2, checkpoint)
+    pool.submit("slow", "1", {"name": "build", "namespace": "slow"})
+    pool.submit("fast", "2", {"name": "build", "namespace": "fast"})
+
+    _wait_for(lambda: checkpoint.get("fast") == "2")
+    assert checkpoint.get("slow") is None
+
+    release_first.set()
+    _wait_for(lambda: checkpoint.get("slow") == "1")
+
+
+def test_failed_fetch_is_done() -> None:
+    """Test a fetch which failed does not hold the checkpoint forever."""
+
+    def fetch(descriptor: Dict[str, Any]) -> None:
+        raise ValueError("Failed to fetch")
+
+    checkpoint = WatchCheckpoint()
+    pool = FetcherPool(fetch, 1, checkpoint)
+    pool.submit("thoth", "1", {"name": "build", "namespace": "thoth"})
+    pool.submit("thoth", "2", bookmark=True)
+
+    _wait_for(lambda: checkpoint.get("thoth") == "2")
+
+
+def test_shutdown_waits_for_fetches() -> None:
+    """Test shutdown waits for fetches handed over, descriptors handed over later are not fetched."""
+    started = threading.Event()
+    fetched: List[str] = []
+
+    def fetch(descriptor: Dict[str, Any]) -> None:
+        started.set()
+        time.sleep(0.2)
+        fetched.append(descriptor["name"])
+
+    checkpoint = WatchCheckpoint()
+    pool = FetcherPool(fetch, 1, checkpoint)
+    pool.submit("thoth", "1", {"name": "first", "namespace": "thoth"})
+    started.wait(timeout=5)
+
+    pool.shutdown()
+    assert fetched == ["first"]
+    assert checkpoint.get("thoth") == "1"
+
+    pool.submit("thoth", "2", {"name": "second", "namespace": "thoth"})
+    assert fetched == ["first"]
+    assert checkpoint.get("thoth") == "1"
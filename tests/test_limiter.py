@@ -0,0 +1,155 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of client side limits of requests to Thoth User API."""
+
+import multiprocessing
+import time
+
+import pytest
+import requests
+
+from thoth.build_watcher import limiter
+from thoth.build_watcher.limiter import AdaptiveLimiter
+from thoth.build_watcher.limiter import TokenBucket
+
+
+class _FakeClock:
+    """A clock which moves only when slept on."""
+
+    def __init__(self) -> None:
+        """Start the clock."""
+        self.now = 0.0
+        self.slept = 0.0
+
+    def monotonic(self) -> float:
+        """Get the current time."""
+        return self.now
+
+    def sleep(self, delay: float) -> None:
+        """Move the clock."""
+        self.now += delay
+        self.slept += delay
+
+
+@pytest.fixture
+def clock(monkeypatch) -> _FakeClock:
+    """Run limits on a fake clock."""
+    fake_clock = _FakeClock()
+    monkeypatch.setattr(limiter, "time", fake_clock)
+    return fake_clock
+
+
+def _acquire(bucket: TokenBucket, count: int) -> None:
+    """Take the given number of tokens."""
+    for _ in range(count):
+        bucket.acquire()
+
+
+def test_shared_bucket_limits_all_processes() -> None:
+    """Test a shared bucket keeps the rate across processes, regardless of their number."""
+    bucket = TokenBucket(20, burst=1, shared=True)
+    processes = [multiprocessing.get_context("fork").Process(target=_acquire, args=(bucket, 5)) for _ in range(4)]
+
+    started = time.monotonic()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert all(process.exitcode == 0 for process in processes)
+    # 20 tokens at 20 per second, the first one is available right away.
+    assert time.monotonic() - started >= 0.9
+
+
+def test_bucket_no_limit(clock: _FakeClock) -> None:
+    """Test a bucket without a rate never waits."""
+    _acquire(TokenBucket(0, burst=1), 100)
+
+    assert clock.slept == 0
+
+
+def test_bucket_burst_and_rate(clock: _FakeClock) -> None:
+    """Test a burst worth of tokens is available at once, further tokens come at the rate."""
+    bucket = TokenBucket(8, burst=4)
+
+    _acquire(bucket, 4)
+    assert clock.slept == 0
+
+    _acquire(bucket, 8)
+    assert clock.slept == 1.0
+
+    # Tokens do not pile up over the burst while idle.
+    clock.now += 60
+    _acquire(bucket, 5)
+    assert clock.slept == 1.125
+
+
+def _request(adaptive: AdaptiveLimiter, clock: _FakeClock, duration: float = 0.0) -> None:
+    """Send a request taking the given number of seconds."""
+    with adaptive.slot():
+        clock.now += duration
+
+
+def test_limit_additive_increase(clock: _FakeClock) -> None:
+    """Test the limit grows by one once a limit worth of requests succeeded, up to the maximum."""
+    adaptive = AdaptiveLimiter(max_limit=4, latency_target=10)
+    assert int(adaptive.limit) == 1
+
+    _request(adaptive, clock)
+    assert adaptive.limit == pytest.approx(2.0)
+
+    _request(adaptive, clock)
+    _request(adaptive, clock)
+    assert adaptive.limit == pytest.approx(2.9)
+
+    for _ in range(20):
+        _request(adaptive, clock)
+    assert adaptive.limit == 4
+
+
+def test_limit_multiplicative_decrease(clock: _FakeClock) -> None:
+    """Test the limit is cut on overload at most once per latency target, but not below the minimum."""
+    adaptive = AdaptiveLimiter(min_limit=2, max_limit=16, latency_target=10)
+    adaptive.limit = 16.0
+
+    _request(adaptive, clock, duration=11)
+    assert adaptive.limit == 8
+
+    # Requests in flight when the backend got overloaded do not cut the limit again.
+    with pytest.raises(requests.exceptions.ConnectionError):
+        with adaptive.slot():
+            raise requests.exceptions.ConnectionError()
+    assert adaptive.limit == 8
+
+    for _ in range(3):
+        clock.now += 10
+        with pytest.raises(requests.exceptions.Timeout):
+            with adaptive.slot():
+                raise requests.exceptions.Timeout()
+    assert adaptive.limit == 2
+
+
+def test_limit_kept_on_permanent_errors(clock: _FakeClock) -> None:
+    """Test errors not caused by an overload do not cut the limit."""
+    adaptive = AdaptiveLimiter(max_limit=16, latency_target=10)
+    adaptive.limit = 8.0
+
+    with pytest.raises(ValueError):
+        with adaptive.slot():
+            raise ValueError("Invalid image")
+
+    assert adaptive.limit == pytest.approx(8.125)
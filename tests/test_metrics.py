@@ -0,0 +1,63 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of metrics aggregated across processes."""
+
+import os
+import subprocess
+import sys
+
+# Metrics are configured on import based on the environment, so each run gets its own interpreter.
+_RUN = """
+import app
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+
+app._clear_multiprocess_metrics()
+from thoth.build_watcher.metrics import METRIC_WORKERS, configure_metrics
+
+configure_metrics("flusher", push_interval=3600)
+METRIC_WORKERS.set({workers})
+registry = CollectorRegistry()
+MultiProcessCollector(registry)
+print(generate_latest(registry).decode())
+"""
+
+
+def _export(directory: str, workers: int) -> str:
+    """Set the workers gauge in a fresh main process and return metrics aggregated from the directory."""
+    environment = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+    return subprocess.run(
+        [sys.executable, "-c", _RUN.format(workers=workers)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=environment,
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stdout
+
+
+def test_main_process_gauge_exported(tmp_path) -> None:
+    """Test gauges set by the main process are exported after the directory is cleared."""
+    assert "build_watcher_workers 3.0" in _export(str(tmp_path), 3)
+
+
+def test_previous_run_values_removed(tmp_path) -> None:
+    """Test values left by a previous run are not aggregated with the current ones."""
+    _export(str(tmp_path), 42)
+    exported = _export(str(tmp_path), 3)
+    assert "build_watcher_workers 3.0" in exported
+    assert "42.0" not in exported
@@ -0,0 +1,83 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of producers watching the cluster."""
+
+import threading
+from typing import Any
+from typing import Dict
+from typing import List
+
+import urllib3
+from kubernetes.client.rest import ApiException
+
+from thoth.build_watcher import producer
+from thoth.build_watcher.checkpoint import WatchCheckpoint
+
+
+class _FakePool:
+    """Record positions handed over, stop the watch once the given number of them was seen."""
+
+    def __init__(self, stop: threading.Event, count: int) -> None:
+        """Stop after count positions."""
+        self.positions: List[Any] = []
+        self._stop = stop
+        self._count = count
+
+    def submit(self, namespace: str, resource_version: str, descriptor: Any = None, *, bookmark: bool = False) -> None:
+        """Record the position."""
+        self.positions.append((namespace, resource_version, bookmark))
+        if len(self.positions) >= self._count:
+            self._stop.set()
+
+
+def _bookmark(resource_version: str) -> Dict[str, Any]:
+    """Create a bookmark event."""
+    metadata = type("Metadata", (), {"resourceVersion": resource_version})
+    return {"type": "BOOKMARK", "object": type("Build", (), {"metadata": metadata})}
+
+
+def test_watch_restarted_on_errors(monkeypatch) -> None:
+    """Test the watch of a namespace is restarted from the checkpoint when it fails with an error other than 410."""
+    errors = [
+        urllib3.exceptions.ProtocolError("Connection broken: InvalidChunkLength"),
+        ApiException(status=500),
+        ConnectionResetError(),
+    ]
+    calls = []
+
+    def watch(v1_build: Any, namespace: str, resource_version: str, **options: Any) -> Any:
+        calls.append(resource_version)
+        if errors:
+            raise errors.pop(0)
+        yield _bookmark(str(len(calls)))
+
+    monkeypatch.setattr(producer, "_watch", watch)
+    monkeypatch.setattr(producer, "_WATCH_RETRY_BACKOFF", 0.01)
+    stop = threading.Event()
+    pool = _FakePool(stop, 1)
+    checkpoint = WatchCheckpoint()
+    checkpoint.set("namespace", "100")
+
+    thread = threading.Thread(
+        target=producer._watch_builds, args=(None, "namespace", checkpoint, None, pool, None, stop), daemon=True
+    )
+    thread.start()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive()
+    assert calls == ["100"] * 4
+    assert pool.positions == [("namespace", "4", True)]
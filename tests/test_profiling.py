@@ -0,0 +1,153 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of profiling of running processes triggered by signals."""
+
+import glob
+import json
+import os
+import re
+import signal
+import threading
+import time
+from typing import Iterator
+from typing import List
+
+import pytest
+
+from thoth.build_watcher import profiling
+from thoth.build_watcher.profiling import CPU_PROFILE_SIGNAL
+from thoth.build_watcher.profiling import MEMORY_PROFILE_SIGNAL
+from thoth.build_watcher.profiling import configure_profiling
+from thoth.build_watcher.profiling import dump_in_flight
+from thoth.build_watcher.profiling import install_profiling_handlers
+from thoth.build_watcher.profiling import track_in_flight
+
+
+@pytest.fixture
+def profile_dir(tmp_path) -> Iterator[str]:
+    """Configure profiling into a temporary directory, signal handlers are restored afterwards."""
+    handlers = {signum: signal.getsignal(signum) for signum in (CPU_PROFILE_SIGNAL, MEMORY_PROFILE_SIGNAL)}
+    directory = str(tmp_path / "profiles")
+    configure_profiling(directory, window=0.2)
+    yield directory
+    configure_profiling(None)
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def _wait_for_file(pattern: str, timeout: float = 5.0) -> str:
+    """Wait until exactly one file matching the given pattern is written, profiles are taken in background."""
+    deadline = time.monotonic() + timeout
+    while True:
+        paths = glob.glob(pattern)
+        if paths and not any(thread.name.endswith("-profiler") for thread in threading.enumerate()):
+            assert len(paths) == 1
+            return paths[0]
+
+        assert time.monotonic() < deadline, f"No file matching {pattern!r} written in time"
+        time.sleep(0.02)
+
+
+def _busy(stop: threading.Event) -> None:
+    """Keep a thread busy until stopped."""
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profile_dir_created(profile_dir: str) -> None:
+    """Test the profile directory is created once profiling is configured."""
+    assert os.path.isdir(profile_dir)
+    assert profiling.profiling_enabled()
+
+
+def test_dump_in_flight(profile_dir: str) -> None:
+    """Test items being processed are dumped ordered by their start, items done are not listed."""
+    with track_in_flight("log_fetch", build_name="app-1", namespace="thoth"):
+        with track_in_flight("submission", build_name="app-2"):
+            pass
+        with track_in_flight("submission", build_name="app-3"):
+            path = dump_in_flight()
+
+    assert os.path.dirname(path) == profile_dir
+    assert re.fullmatch(rf"inflight-MainProcess-{os.getpid()}-\d{{8}}T\d{{6}}\.\d{{3}}\.json", os.path.basename(path))
+    with open(path) as dump_file:
+        items = json.load(dump_file)
+
+    assert [(item["kind"], item["build_name"]) for item in items] == [("log_fetch", "app-1"), ("submission", "app-3")]
+    assert items[0]["namespace"] == "thoth"
+    assert all(item["thread"] == "MainThread" and item["age"] >= 0 for item in items)
+    assert not profiling._IN_FLIGHT
+
+
+def test_no_handlers_if_not_configured() -> None:
+    """Test signal handlers are not installed if profiling is not configured."""
+    handler = signal.getsignal(CPU_PROFILE_SIGNAL)
+    install_profiling_handlers()
+    assert signal.getsignal(CPU_PROFILE_SIGNAL) is handler
+
+
+def test_cpu_profile_on_signal(profile_dir: str) -> None:
+    """Test SIGUSR1 dumps items in flight and writes stacks of all the threads sampled, the signal is forwarded."""
+    forwarded: List[int] = []
+    install_profiling_handlers(forward=forwarded.append)
+    stop = threading.Event()
+    thread = threading.Thread(target=_busy, args=(stop,), name="busy")
+    thread.start()
+    try:
+        with track_in_flight("submission", build_name="app-1"):
+            os.kill(os.getpid(), CPU_PROFILE_SIGNAL)
+            path = _wait_for_file(os.path.join(profile_dir, "cpu-*.collapsed"))
+    finally:
+        stop.set()
+        thread.join()
+
+    assert forwarded == [CPU_PROFILE_SIGNAL]
+    with open(path) as profile_file:
+        lines = profile_file.read().splitlines()
+
+    assert lines
+    assert all(re.fullmatch(r".+ \d+", line) for line in lines)
+    assert any(line.startswith("busy;") and "_busy (test_profiling.py:" in line for line in lines)
+
+    with open(_wait_for_file(os.path.join(profile_dir, "inflight-*.json"))) as dump_file:
+        assert [item["build_name"] for item in json.load(dump_file)] == ["app-1"]
+    assert not glob.glob(os.path.join(profile_dir, "memory-*"))
+
+
+def test_memory_profile_on_signal(profile_dir: str) -> None:
+    """Test SIGUSR2 writes the top allocators traced."""
+    install_profiling_handlers()
+    os.kill(os.getpid(), MEMORY_PROFILE_SIGNAL)
+    path = _wait_for_file(os.path.join(profile_dir, "memory-*.txt"))
+
+    with open(path) as profile_file:
+        content = profile_file.read()
+
+    assert content.startswith(f"Top {profiling._TOP_ALLOCATIONS} allocations by line:\n")
+    assert "\nTop 10 allocations by traceback:\n" in content
+    assert glob.glob(os.path.join(profile_dir, "inflight-*.json"))
+    assert not glob.glob(os.path.join(profile_dir, "cpu-*"))
+
+
+def test_one_profile_at_a_time(profile_dir: str) -> None:
+    """Test a request for a profile of a kind already being taken is ignored."""
+    install_profiling_handlers()
+    os.kill(os.getpid(), CPU_PROFILE_SIGNAL)
+    os.kill(os.getpid(), CPU_PROFILE_SIGNAL)
+
+    _wait_for_file(os.path.join(profile_dir, "cpu-*.collapsed"))
@@ -0,0 +1,133 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of memoization and coalescing of image pushes."""
+
+import asyncio
+import fcntl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+import pytest
+
+from thoth.build_watcher import pushcache
+from thoth.build_watcher.pushcache import PushCache
+
+_KEY = PushCache.key("quay.io/thoth/base:latest", "sha256:1234", "registry.example.com/thoth")
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_push_single_flight_threads(tmp_path, shared: bool) -> None:
+    """Test concurrent pushes of the same image by threads of one process copy the image once."""
+    cache = PushCache(path=str(tmp_path / "cache.db") if shared else None)
+    pushes = []
+    started = threading.Event()
+
+    def push() -> Optional[str]:
+        pushes.append(threading.current_thread().name)
+        started.set()
+        time.sleep(0.2)
+        return "registry.example.com/thoth/base:latest"
+
+    def pusher() -> Optional[str]:
+        return cache.push(_KEY, push)
+
+    with ThreadPoolExecutor(4) as executor:
+        first = executor.submit(pusher)
+        started.wait()
+        results = [first] + [executor.submit(pusher) for _ in range(3)]
+
+    assert [result.result() for result in results] == ["registry.example.com/thoth/base:latest"] * 4
+    assert len(pushes) == 1
+    # Pushed images are served from the cache afterwards.
+    assert cache.push(_KEY, push) == "registry.example.com/thoth/base:latest"
+    assert len(pushes) == 1
+
+
+def test_push_failed_threads() -> None:
+    """Test a failed push is reported to waiting threads as an image which cannot be pushed and is retried later."""
+    cache = PushCache()
+    started = threading.Event()
+
+    def push() -> Optional[str]:
+        started.set()
+        time.sleep(0.2)
+        raise RuntimeError("copy failed")
+
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(cache.push, _KEY, push)
+        started.wait()
+        second = executor.submit(cache.push, _KEY, push)
+
+    with pytest.raises(RuntimeError):
+        first.result()
+    assert second.result() is None
+    assert (
+        cache.push(_KEY, lambda: "registry.example.com/thoth/base:latest") == "registry.example.com/thoth/base:latest"
+    )
+
+
+def test_push_single_flight_async() -> None:
+    """Test concurrent pushes of the same image on an event loop copy the image once."""
+    cache = PushCache()
+    pushes = []
+
+    async def push() -> Optional[str]:
+        pushes.append(1)
+        await asyncio.sleep(0.1)
+        return "registry.example.com/thoth/base:latest"
+
+    async def main() -> list:
+        return await asyncio.gather(*(cache.push_async(_KEY, push) for _ in range(4)))
+
+    assert asyncio.run(main()) == ["registry.example.com/thoth/base:latest"] * 4
+    assert len(pushes) == 1
+
+
+def test_push_async_blocking_calls_off_loop(tmp_path, monkeypatch) -> None:
+    """Test lookups in the cache database and file locks are not done on the event loop."""
+    cache = PushCache(path=str(tmp_path / "cache.db"))
+    calls = []
+
+    def on_thread(name: str, function: Callable[..., Any]) -> Callable[..., Any]:
+        def wrapper(*args: Any) -> Any:
+            calls.append((name, threading.current_thread() is threading.main_thread()))
+            return function(*args)
+
+        return wrapper
+
+    monkeypatch.setattr(cache._cache, "get", on_thread("get", cache._cache.get))
+    monkeypatch.setattr(cache._cache, "set", on_thread("set", cache._cache.set))
+    monkeypatch.setattr(
+        pushcache,
+        "fcntl",
+        SimpleNamespace(flock=on_thread("flock", fcntl.flock), LOCK_EX=fcntl.LOCK_EX, LOCK_UN=fcntl.LOCK_UN),
+    )
+
+    async def push() -> Optional[str]:
+        return "registry.example.com/thoth/base:latest"
+
+    assert asyncio.run(cache.push_async(_KEY, push)) == "registry.example.com/thoth/base:latest"
+    assert calls == [("get", False), ("flock", False), ("get", False), ("set", False), ("flock", False)]
+
+    calls.clear()
+    assert asyncio.run(cache.push_async(_KEY, push)) == "registry.example.com/thoth/base:latest"
+    assert calls == [("get", False)]
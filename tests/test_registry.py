@@ -0,0 +1,151 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of bearer token handling of the native registry client."""
+
+import io
+from typing import Any
+from typing import List
+from typing import Optional
+from typing import Set
+
+import requests
+
+from thoth.build_watcher import registry
+from thoth.build_watcher.registry import ImageCopy
+from thoth.build_watcher.registry import RegistryClient
+
+_CHALLENGE = 'Bearer realm="https://auth.example.com/token",service="registry.example.com"'
+_BLOB = b"layer content"
+_DIGEST = "sha256:1234"
+
+
+def _response(status_code: int, content: bytes = b"", headers: Optional[dict] = None) -> requests.Response:
+    """Construct a response returned by the fake session."""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.raw = io.BytesIO(content)
+    response.headers.update(headers or {})
+    return response
+
+
+class _FakeSession:
+    """A registry and its token service, tokens stay valid until they are revoked."""
+
+    def __init__(self, expires_in: int = 300) -> None:
+        """Set up the fake registry."""
+        self.expires_in = expires_in
+        self.issued = 0
+        self.valid: Set[str] = set()
+        self.uploads: List[bytes] = []
+        self.rejected_puts = 0
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        """Issue a new token."""
+        self.issued += 1
+        self.valid.add(f"t{self.issued}")
+        return _response(200, f'{{"token": "t{self.issued}", "expires_in": {self.expires_in}}}'.encode())
+
+    def request(self, method: str, url: str, headers: dict, data: Any = None, **kwargs: Any) -> requests.Response:
+        """Serve a request of the registry API."""
+        if headers.get("Authorization", "").replace("Bearer ", "") not in self.valid:
+            if method == "PUT":
+                self.rejected_puts += 1
+                if data is not None and hasattr(data, "read"):
+                    data.read()
+            return _response(401, headers={"WWW-Authenticate": _CHALLENGE})
+
+        if method == "GET":
+            return _response(200, _BLOB)
+        if method == "PUT":
+            self.uploads.append(data.read() if hasattr(data, "read") else data)
+            return _response(201)
+
+        return _response(404)
+
+
+def _client(session: _FakeSession) -> RegistryClient:
+    """Create a client talking to the fake session."""
+    client = RegistryClient("registry.example.com")
+    client._session = session
+    return client
+
+
+def test_token_reused() -> None:
+    """Test a valid token is negotiated once and reused."""
+    session = _FakeSession()
+    client = _client(session)
+
+    for _ in range(3):
+        assert client.request("GET", "thoth/blobs/sha256:1234", ["repository:thoth:pull"]).status_code == 200
+    assert session.issued == 1
+
+
+def test_token_refreshed_before_expiry(monkeypatch) -> None:
+    """Test a token about to expire is refreshed before it is used rather than after the registry rejects it."""
+    now = [1000.0]
+    monkeypatch.setattr(registry.time, "monotonic", lambda: now[0])
+    session = _FakeSession(expires_in=60)
+    client = _client(session)
+
+    assert client.request("GET", "thoth/blobs/sha256:1234", ["repository:thoth:pull"]).status_code == 200
+    assert session.issued == 1
+
+    now[0] += 55
+    # The registry would still accept the token, but it is refreshed ahead of its expiry.
+    assert client.request("GET", "thoth/blobs/sha256:1234", ["repository:thoth:pull"]).status_code == 200
+    assert session.issued == 2
+
+
+def test_streamed_body_not_replayed() -> None:
+    """Test a rejected request with a streamed body is not retried with the consumed stream."""
+    session = _FakeSession()
+    client = _client(session)
+
+    response = client.request("PUT", "thoth/blobs/uploads/1", ["repository:thoth:pull,push"], data=io.BytesIO(_BLOB))
+
+    assert response.status_code == 401
+    assert session.uploads == []
+    # A new token was obtained for the retry done by the caller.
+    assert client._tokens["repository:thoth:pull,push"][0] == f"t{session.issued}"
+
+
+def test_blob_upload_retried_with_fresh_stream() -> None:
+    """Test a blob upload rejected because the token was revoked downloads the blob again for the retry."""
+    session = _FakeSession()
+    original_request = session.request
+
+    def request(method: str, url: str, headers: dict, data: Any = None, **kwargs: Any) -> requests.Response:
+        if method == "HEAD":
+            return _response(404)
+        if method == "PUT" and not session.rejected_puts:
+            # Tokens expire while the blob is being downloaded.
+            session.valid.clear()
+        if method == "POST":
+            response = original_request(method, url, headers, data, **kwargs)
+            if response.status_code == 401:
+                return response
+            return _response(202, headers={"Location": "https://registry.example.com/v2/thoth/app/blobs/uploads/1"})
+        return original_request(method, url, headers, data, **kwargs)
+
+    session.request = request
+    image_copy = ImageCopy(_client(session), _client(session), "thoth/base", "thoth/app")
+    image_copy._copy_blob({"digest": _DIGEST, "size": len(_BLOB)})
+
+    assert session.rejected_puts == 1
+    assert session.uploads == [_BLOB]
+    assert image_copy.uploaded == 1
@@ -0,0 +1,106 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of recording a trace and replaying it by benchmarks."""
+
+import os
+import queue
+import sys
+import time
+from types import SimpleNamespace
+from typing import Iterator
+
+import pytest
+
+from thoth.build_watcher import recorder
+from thoth.build_watcher.recorder import configure_recording
+from thoth.build_watcher.recorder import record
+from thoth.build_watcher.tracing import observe
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from fakes import TraceBuildResource  # noqa: E402
+from fakes import build_name  # noqa: E402
+from replay import _recorded_durations  # noqa: E402
+from replay import load_trace  # noqa: E402
+
+# Builds recorded: offset from the first build, name, namespace, whether an image was produced, analysis duration.
+_BUILDS = [
+    (0.0, "app-1", "thoth", True, 0.5),
+    (0.2, "app-2", "other", True, 1.25),
+    (0.3, "app-1", "thoth", False, None),
+    (0.7, "app-3", "thoth", True, 0.75),
+]
+
+
+@pytest.fixture
+def trace_path(tmp_path) -> Iterator[str]:
+    """Record into a trace in a temporary directory."""
+    path = str(tmp_path / "trace.jsonl")
+    configure_recording(path)
+    yield path
+    configure_recording(None)
+
+
+def _record_builds(monkeypatch) -> None:
+    """Record builds and their stage timings at their offsets from the recording start."""
+    start = 1600000000.0
+    for offset, name, namespace, output, analysis in _BUILDS:
+        monkeypatch.setattr(recorder, "time", SimpleNamespace(time=lambda: start + offset))
+        record("build", name=name, namespace=namespace, output=output, base=True, log_size=1024)
+        observe("push", 0.1, name)
+        if analysis is not None:
+            observe("analysis", analysis, name)
+
+
+def test_record_and_load(trace_path: str, monkeypatch) -> None:
+    """Test builds and stage timings recorded are loaded in the recorded order with their offsets."""
+    _record_builds(monkeypatch)
+    # Lines appended by concurrent processes are not necessarily ordered, a torn line is skipped.
+    with open(trace_path, "a") as trace_file:
+        trace_file.write('{"t": 1599999999.9, "kind": "build", "name": "app-0", "namespace": "thoth", "output": true, ')
+        trace_file.write('"base": false, "log_size": 0}\n{"t": 16000\n')
+
+    builds, stages = load_trace(trace_path)
+
+    assert [build["name"] for build in builds] == ["app-0"] + [build[1] for build in _BUILDS]
+    assert [build["offset"] for build in builds] == pytest.approx([0.0] + [build[0] + 0.1 for build in _BUILDS])
+    assert _recorded_durations(builds, stages, "analysis") == {1: 0.5, 2: 1.25, 4: 0.75}
+    assert _recorded_durations(builds, stages, "push") == {1: 0.1, 2: 0.1, 3: 0.1, 4: 0.1}
+
+
+def test_replay_pace(trace_path: str, monkeypatch) -> None:
+    """Test builds of a recorded trace are replayed in the recorded order and at the recorded pace."""
+    _record_builds(monkeypatch)
+    builds, _ = load_trace(trace_path)
+
+    results: queue.Queue = queue.Queue()
+    resource = TraceBuildResource(results, builds, speed=2.0)
+    assert resource.namespaces == ["other", "thoth"]
+
+    events = resource.watch()
+    started = time.time()
+    replayed = [next(events) for _ in builds]
+
+    assert [event["object"].metadata.name for event in replayed] == [build_name(index) for index in range(4)]
+    assert [event["object"].metadata.namespace for event in replayed] == [build[2] for build in _BUILDS]
+    assert [event["object"].status.phase for event in replayed] == ["Complete", "Complete", "Failed", "Complete"]
+
+    emitted = [results.get_nowait() for _ in builds]
+    assert [index for _, index, _ in emitted] == [0, 1, 2, 3]
+    offsets = [at - started for _, _, at in emitted]
+    assert offsets == pytest.approx([build[0] / 2.0 for build in _BUILDS], abs=0.05)
@@ -0,0 +1,292 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of splitting builds across replicas."""
+
+import copy
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from types import SimpleNamespace
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from kubernetes.client.rest import ApiException
+from openshift.dynamic.exceptions import ConflictError
+from openshift.dynamic.exceptions import NotFoundError
+from openshift.dynamic.resource import ResourceInstance
+
+from thoth.build_watcher.sharding import SHARD_CLAIM_ANNOTATION
+from thoth.build_watcher.sharding import HashRing
+from thoth.build_watcher.sharding import LeaseMembership
+from thoth.build_watcher.sharding import ShardCoordinator
+
+_KEYS = [f"namespace/{index}" for index in range(3000)]
+
+
+def test_ring_empty() -> None:
+    """Test no key has an owner if there are no members."""
+    assert HashRing([]).owner("namespace/uid") is None
+
+
+def test_ring_distribution() -> None:
+    """Test keys are spread evenly across members and the owner of a key does not depend on the order of members."""
+    ring = HashRing(["a", "b", "c"])
+    owners = Counter(ring.owner(key) for key in _KEYS)
+
+    assert set(owners) == {"a", "b", "c"}
+    assert all(0.25 < count / len(_KEYS) < 0.42 for count in owners.values())
+    assert all(ring.owner(key) == HashRing(["c", "a", "b"]).owner(key) for key in _KEYS[:100])
+
+
+def test_ring_member_joins() -> None:
+    """Test only keys taken by a joining member change their owner."""
+    ring = HashRing(["a", "b", "c"])
+    grown = HashRing(["a", "b", "c", "d"])
+    moved = [key for key in _KEYS if ring.owner(key) != grown.owner(key)]
+
+    assert {grown.owner(key) for key in moved} == {"d"}
+    assert 0.15 < len(moved) / len(_KEYS) < 0.35
+
+
+def test_ring_member_leaves() -> None:
+    """Test only keys of a leaving member change their owner, they are spread across the remaining members."""
+    ring = HashRing(["a", "b", "c", "d"])
+    shrunk = HashRing(["a", "b", "c"])
+    moved = [key for key in _KEYS if ring.owner(key) != shrunk.owner(key)]
+
+    assert {ring.owner(key) for key in moved} == {"d"}
+    assert {shrunk.owner(key) for key in moved} == {"a", "b", "c"}
+
+
+class _FakeResource:
+    """Objects of one kind stored in memory, keyed by namespace and name, patched using merge patches."""
+
+    def __init__(self, kind: str) -> None:
+        """Start with no objects."""
+        self.kind = kind
+        self.objects: Dict[tuple, Dict[str, Any]] = {}
+        self._resource_version = 0
+        # Called before a patch is applied, e.g. to simulate a concurrent update.
+        self.before_patch: Optional[Callable[[], None]] = None
+
+    def store(self, namespace: str, body: Dict[str, Any]) -> None:
+        """Store the given object with a new resourceVersion."""
+        self._resource_version += 1
+        body = copy.deepcopy(body)
+        body.setdefault("apiVersion", "v1")
+        body.setdefault("kind", self.kind)
+        body["metadata"]["resourceVersion"] = str(self._resource_version)
+        self.objects[(namespace, body["metadata"]["name"])] = body
+
+    def get(self, name: Optional[str] = None, namespace: Optional[str] = None, label_selector: str = "") -> Any:
+        """Get one object or list objects with the given label."""
+        if name:
+            if (namespace, name) not in self.objects:
+                raise NotFoundError(ApiException(status=404))
+            return ResourceInstance(None, copy.deepcopy(self.objects[(namespace, name)]))
+
+        key, _, value = label_selector.partition("=")
+        items = [
+            copy.deepcopy(item)
+            for (item_namespace, _), item in self.objects.items()
+            if item_namespace == namespace and (item["metadata"].get("labels") or {}).get(key) == value
+        ]
+        return ResourceInstance(None, {"apiVersion": "v1", "kind": f"{self.kind}List", "items": items})
+
+    def create(self, body: Dict[str, Any], namespace: str) -> None:
+        """Create an object."""
+        self.store(namespace, body)
+
+    def patch(self, body: Dict[str, Any], namespace: str, content_type: str) -> None:
+        """Merge patch an object, conditioned on its resourceVersion if given."""
+        assert content_type == "application/merge-patch+json"
+        if self.before_patch:
+            self.before_patch()
+
+        key = (namespace, body["metadata"]["name"])
+        if key not in self.objects:
+            raise NotFoundError(ApiException(status=404))
+
+        current = copy.deepcopy(self.objects[key])
+        expected = body["metadata"].get("resourceVersion")
+        if expected and expected != current["metadata"]["resourceVersion"]:
+            raise ConflictError(ApiException(status=409))
+
+        for field, value in body.items():
+            if isinstance(value, dict):
+                for nested, nested_value in value.items():
+                    if isinstance(nested_value, dict):
+                        current[field].setdefault(nested, {}).update(nested_value)
+                    elif nested != "resourceVersion":
+                        current.setdefault(field, {})[nested] = nested_value
+            else:
+                current[field] = value
+        self.store(namespace, current)
+
+    def delete(self, name: str, namespace: str) -> None:
+        """Delete an object."""
+        if self.objects.pop((namespace, name), None) is None:
+            raise NotFoundError(ApiException(status=404))
+
+
+class _FakeCluster:
+    """A cluster with Leases and Builds, shaped as the OpenShift dynamic client."""
+
+    def __init__(self) -> None:
+        """Create the cluster with a build."""
+        self.leases = _FakeResource("Lease")
+        self.builds = _FakeResource("Build")
+        self.builds.store("thoth", {"metadata": {"name": "build-1", "namespace": "thoth", "uid": "uid-1"}})
+        resources = {"Lease": self.leases, "Build": self.builds}
+        self.ocp_client = SimpleNamespace(
+            resources=SimpleNamespace(get=lambda api_version, kind: resources[kind]),
+        )
+
+
+_BUILD = {"name": "build-1", "namespace": "thoth", "build_uid": "uid-1", "claimed_by": None}
+
+
+def _membership(cluster: _FakeCluster, identity: str, lease_duration: float = 30) -> LeaseMembership:
+    """Create a lease membership of the given replica."""
+    return LeaseMembership(cluster, "thoth", identity, lease_duration=lease_duration)
+
+
+def test_lease_members() -> None:
+    """Test members are replicas renewing their Leases, expired Leases and other groups are not members."""
+    cluster = _FakeCluster()
+    first = _membership(cluster, "first")
+    first.renew()
+    first.renew()
+    _membership(cluster, "second").renew()
+    LeaseMembership(cluster, "thoth", "other", group="other").renew()
+    expired = _membership(cluster, "expired")
+    expired.renew()
+    lease = cluster.leases.objects[("thoth", "build-watcher-expired")]
+    renewed = datetime.now(timezone.utc) - timedelta(seconds=31)
+    lease["spec"]["renewTime"] = renewed.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    assert sorted(first.members()) == ["first", "second"]
+
+    first.leave()
+    first.leave()
+    assert first.members() == ["second"]
+
+
+def test_claim_once() -> None:
+    """Test a build is claimed by the first replica only, claims are kept as an annotation of the build."""
+    cluster = _FakeCluster()
+    first, second = _membership(cluster, "first"), _membership(cluster, "second")
+
+    assert first.claim(dict(_BUILD))
+    assert first.claim(dict(_BUILD))
+    assert not second.claim(dict(_BUILD))
+    annotations = cluster.builds.objects[("thoth", "build-1")]["metadata"]["annotations"]
+    assert annotations == {SHARD_CLAIM_ANNOTATION: "first"}
+
+
+def test_claim_conflict() -> None:
+    """Test a replica losing a race for a claim does not handle the build."""
+    cluster = _FakeCluster()
+    first, second = _membership(cluster, "first"), _membership(cluster, "second")
+
+    def claim_concurrently() -> None:
+        cluster.builds.before_patch = None
+        assert second.claim(dict(_BUILD))
+
+    cluster.builds.before_patch = claim_concurrently
+
+    assert not first.claim(dict(_BUILD))
+    annotations = cluster.builds.objects[("thoth", "build-1")]["metadata"]["annotations"]
+    assert annotations == {SHARD_CLAIM_ANNOTATION: "second"}
+
+
+def test_claim_retried_on_unrelated_update() -> None:
+    """Test a claim conflicting with an update not claiming the build is retried."""
+    cluster = _FakeCluster()
+    first = _membership(cluster, "first")
+
+    def update() -> None:
+        cluster.builds.before_patch = None
+        build = cluster.builds.objects[("thoth", "build-1")]
+        cluster.builds.store("thoth", dict(build, status={"phase": "Complete"}))
+
+    cluster.builds.before_patch = update
+
+    assert first.claim(dict(_BUILD))
+    assert cluster.builds.objects[("thoth", "build-1")]["metadata"]["annotations"][SHARD_CLAIM_ANNOTATION] == "first"
+
+
+def _descriptors(count: int) -> List[Dict[str, Any]]:
+    """Create build descriptors."""
+    return [dict(_BUILD, name=f"build-{index}", build_uid=f"uid-{index}") for index in range(count)]
+
+
+def test_coordinator_adopts_builds_of_expired_member() -> None:
+    """Test builds deferred to a replica whose Lease expired before it claimed them are adopted by their new owner."""
+    cluster = _FakeCluster()
+    _membership(cluster, "second").renew()
+    adopted: List[Dict[str, Any]] = []
+    coordinator = ShardCoordinator(_membership(cluster, "first", lease_duration=3600), adopted.append)
+
+    descriptors = _descriptors(50)
+    accepted = [descriptor for descriptor in descriptors if coordinator.accept(descriptor)]
+    deferred = [descriptor for descriptor in descriptors if descriptor not in accepted]
+    assert accepted and deferred
+
+    # Builds claimed by the other replica are not adopted.
+    claimed = dict(deferred[0], claimed_by="second")
+    assert not coordinator.accept(claimed)
+
+    coordinator._rebalance()
+    assert adopted == []
+
+    lease = cluster.leases.objects[("thoth", "build-watcher-second")]
+    lease["spec"]["renewTime"] = (datetime.now(timezone.utc) - timedelta(seconds=31)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    coordinator._rebalance()
+
+    assert adopted == deferred[1:]
+    # Builds are adopted once.
+    coordinator._rebalance()
+    assert adopted == deferred[1:]
+    assert all(coordinator.accept(descriptor) for descriptor in descriptors[1:])
+
+
+def test_coordinator_forgets_after_grace_period() -> None:
+    """Test builds deferred to another replica are not adopted once the grace period passed."""
+    cluster = _FakeCluster()
+    _membership(cluster, "second").renew()
+    adopted: List[Dict[str, Any]] = []
+    coordinator = ShardCoordinator(_membership(cluster, "first", lease_duration=3600), adopted.append, grace_period=-1)
+    assert not all(coordinator.accept(descriptor) for descriptor in _descriptors(50))
+
+    cluster.leases.delete("build-watcher-second", "thoth")
+    coordinator._rebalance()
+
+    assert adopted == []
+
+
+def test_coordinator_claim_errors() -> None:
+    """Test a build which cannot be claimed is not handled."""
+    cluster = _FakeCluster()
+    coordinator = ShardCoordinator(_membership(cluster, "first", lease_duration=3600), lambda _: None)
+
+    assert not coordinator.claim(dict(_BUILD, name="missing"))
+    assert coordinator.claim(dict(_BUILD))
@@ -0,0 +1,351 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of submissions of artifacts for analysis."""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import pytest
+
+from thoth.build_watcher import submitter
+from thoth.build_watcher.cache import TTLCache
+from thoth.build_watcher.limiter import AdaptiveLimiter
+from thoth.build_watcher.metrics import prometheus_registry
+from thoth.build_watcher.pushcache import PushCache
+from thoth.build_watcher.submitter import prepare_submission
+from thoth.build_watcher.submitter import record_submission
+
+_OUTPUT = "registry.example.com/thoth/app@sha256:1111"
+_BASE = "quay.io/thoth/base@sha256:2222"
+_BUILD_LOG = "Collecting flask==1.1.2\nSuccessfully installed flask-1.1.2\n"
+
+
+def _reference(build_uid: str = "uid-1", build_log: str = _BUILD_LOG) -> Dict[str, Any]:
+    """Create a reference to a finished build as sent by the producer."""
+    return {
+        "name": "app-1",
+        "namespace": "thoth",
+        "build_uid": build_uid,
+        "output_reference": _OUTPUT,
+        "base_input_reference": _BASE,
+        "build_log_reference": {"log": build_log},
+    }
+
+
+def _response(
+    output_id: Optional[str] = "output-1", base_id: Optional[str] = "base-1", document_id: Optional[str] = "log-1"
+) -> SimpleNamespace:
+    """Create a response of the analysis endpoint."""
+    return SimpleNamespace(
+        output_image_analysis=SimpleNamespace(analysis_id=output_id) if output_id else None,
+        base_image_analysis=SimpleNamespace(analysis_id=base_id) if base_id else None,
+        buildlog_document_id=document_id,
+    )
+
+
+def test_dedup_by_image_digest(tmp_path) -> None:
+    """Test images are keyed by their digests and are not submitted again once recorded."""
+    cache = TTLCache(path=str(tmp_path / "cache.db"))
+    submission = prepare_submission(_reference(), cache)
+    assert submission["output_key"] == "image:sha256:1111"
+    assert submission["base_key"] == "image:sha256:2222"
+    assert submission["build_log_key"] == "buildlog:uid-1"
+    record_submission(cache, submission, _response())
+
+    assert cache.get("image:sha256:1111") == "output-1"
+    assert cache.get("image:sha256:2222") == "base-1"
+    assert cache.get("buildlog:uid-1") == "log-1"
+
+    # Another build producing the same images, its build log is different.
+    submission = prepare_submission(_reference("uid-2", "Collecting requests\n"), cache)
+    assert submission["output"] is None
+    assert submission["base"] is None
+    assert submission["output_key"] is None
+    assert submission["base_key"] is None
+    assert submission["build_log"]["log"] == "Collecting requests\n"
+    assert submission["build_log_key"] == "buildlog:uid-2"
+
+
+def test_dedup_survives_restart(tmp_path) -> None:
+    """Test entries are read back from the database by a new cache instance."""
+    path = str(tmp_path / "cache.db")
+    cache = TTLCache(path=path)
+    record_submission(cache, prepare_submission(_reference(), cache), _response())
+
+    assert prepare_submission(_reference(), TTLCache(path=path)) is None
+
+
+def test_dedup_build_log_by_build(tmp_path) -> None:
+    """Test the build log of the same build is not submitted again."""
+    cache = TTLCache(path=str(tmp_path / "cache.db"))
+    cache.set("buildlog:uid-1", "log-1")
+
+    submission = prepare_submission(_reference(build_log="changed\n"), cache)
+    assert submission["build_log"] is None
+    assert submission["build_log_key"] is None
+    assert submission["build_log_content_key"] is None
+    assert submission["output"] == _OUTPUT
+    assert submission["base"] == _BASE
+
+
+def test_dedup_build_log_by_content(tmp_path) -> None:
+    """Test build logs of different builds differing only in volatile parts are submitted once."""
+    cache = TTLCache(path=str(tmp_path / "cache.db"))
+    build_log = "2021-03-04T10:11:12Z Running in pod app-1-build\nCollecting flask==1.1.2\n"
+    submission = prepare_submission(_reference(build_log=build_log), cache)
+    assert submission["build_log_content_key"].startswith("buildlog-content:")
+    record_submission(cache, submission, _response())
+
+    build_log = "2021-03-05T08:00:01Z Running in pod app-2-build\nCollecting flask==1.1.2\n"
+    assert prepare_submission(_reference("uid-2", build_log), cache) is None
+
+    build_log = "2021-03-05T08:00:01Z Running in pod app-2-build\nCollecting flask==2.0.0\n"
+    submission = prepare_submission(_reference("uid-3", build_log), cache)
+    assert submission["build_log"]["log"] == build_log
+    assert submission["build_log_key"] == "buildlog:uid-3"
+
+
+def test_dedup_force(tmp_path) -> None:
+    """Test force submits all the inputs even if they were recorded."""
+    cache = TTLCache(path=str(tmp_path / "cache.db"))
+    record_submission(cache, prepare_submission(_reference(), cache), _response())
+
+    submission = prepare_submission(_reference(), cache, force=True)
+    assert submission["output"] == _OUTPUT
+    assert submission["base"] == _BASE
+    assert submission["build_log"]["log"] == _BUILD_LOG
+    assert submission["output_key"] == "image:sha256:1111"
+    assert submission["build_log_key"] == "buildlog:uid-1"
+
+
+def test_no_record_without_analysis(tmp_path) -> None:
+    """Test inputs are not recorded if the analysis of them was not scheduled."""
+    cache = TTLCache(path=str(tmp_path / "cache.db"))
+    submission = prepare_submission(_reference(), cache)
+    record_submission(cache, submission, _response(output_id=None, base_id=None, document_id=None))
+
+    assert "image:sha256:1111" not in cache
+    assert "image:sha256:2222" not in cache
+    assert "buildlog:uid-1" not in cache
+
+    submission = prepare_submission(_reference(), cache)
+    assert submission["output"] == _OUTPUT
+    assert submission["base"] == _BASE
+    assert submission["build_log"]["log"] == _BUILD_LOG
+
+
+def test_no_dedup_without_cache() -> None:
+    """Test all the inputs are submitted if no cache is configured."""
+    record_submission(None, prepare_submission(_reference()), _response())
+    submission = prepare_submission(_reference())
+    assert submission["output"] == _OUTPUT
+    assert submission["build_log"]["log"] == _BUILD_LOG
+
+
+class _FakeBuildAnalysis:
+    """Thoth User API endpoint for build analysis, tracking the number of concurrent requests."""
+
+    def __init__(self) -> None:
+        """Create the endpoint."""
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+
+    def __wrapped__(self, api_client: Any, **parameters: Any) -> SimpleNamespace:
+        """Handle one request."""
+        with self.lock:
+            self.in_flight += 1
+            self.requests += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        return SimpleNamespace(
+            output_image_analysis=SimpleNamespace(analysis_id="output"),
+            base_image_analysis=None,
+            buildlog_analysis=None,
+            buildlog_document_id=None,
+        )
+
+
+@pytest.mark.parametrize(
+    "batch_size,api_max_concurrency,max_limit",
+    [(1, 16, 1), (4, 16, 4), (4, 2, 2)],
+)
+def test_process_mode_concurrency_limit(monkeypatch, batch_size: int, api_max_concurrency: int, max_limit: int) -> None:
+    """Test the concurrency of requests of a worker in the process mode adapts up to the batch size."""
+    build_analysis = _FakeBuildAnalysis()
+    limiters: List[AdaptiveLimiter] = []
+    monkeypatch.setattr(submitter, "build_analysis", build_analysis)
+    monkeypatch.setattr(submitter, "thoth_api_client", lambda: None)
+    monkeypatch.setattr(
+        submitter, "AdaptiveLimiter", lambda **kwargs: limiters.append(AdaptiveLimiter(**kwargs)) or limiters[-1]
+    )
+
+    work_queue: queue.Queue = queue.Queue()
+    for index in range(40):
+        work_queue.put(f"registry.example.com/thoth/app@sha256:{index}")
+    stop = threading.Event()
+    stop.set()
+
+    submitter.submitter(
+        work_queue,
+        None,
+        None,
+        dedup_cache_size=0,
+        push_cache_size=0,
+        api_max_concurrency=api_max_concurrency,
+        batch_size=batch_size,
+        batch_wait=0.1,
+        stop=stop,
+    )
+
+    assert build_analysis.requests == 40
+    assert limiters[0].max_limit == max_limit
+    assert limiters[0].limit == max_limit
+    assert build_analysis.max_in_flight == max_limit
+
+
+def _options(**kwargs: Any) -> Dict[str, Any]:
+    """Create options of submissions without pushes and limits."""
+    options = dict(
+        push_registry=None,
+        environment_type=None,
+        src_registry_user=None,
+        src_registry_password=None,
+        dst_registry_user=None,
+        dst_registry_password=None,
+        src_verify_tls=True,
+        dst_verify_tls=True,
+        debug=False,
+        force=False,
+        push_engine="skopeo",
+        push_cache=None,
+        limiter=None,
+    )
+    options.update(kwargs)
+    return options
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4])
+def test_async_max_in_flight(monkeypatch, max_in_flight: int) -> None:
+    """Test the async submitter keeps at most max_in_flight submissions in flight, off the event loop."""
+    build_analysis = _FakeBuildAnalysis()
+    threads = set()
+    wrapped = build_analysis.__wrapped__
+
+    def analyze(api_client: Any, **parameters: Any) -> SimpleNamespace:
+        threads.add(threading.current_thread().name)
+        return wrapped(api_client, **parameters)
+
+    build_analysis.__wrapped__ = analyze
+    monkeypatch.setattr(submitter, "build_analysis", build_analysis)
+    monkeypatch.setattr(submitter, "thoth_api_client", lambda: None)
+
+    work_queue: queue.Queue = queue.Queue()
+    for index in range(20):
+        work_queue.put(f"registry.example.com/thoth/app@sha256:{index}")
+    stop = threading.Event()
+    stop.set()
+
+    limits = dict(no_base=False, no_output=False, no_build_log=False)
+    asyncio.run(submitter._async_submitter(work_queue, None, _options(), limits, max_in_flight, stop))
+
+    assert build_analysis.requests == 20
+    assert build_analysis.max_in_flight == max_in_flight
+    assert all(name.startswith("submitter") for name in threads)
+
+
+def test_async_drain_on_stop(monkeypatch) -> None:
+    """Test the async submitter submits the work queued once stop is set and waits for submissions in flight."""
+    build_analysis = _FakeBuildAnalysis()
+    monkeypatch.setattr(submitter, "build_analysis", build_analysis)
+    monkeypatch.setattr(submitter, "thoth_api_client", lambda: None)
+
+    work_queue: queue.Queue = queue.Queue()
+    stop = threading.Event()
+
+    def produce() -> None:
+        for index in range(10):
+            work_queue.put(f"registry.example.com/thoth/app@sha256:{index}")
+            time.sleep(0.01)
+        stop.set()
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    limits = dict(no_base=False, no_output=False, no_build_log=False)
+    asyncio.run(submitter._async_submitter(work_queue, None, _options(), limits, 4, stop))
+    producer.join()
+
+    assert build_analysis.requests == 10
+    assert build_analysis.in_flight == 0
+    assert work_queue.empty()
+
+
+def _pushed(namespace: str) -> float:
+    """Get the number of images pushed to the push registry by builds in the given namespace."""
+    return prometheus_registry.get_sample_value("build_watcher_image_pushed_registry_total", {"namespace": namespace})
+
+
+@pytest.mark.parametrize("worker_mode", ["process", "async"])
+def test_pushed_registry_not_counted_on_cache_hit(monkeypatch, worker_mode: str) -> None:
+    """Test base images reused from the push cache are counted as cache hits, not as images pushed."""
+    pushes: List[str] = []
+
+    def push_image(image: str, push_registry: str, *args: Any, **kwargs: Any) -> str:
+        pushes.append(image)
+        return f"{push_registry}/{image.rsplit('/', maxsplit=1)[1]}"
+
+    async def push_image_async(image: str, push_registry: str, *args: Any, **kwargs: Any) -> str:
+        return push_image(image, push_registry)
+
+    monkeypatch.setattr(submitter, "build_analysis", _FakeBuildAnalysis())
+    monkeypatch.setattr(submitter, "thoth_api_client", lambda: None)
+    monkeypatch.setattr(submitter, "manifest_digest", lambda *args: "sha256:2222")
+    monkeypatch.setattr(submitter, "push_image", push_image)
+    monkeypatch.setattr(submitter, "push_image_async", push_image_async)
+
+    push_cache = PushCache()
+    namespace = f"push-{worker_mode}"
+    hits = prometheus_registry.get_sample_value("build_watcher_push_cache_hits_total") or 0.0
+    for index in range(2):
+        arguments = dict(
+            output_reference=f"registry.example.com/thoth/app@sha256:{index}",
+            base_input_reference=_BASE,
+            push_registry="push.example.com",
+            push_cache=push_cache,
+            namespace=namespace,
+        )
+        if worker_mode == "async":
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                asyncio.run(submitter.do_analyze_build_async(executor=executor, **arguments))
+        else:
+            submitter.do_analyze_build(**arguments)
+
+    assert pushes == ["registry.example.com/thoth/app@sha256:0", _BASE, "registry.example.com/thoth/app@sha256:1"]
+    assert _pushed(namespace) == 3
+    assert prometheus_registry.get_sample_value("build_watcher_push_cache_hits_total") == hits + 1
@@ -0,0 +1,233 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of supervision of producer and worker processes."""
+
+import time
+from multiprocessing import Queue
+from typing import Any
+from typing import List
+
+import pytest
+
+from thoth.build_watcher import supervisor
+from thoth.build_watcher.supervisor import Supervisor
+from thoth.build_watcher.supervisor import _Child
+
+
+class _FakeProcess:
+    """A process which exited with the given exit code."""
+
+    pid = 42
+
+    def __init__(self, exitcode: int = 1) -> None:
+        """Create the process."""
+        self.exitcode = exitcode
+
+    def is_alive(self) -> bool:
+        """Exited processes are not alive."""
+        return False
+
+
+class _FakeQueue:
+    """A work queue of the given depth."""
+
+    def __init__(self, depth: int = 0) -> None:
+        """Create the queue."""
+        self.depth = depth
+
+    def qsize(self) -> int:
+        """Get the depth of the queue."""
+        return self.depth
+
+
+def _child(started: List[Any], restart: bool = True) -> _Child:
+    """Create a child which exited, restarts are recorded instead of starting a process."""
+    child = _Child("producer", None, (), restart)
+    child.process = _FakeProcess()
+    child.start = lambda kwargs: started.append(kwargs)
+    return child
+
+
+def _service(events: Queue, delay: float, stop: Any) -> None:
+    """Stop once asked to, after finishing the work in progress."""
+    stop.wait()
+    time.sleep(delay)
+    events.put("service")
+
+
+def _hanging_service(events: Queue, stop: Any) -> None:
+    """Ignore the request to stop."""
+    time.sleep(60)
+
+
+def _worker(events: Queue, stop: Any, stats: Any) -> None:
+    """Stop once asked to."""
+    stop.wait()
+    events.put("worker")
+
+
+def test_restart_backoff(monkeypatch) -> None:
+    """Test processes exiting soon after start are restarted with exponential backoff."""
+    now = [1000.0]
+    monkeypatch.setattr(supervisor.time, "monotonic", lambda: now[0])
+    started: List[Any] = []
+    child = _child(started)
+    child.started = now[0]
+    sup = Supervisor(_FakeQueue(), restart_backoff=1.0, restart_backoff_max=5.0)
+
+    delays = []
+    for _ in range(5):
+        assert sup._check(child, {"stop": child.stop}) is True
+        delays.append(child.restart_at - now[0])
+        assert not started
+
+        now[0] = child.restart_at
+        assert sup._check(child, {"stop": child.stop}) is True
+        assert started.pop() == {"stop": child.stop}
+        # The restarted process exits right away again.
+        child.restart_at = None
+        child.started = now[0]
+
+    assert delays == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_restart_backoff_reset(monkeypatch) -> None:
+    """Test the backoff is reset for processes which ran long enough."""
+    now = [1000.0]
+    monkeypatch.setattr(supervisor.time, "monotonic", lambda: now[0])
+    child = _child([])
+    child.failures = 4
+    child.started = now[0] - supervisor._HEALTHY_AFTER
+    sup = Supervisor(_FakeQueue(), restart_backoff=1.0)
+
+    assert sup._check(child, {}) is True
+    assert child.failures == 1
+    assert child.restart_at == now[0] + 1.0
+
+
+@pytest.mark.parametrize(
+    "restart,retiring,exitcode,expected",
+    [(False, False, 0, False), (False, False, 1, True), (True, True, 1, False), (True, False, 0, True)],
+)
+def test_restart_finished(restart: bool, retiring: bool, exitcode: int, expected: bool) -> None:
+    """Test processes which finished for good are not restarted."""
+    child = _child([], restart)
+    child.process = _FakeProcess(exitcode)
+    child.retiring = retiring
+
+    assert Supervisor(_FakeQueue())._check(child, {}) is expected
+    assert (child.restart_at is not None) is expected
+
+
+def _scaled(depth: int, workers: int, submitted: int, busy: float, interval: float = 30.0) -> Supervisor:
+    """Scale a pool of the given number of workers, workers added are not started."""
+    sup = Supervisor(_FakeQueue(depth), min_workers=1, max_workers=3, latency_target=60.0)
+    sup._workers = [_Child(f"worker-{index}", None, ()) for index in range(workers)]
+    sup._add_worker = lambda: sup._workers.append(_Child("worker-new", None, ()))
+    sup.stats.record(0.0)
+    previous = sup.stats.snapshot()
+    for _ in range(submitted):
+        sup.stats.record(busy / submitted)
+    sup._scale(previous, interval)
+    return sup
+
+
+@pytest.mark.parametrize(
+    "depth,workers,submitted,busy,expected",
+    [
+        # 100 items at 1 second each would take 100 seconds by one worker.
+        (100, 1, 10, 10.0, 2),
+        # 50 items would be done in 50 seconds.
+        (50, 1, 10, 10.0, 1),
+        # Nothing was submitted although there is a backlog.
+        (1, 2, 0, 0.0, 3),
+        # The pool is at its maximum.
+        (100, 3, 10, 10.0, 3),
+    ],
+)
+def test_scale_up(depth: int, workers: int, submitted: int, busy: float, expected: int) -> None:
+    """Test a worker is added if the backlog would not be processed within the latency target."""
+    sup = _scaled(depth, workers, submitted, busy)
+
+    assert len(sup._workers) == expected
+    assert not any(worker.retiring for worker in sup._workers)
+
+
+def test_scale_down() -> None:
+    """Test the last worker is retired if the queue is empty and workers are mostly idle."""
+    sup = _scaled(0, 2, 10, 1.0)
+
+    assert [worker.retiring for worker in sup._workers] == [False, True]
+    assert sup._workers[1].stop.is_set()
+    assert not sup._workers[0].stop.is_set()
+
+    # The retiring worker is not counted, the pool is at its minimum.
+    sup._scale(sup.stats.snapshot(), 30.0)
+    assert [worker.retiring for worker in sup._workers] == [False, True]
+
+
+def test_no_scale_down_busy() -> None:
+    """Test workers are not retired if they are busy even though the queue is empty."""
+    sup = _scaled(0, 2, 10, 50.0)
+
+    assert not any(worker.retiring for worker in sup._workers)
+
+
+def _start(sup: Supervisor, events: Queue) -> None:
+    """Start processes registered and two workers."""
+    for service in sup._services:
+        service.start({"stop": service.stop})
+
+    sup._worker_target = _worker
+    sup._worker_args = (events,)
+    sup._add_worker()
+    sup._add_worker()
+
+
+def _drained(events: Queue, count: int) -> List[str]:
+    """Get events reported by processes drained."""
+    return [events.get(timeout=10) for _ in range(count)]
+
+
+def test_drain_order() -> None:
+    """Test workers are stopped only after producers queued the work in progress."""
+    events = Queue()
+    sup = Supervisor(_FakeQueue(), drain_timeout=10.0)
+    sup.add_service("producer", _service, (events, 0.5))
+    _start(sup, events)
+
+    sup._drain()
+
+    assert _drained(events, 3) == ["service", "worker", "worker"]
+    assert [child.process.exitcode for child in sup._services + sup._workers] == [0, 0, 0]
+
+
+def test_drain_terminates_hanging_producer() -> None:
+    """Test producers not stopped in time are terminated and workers are drained afterwards."""
+    events = Queue()
+    sup = Supervisor(_FakeQueue(), drain_timeout=10.0, stop_timeout=0.5)
+    sup.add_service("producer", _hanging_service, (events,))
+    _start(sup, events)
+
+    start = time.monotonic()
+    sup._drain()
+
+    assert time.monotonic() - start < 5.0
+    assert _drained(events, 2) == ["worker", "worker"]
+    assert sup._services[0].process.exitcode == -15
+    assert [worker.process.exitcode for worker in sup._workers] == [0, 0]
@@ -0,0 +1,82 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of recording latency of pipeline stages."""
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import pytest
+
+from thoth.build_watcher import tracing
+from thoth.build_watcher.metrics import prometheus_registry
+from thoth.build_watcher.tracing import observe
+
+
+def _count(stage: str) -> float:
+    """Get the number of durations of the given stage observed."""
+    return prometheus_registry.get_sample_value("build_watcher_stage_duration_seconds_count", {"stage": stage}) or 0.0
+
+
+@pytest.mark.parametrize("build_name", [None, "", "app-1", "a" * 1000])
+def test_observe_counted_once(build_name: Optional[str]) -> None:
+    """Test each duration is counted once whatever exemplar is attached."""
+    stage = f"test-{len(build_name or '')}-{build_name is None}"
+    observe(stage, 0.3, build_name)
+    observe(stage, 7.0, build_name)
+
+    assert _count(stage) == 2
+    assert prometheus_registry.get_sample_value("build_watcher_stage_duration_seconds_sum", {"stage": stage}) == 7.3
+
+
+@pytest.mark.parametrize(
+    "build_name,expected",
+    [
+        (None, None),
+        ("app-1", {"build_name": "app-1"}),
+        ("a" * 1000, {"build_name": "a" * 100}),
+    ],
+)
+def test_exemplar(build_name: Optional[str], expected: Optional[Dict[str, str]]) -> None:
+    """Test exemplars name the build and fit the limits of the collector."""
+    assert tracing._exemplar(build_name) == expected
+
+
+def test_exemplar_invalid(monkeypatch) -> None:
+    """Test exemplars which the collector would reject after counting the observation are dropped."""
+    monkeypatch.setattr(tracing, "_EXEMPLAR_MAX_LENGTH", 15)
+    assert tracing._exemplar("app-1") == {"build_name": "app-1"}
+    assert tracing._exemplar("app-12") is None
+
+
+def test_observe_without_exemplar_support(monkeypatch) -> None:
+    """Test durations are counted once by collectors not supporting exemplars."""
+    observed: List[float] = []
+
+    class _Histogram:
+        def labels(self, **_: Any) -> "_Histogram":
+            return self
+
+        def observe(self, amount: float) -> None:
+            observed.append(amount)
+
+    monkeypatch.setattr(tracing, "METRIC_STAGE_DURATION", _Histogram())
+    observe("analysis", 1.5, "app-1")
+
+    assert observed == [1.5]
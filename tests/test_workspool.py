@@ -0,0 +1,148 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the durable work spool."""
+
+import socket
+
+import pytest
+import requests
+import urllib3
+from thamos.swagger_client.rest import ApiException
+
+from thoth.build_watcher.workspool import WorkSpool
+from thoth.build_watcher.workspool import is_transient
+
+
+@pytest.fixture
+def spool(tmp_path) -> WorkSpool:
+    """Create a spool retrying right away."""
+    return WorkSpool(str(tmp_path / "spool.db"), lease_duration=60, max_attempts=3, backoff_base=0)
+
+
+def test_lease_ack(spool: WorkSpool) -> None:
+    """Test entries are leased in order, leased entries are not handed out again until acknowledged."""
+    spool.put({"name": "first"})
+    spool.put({"name": "second"})
+
+    first_id, first = spool.lease(timeout=0)
+    second_id, second = spool.lease(timeout=0)
+    assert (first, second) == ({"name": "first"}, {"name": "second"})
+    assert spool.lease(timeout=0) is None
+    assert spool.qsize() == 2
+
+    spool.ack(first_id)
+    spool.ack(second_id)
+    assert spool.qsize() == 0
+
+
+def test_recover(spool: WorkSpool) -> None:
+    """Test leases of a previous run are released on recovery."""
+    spool.put({"name": "build"})
+    assert spool.lease(timeout=0) is not None
+
+    assert spool.recover() == 1
+    assert spool.lease(timeout=0)[1] == {"name": "build"}
+
+
+def test_retry_and_dead_letter(spool: WorkSpool) -> None:
+    """Test failed entries are retried until they run out of attempts and then moved to the dead letter table."""
+    spool.put({"name": "build"})
+    for _ in range(3):
+        entry_id, _ = spool.lease(timeout=1)
+        spool.fail(entry_id, "HTTP 503")
+
+    assert spool.lease(timeout=0) is None
+    assert spool.qsize() == 0
+    assert spool.dead_letter_count() == 1
+    [dead_letter] = spool.dead_letters()
+    assert (dead_letter["reference"], dead_letter["attempts"], dead_letter["error"]) == (
+        {"name": "build"},
+        3,
+        "HTTP 503",
+    )
+
+    assert spool.replay() == 1
+    assert spool.dead_letter_count() == 0
+    assert spool.lease(timeout=0)[1] == {"name": "build"}
+
+
+def test_fail_permanent(spool: WorkSpool) -> None:
+    """Test entries failing with errors not worth retrying are moved to the dead letter table right away."""
+    spool.put({"name": "build"})
+    entry_id, _ = spool.lease(timeout=0)
+    spool.fail(entry_id, "HTTP 400", retry=False)
+
+    assert spool.qsize() == 0
+    assert spool.dead_letter_count() == 1
+
+
+def test_worker_died_on_each_attempt(spool: WorkSpool) -> None:
+    """Test an entry whose worker died on each attempt is moved to the dead letter table instead of leased again."""
+    spool.put({"name": "poison"})
+    for _ in range(3):
+        assert spool.lease(timeout=0) is not None
+        spool.recover()
+
+    assert spool.lease(timeout=0) is None
+    assert spool.dead_letters()[0]["error"] == "Worker exited while processing"
+
+
+def test_idle_lease_does_not_write(spool: WorkSpool) -> None:
+    """Test leasing from a spool without entries available does not start write transactions."""
+    spool.put({"name": "build"})
+    spool.lease(timeout=0)
+    statements = []
+    spool._db().set_trace_callback(statements.append)
+
+    assert spool.lease(timeout=0.1) is None
+    assert statements
+    assert not [statement for statement in statements if "BEGIN" in statement or "UPDATE" in statement]
+
+
+@pytest.mark.parametrize(
+    "exc",
+    [
+        ApiException(status=503, reason="Service Unavailable"),
+        ApiException(status=429, reason="Too Many Requests"),
+        ApiException(status=408, reason="Request Timeout"),
+        ConnectionResetError(),
+        TimeoutError(),
+        socket.timeout(),
+        requests.exceptions.ConnectionError(),
+        requests.exceptions.ReadTimeout(),
+        urllib3.exceptions.MaxRetryError(None, "/api/v1/build-analysis"),
+        urllib3.exceptions.ProtocolError("Connection aborted."),
+    ],
+)
+def test_transient_errors(exc: Exception) -> None:
+    """Test connection errors, timeouts, 5xx and 429 are retried."""
+    assert is_transient(exc)
+
+
+@pytest.mark.parametrize(
+    "exc",
+    [
+        ApiException(status=400, reason="Bad Request"),
+        ApiException(status=404, reason="Not Found"),
+        ValueError("invalid build log"),
+        KeyError("output_reference"),
+        TypeError("unexpected argument"),
+    ],
+)
+def test_permanent_errors(exc: Exception) -> None:
+    """Test client errors and errors caused by the submitted data are not retried."""
+    assert not is_transient(exc)
@@ -0,0 +1,469 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Handling of build logs passed from producers to submitters."""
+
+import collections
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import requests
+
+from .metrics import METRIC_BUILD_LOG_REDUCTION_RATIO
+
+_LOGGER = logging.getLogger(__name__)
+
+_BUILD_LOG_CHUNK_SIZE = 65536
+
+# Parts of build logs which differ across builds of the same BuildConfig even if dependencies installed are the same.
+_VOLATILE_PATTERNS = tuple(
+    (re.compile(pattern), replacement)
+    for pattern, replacement in (
+        (r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?", "<timestamp>"),
+        (r"\b\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?\b", "<time>"),
+        (r"\b(?:sha256|sha512):[0-9a-f]{32,128}\b", "<digest>"),
+        (r"\b[0-9a-f]{12,64}\b", "<id>"),
+        (r"\b[a-z0-9](?:[-a-z0-9]*[a-z0-9])?-\d+-build\b", "<pod>"),
+        (r"/tmp/[\w.-]+", "/tmp/<tmp>"),
+        (r"\b\d+(?:\.\d+)?\s?(?:[kMG]i?B/s|ms|s)\b", "<measure>"),
+    )
+)
+
+
+def buildlog_metadata(
+    api_endpoint: Optional[str] = None,
+    build_log: Optional[str] = None,
+    *,
+    size: Optional[int] = None,
+    omitted: int = 0,
+    sections: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """Gather metadata for the build log, sections are given if the build log was reduced."""
+    # Update the metadata with more details
+    if not build_log:
+        return {}
+
+    metadata = {"apiversion": api_endpoint, "kind": "BuildLog", "log": build_log}
+    if omitted:
+        metadata["truncated"] = True
+        metadata["original_size"] = size
+        metadata["omitted_bytes"] = omitted
+    if sections:
+        metadata["reduced"] = True
+        metadata["original_size"] = size
+        metadata["sections"] = sections
+
+    return metadata
+
+
+# Lines starting sections of build logs analyzed by Thoth - installation of Python dependencies and tracebacks.
+_DEPENDENCIES_START = re.compile(
+    r"Installing dependencies|\bmicropipenv\b|\bpipenv (?:install|sync|lock)\b|\bpip3? install\b|"
+    r"^(?:Collecting|Requirement already satisfied|Looking in indexes|Processing) "
+)
+_TRACEBACK_START = re.compile(r"^Traceback \(most recent call last\):")
+# Lines ending a section of dependencies - next steps of S2I or image build and push.
+_DEPENDENCIES_END = re.compile(
+    r"^(?:---> (?!Installing dependencies)|STEP \d+|COMMIT\b|Copying blob|Copying config|Writing manifest|"
+    r"Storing signatures|Pushing image|Successfully pushed|Push successful|Getting image source signatures)"
+)
+# Lines kept wherever they are, even outside of sections.
+_ERROR_LINE = re.compile(r"\b(?:ERROR|FATAL|Failed to)\b|\b[Ee]rror:")
+# Lines dropped even in sections - progress bars.
+_NOISE_LINE = re.compile(r"[\u2588\u2501]{3}|^\s*\d{1,3}%\|")
+
+
+class BuildLogReducer:
+    """Line filter keeping sections of build logs with installation of dependencies, tracebacks and error lines.
+
+    Lines are fed one by one, so that build logs can be reduced while they are streamed. Sections are described by
+    their kind and the line of the original log on which they start.
+    """
+
+    def __init__(self) -> None:
+        """Start with no section found."""
+        self.sections: List[Dict[str, Any]] = []
+        self._section: Optional[Dict[str, Any]] = None
+        self._line_number = 0
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        """Feed the next line of the build log, the section it is kept in is returned (None if it is dropped)."""
+        self._line_number += 1
+        section = self._section
+        if section and section["kind"] == "traceback" and not line[:1].isspace() and section["lines"] > 1:
+            # The exception line ends the traceback.
+            self._section = None
+            return section
+
+        if section and section["kind"] == "dependencies" and _DEPENDENCIES_END.search(line):
+            section = self._section = None
+
+        if section is None:
+            kind = None
+            if _TRACEBACK_START.search(line):
+                kind = "traceback"
+            elif _DEPENDENCIES_START.search(line):
+                kind = "dependencies"
+            elif _ERROR_LINE.search(line):
+                kind = "error"
+
+            if kind:
+                section = self._section = {"kind": kind, "line": self._line_number, "lines": 0}
+                self.sections.append(section)
+
+        if section is None or _NOISE_LINE.search(line):
+            return None
+
+        section["lines"] += 1
+        if section["kind"] == "error":
+            self._section = None
+        return section
+
+
+def _describe_sections(lines: Iterable[Tuple[str, Optional[Dict[str, Any]]]]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Join reduced lines, sections are described by start and end offsets in the result."""
+    result = io.StringIO()
+    sections: List[Dict[str, Any]] = []
+    last = None
+    for line, section in lines:
+        if section is not None and section is not last:
+            last = section
+            sections.append({"kind": section["kind"], "start": result.tell(), "end": None, "line": section["line"]})
+        result.write(line)
+
+    text = result.getvalue()
+    for i, item in enumerate(sections):
+        item["end"] = sections[i + 1]["start"] if i + 1 < len(sections) else len(text)
+
+    return text, sections
+
+
+def reduce_build_log(build_log: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """Keep only sections of the build log with installation of dependencies, tracebacks and error lines.
+
+    Sections are described by their kind, start and end offsets in the reduced log and the line of the original log
+    on which they start. The build log is returned unchanged if it has no section recognized.
+    """
+    reducer = BuildLogReducer()
+    kept = []
+    for line in io.StringIO(build_log):
+        section = reducer.feed(line)
+        if section is not None:
+            kept.append((line, section))
+
+    if not reducer.sections:
+        return build_log, []
+
+    return _describe_sections(kept)
+
+
+def normalize_build_log(build_log: str) -> str:
+    """Strip timestamps, pod names, digests and other parts of the build log which change on each build."""
+    for pattern, replacement in _VOLATILE_PATTERNS:
+        build_log = pattern.sub(replacement, build_log)
+
+    return build_log
+
+
+def build_log_digest(build_log: str) -> str:
+    """Compute digest of the normalized build log, builds installing the same dependencies share it."""
+    return hashlib.sha256(normalize_build_log(build_log).encode("utf-8", errors="replace")).hexdigest()
+
+
+class BoundedReader:
+    """Keep at most max_bytes of chunks fed - head and tail windows of equal size are kept if the cap is exceeded."""
+
+    def __init__(self, max_bytes: int = 0) -> None:
+        """Create the reader, max_bytes set to 0 means no limit."""
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._head_size = max_bytes // 2
+        self._tail_size = max_bytes - self._head_size
+
+    def feed(self, chunk: bytes) -> None:
+        """Feed the next chunk."""
+        self.size += len(chunk)
+        if self.max_bytes <= 0:
+            self._head += chunk
+            return
+
+        if len(self._head) < self._head_size:
+            taken = self._head_size - len(self._head)
+            self._head += chunk[:taken]
+            chunk = chunk[taken:]
+
+        if chunk:
+            self._tail += chunk
+            # Trim lazily so that the tail window is not copied on each chunk, one byte preceding the window is kept
+            # to tell whether the window starts on a line boundary.
+            if len(self._tail) > 2 * self._tail_size:
+                del self._tail[: -(self._tail_size + 1)]
+
+    def result(self) -> Tuple[bytes, int, int]:
+        """Return the content kept, the total size and the number of bytes omitted.
+
+        The windows are aligned to line boundaries where they hold a complete line, the omitted part is replaced
+        with a marker on a line of its own.
+        """
+        head, tail, size = self._head, self._tail, self.size
+        if self.max_bytes <= 0 or size <= self.max_bytes:
+            return bytes(head + tail), size, 0
+
+        del tail[: -(self._tail_size + 1)]
+        if b"\n" in head:
+            del head[head.rfind(b"\n") + 1 :]
+        # The partial first line of the tail is dropped only if a complete line remains.
+        line_end = tail.find(b"\n")
+        if line_end != -1 and line_end + 1 < len(tail):
+            del tail[: line_end + 1]
+        else:
+            del tail[:1]
+
+        omitted = size - len(head) - len(tail)
+        marker = _omitted_marker(omitted)
+        if head and not head.endswith(b"\n"):
+            marker = b"\n" + marker
+        return bytes(head) + marker + bytes(tail), size, omitted
+
+
+def _omitted_marker(omitted: int) -> bytes:
+    """Create the line replacing the omitted part of a build log."""
+    return f"... [{omitted} bytes of build log omitted] ...\n".encode()
+
+
+def read_bounded(chunks: Iterable[bytes], max_bytes: int = 0) -> Tuple[bytes, int, int]:
+    """Read chunks keeping at most max_bytes - head and tail windows of equal size are kept if the cap is exceeded.
+
+    Return the content read, the total size and the number of bytes omitted, see BoundedReader.
+    """
+    reader = BoundedReader(max_bytes)
+    for chunk in chunks:
+        reader.feed(chunk)
+
+    return reader.result()
+
+
+def _split_lines(chunks: Iterable[bytes], max_line: int = 0) -> Iterator[bytes]:
+    """Split chunks into lines, lines longer than max_line (if set) are cut and their rest is skipped."""
+    pending = bytearray()
+    skipping = False
+    for chunk in chunks:
+        start = 0
+        while start < len(chunk):
+            end = chunk.find(b"\n", start)
+            stop = len(chunk) if end == -1 else end + 1
+            if not skipping:
+                pending += chunk[start:stop]
+            start = stop
+
+            if max_line and len(pending) > max_line:
+                yield bytes(pending[: max_line - 1]) + b"\n"
+                pending.clear()
+                skipping = True
+
+            if end != -1:
+                if pending:
+                    yield bytes(pending)
+                    pending.clear()
+                skipping = False
+
+    if pending:
+        yield bytes(pending)
+
+
+def read_reduced(chunks: Iterable[bytes], max_bytes: int = 0) -> Tuple[str, int, int, Optional[List[Dict[str, Any]]]]:
+    """Read chunks reducing them line by line with BuildLogReducer, the cap applies to the reduced build log.
+
+    Return the build log, the total size read, the number of bytes of the reduced log omitted and sections of the
+    reduced log - None if no section was found, the build log is then read as by read_bounded. Lines kept are whole,
+    the reduced log is cut between lines keeping head and tail windows of equal size.
+    """
+    reducer = BuildLogReducer()
+    # The original log is kept as well in case it has no section recognized.
+    original = BoundedReader(max_bytes)
+    head: List[Tuple[str, Dict[str, Any]]] = []
+    # Lines of the tail window with their size in bytes.
+    tail: "collections.deque[Tuple[str, Dict[str, Any], int]]" = collections.deque()
+    head_bytes = tail_bytes = omitted = 0
+    head_size = max_bytes // 2
+
+    def read() -> Iterator[bytes]:
+        for chunk in chunks:
+            original.feed(chunk)
+            yield chunk
+
+    # A line kept needs to fit one of the windows.
+    for raw_line in _split_lines(read(), max(max_bytes // 2, 1) if max_bytes > 0 else 0):
+        line = raw_line.decode("utf-8", errors="replace")
+        section = reducer.feed(line)
+        if section is None:
+            continue
+
+        if max_bytes <= 0 or (not tail and head_bytes + len(raw_line) <= head_size):
+            head.append((line, section))
+            head_bytes += len(raw_line)
+            continue
+
+        tail.append((line, section, len(raw_line)))
+        tail_bytes += len(raw_line)
+        # The tail can use the part of the head window which was not filled.
+        while tail and tail_bytes > max_bytes - head_bytes:
+            dropped = tail.popleft()[2]
+            tail_bytes -= dropped
+            omitted += dropped
+
+    if not reducer.sections:
+        content, size, omitted = original.result()
+        return content.decode("utf-8", errors="replace"), size, omitted, None
+
+    lines: List[Tuple[str, Optional[Dict[str, Any]]]] = list(head)
+    if omitted:
+        lines.append((_omitted_marker(omitted).decode(), None))
+    lines.extend((line, section) for line, section, _ in tail)
+    build_log, sections = _describe_sections(lines)
+    return build_log, original.size, omitted, sections
+
+
+class BuildLogFetcher:
+    """Fetch build logs from the cluster incrementally, keeping memory used bounded by the configured cap."""
+
+    def __init__(self, max_bytes: int = 0, spool: Optional["BuildLogSpool"] = None, reduce: bool = False) -> None:
+        """Configure the fetcher, max_bytes set to 0 means no limit on build log size.
+
+        If reduce is set, only sections of build logs relevant for the analysis are kept, see read_reduced.
+        """
+        self.max_bytes = max_bytes
+        self.spool = spool
+        self.reduce = reduce
+
+    def fetch(self, openshift: Any, name: str, namespace: str, api_endpoint: Optional[str] = None) -> Dict[str, Any]:
+        """Fetch log of the given build and turn it into a build log reference passed to workers."""
+        endpoint = f"{openshift.openshift_api_url}/apis/build.openshift.io/v1/namespaces/{namespace}/builds/{name}/log"
+        with requests.get(
+            endpoint,
+            headers={"Authorization": f"Bearer {openshift.token}"},
+            verify=openshift.kubernetes_verify_tls,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            chunks = response.iter_content(chunk_size=_BUILD_LOG_CHUNK_SIZE)
+            if self.reduce:
+                # Sections are picked from the whole build log, the cap applies only to the reduced build log.
+                build_log, size, omitted, sections = read_reduced(chunks, self.max_bytes)
+            else:
+                content, size, omitted = read_bounded(chunks, self.max_bytes)
+                build_log, sections = content.decode("utf-8", errors="replace"), None
+
+        if omitted:
+            _LOGGER.info(
+                "Build log of %r in namespace %r has %d bytes, %d bytes were omitted", name, namespace, size, omitted
+            )
+
+        if self.reduce and size:
+            METRIC_BUILD_LOG_REDUCTION_RATIO.observe(len(build_log.encode("utf-8", errors="replace")) / size)
+            _LOGGER.debug(
+                "Build log of %r in namespace %r reduced from %d bytes to %d characters",
+                name,
+                namespace,
+                size,
+                len(build_log),
+            )
+
+        build_log_reference = buildlog_metadata(api_endpoint, build_log, size=size, omitted=omitted, sections=sections)
+        if self.spool:
+            build_log_reference = self.spool.store(build_log_reference)
+
+        return build_log_reference
+
+
+class BuildLogSpool:
+    """Pass large build logs between processes by reference using files in a spool directory.
+
+    Build logs larger than the threshold are written to a file by the producer and only the path is sent over the
+    work queue; the submitter reads the log back right before submitting it and removes the file.
+    """
+
+    def __init__(self, directory: Optional[str] = None, threshold: int = 65536) -> None:
+        """Configure the spool, the directory is created if it does not exist."""
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "build-watcher-logs")
+        self.threshold = threshold
+        os.makedirs(self.directory, exist_ok=True)
+
+    def store(self, build_log_reference: Dict[str, Any]) -> Dict[str, Any]:
+        """Move log out of the given build log reference into the spool if it exceeds the threshold."""
+        build_log = build_log_reference.get("log")
+        if not build_log or len(build_log) < self.threshold:
+            return build_log_reference
+
+        fd, path = tempfile.mkstemp(prefix="build-log-", suffix=".log", dir=self.directory)
+        try:
+            with os.fdopen(fd, "w") as spool_file:
+                spool_file.write(build_log)
+        except OSError as exc:
+            _LOGGER.warning("Failed to spool build log, it will be passed by value: %s", str(exc))
+            return build_log_reference
+
+        result = dict(build_log_reference)
+        result.pop("log")
+        result["log_path"] = path
+        return result
+
+    @staticmethod
+    def load(build_log_reference: Dict[str, Any]) -> Dict[str, Any]:
+        """Read log of the given build log reference back from the spool, the spool file is removed."""
+        path = build_log_reference.get("log_path")
+        if not path:
+            return build_log_reference
+
+        result = dict(build_log_reference)
+        result.pop("log_path")
+        try:
+            with open(path, "r") as spool_file:
+                result["log"] = spool_file.read()
+        except OSError as exc:
+            _LOGGER.error("Failed to read spooled build log from %r: %s", path, str(exc))
+            return {}
+        finally:
+            BuildLogSpool.discard(build_log_reference)
+
+        return result
+
+    @staticmethod
+    def discard(build_log_reference: Optional[Dict[str, Any]]) -> None:
+        """Remove spool file of the given build log reference, if any."""
+        path = (build_log_reference or {}).get("log_path")
+        if not path:
+            return
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            _LOGGER.warning("Failed to remove spooled build log %r: %s", path, str(exc))
@@ -0,0 +1,132 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Caches shared by build-watcher workers."""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from typing import Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """An LRU cache with TTL eviction, optionally backed by an SQLite database.
+
+    The on-disk store makes entries survive restarts and shares them across worker processes; the in-memory LRU
+    avoids hitting the database for hot keys.
+    """
+
+    # Expired and overflowing rows are dropped from the database once per this number of writes.
+    _DB_CLEANUP_INTERVAL = 256
+
+    def __init__(self, max_size: int = 4096, ttl: float = 86400, path: Optional[str] = None, table: str = "cache"):
+        """Create the cache, the database on the given path is created if it does not exist."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.table = table
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._connection_pid: Optional[int] = None
+        self._writes = 0
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """Get a connection to the backing database, connections are not shared across forked processes."""
+        if not self.path:
+            return None
+
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+            )
+            self._connection_pid = os.getpid()
+
+        return self._connection
+
+    def get(self, key: str) -> Optional[str]:
+        """Get value stored for the given key, None if the key is not present or the entry expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+
+            row = None
+            try:
+                db = self._db()
+                if db is not None:
+                    row = db.execute(f"SELECT expires, value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as exc:
+                _LOGGER.warning("Failed to query cache database %r: %s", self.path, str(exc))
+                return None
+
+            if row is None or row[0] <= now:
+                return None
+
+            self._store(key, row[0], row[1])
+            return row[1]
+
+    def __contains__(self, key: str) -> bool:
+        """Check if the given key is present in the cache."""
+        return self.get(key) is not None
+
+    def set(self, key: str, value: str = "") -> None:
+        """Store the given value under the key."""
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._store(key, expires, value)
+
+            try:
+                db = self._db()
+                if db is None:
+                    return
+
+                db.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)", (key, value, expires)
+                )
+                self._writes += 1
+                if self._writes % self._DB_CLEANUP_INTERVAL == 0:
+                    self._cleanup(db)
+            except sqlite3.Error as exc:
+                _LOGGER.warning("Failed to store entry into cache database %r: %s", self.path, str(exc))
+
+    def _store(self, key: str, expires: float, value: str) -> None:
+        """Store the entry into the in-memory LRU, evict the least recently used entries if needed."""
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _cleanup(self, db: sqlite3.Connection) -> None:
+        """Drop expired entries and entries exceeding the configured size from the database."""
+        db.execute(f"DELETE FROM {self.table} WHERE expires <= ?", (time.time(),))
+        db.execute(
+            f"DELETE FROM {self.table} WHERE key NOT IN "
+            f"(SELECT key FROM {self.table} ORDER BY expires DESC LIMIT ?)",
+            (self.max_size,),
+        )
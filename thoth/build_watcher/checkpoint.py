@@ -0,0 +1,82 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Persist position in the Build watch so that build-watcher can resume after a restart."""
+
+import json
+import logging
+import os
+import time
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class WatchCheckpoint:
+    """Store resourceVersion of the last processed Build watch event (or bookmark) per namespace.
+
+    If no path is provided, the checkpoint is kept only in memory - the watch can still resume after watch expiry,
+    but a restart of build-watcher causes a full relist.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        """Load the checkpoint stored on the given path, if any."""
+        self.path = path
+        self._content: Dict[str, Any] = {"resource_versions": {}}
+
+        if path and os.path.isfile(path):
+            try:
+                with open(path, "r") as checkpoint_file:
+                    self._content.update(json.load(checkpoint_file))
+            except (OSError, ValueError) as exc:
+                _LOGGER.warning("Failed to load watch checkpoint from %r, starting from scratch: %s", path, str(exc))
+
+    def get(self, namespace: str) -> Optional[str]:
+        """Get the last processed resourceVersion for the given namespace."""
+        entry = self._content["resource_versions"].get(namespace)
+        return entry["resource_version"] if entry else None
+
+    def set(self, namespace: str, resource_version: Optional[str], *, bookmark: bool = False) -> None:
+        """Record the last processed resourceVersion for the given namespace."""
+        if not resource_version:
+            return
+
+        self._content["resource_versions"][namespace] = {
+            "resource_version": resource_version,
+            "bookmark": bookmark,
+            "updated": time.time(),
+        }
+        self._persist()
+
+    def reset(self, namespace: str) -> None:
+        """Drop the checkpoint for the given namespace - the next watch will start with a full relist."""
+        if self._content["resource_versions"].pop(namespace, None) is not None:
+            self._persist()
+
+    def _persist(self) -> None:
+        """Atomically write the checkpoint to disk."""
+        if not self.path:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as checkpoint_file:
+                json.dump(self._content, checkpoint_file)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            _LOGGER.warning("Failed to persist watch checkpoint to %r: %s", self.path, str(exc))
@@ -0,0 +1,72 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Cluster client shared by all the components of build-watcher."""
+
+import logging
+import os
+import threading
+from typing import Optional
+
+from thoth.common import OpenShift
+
+_LOGGER = logging.getLogger(__name__)
+
+# Resources used by build-watcher, discovered before any process is forked.
+_RESOURCES = (
+    ("build.openshift.io/v1", "Build"),
+    ("image.openshift.io/v1", "ImageStream"),
+    ("v1", "Namespace"),
+    ("coordination.k8s.io/v1", "Lease"),
+)
+
+_OPENSHIFT: Optional[OpenShift] = None
+_OPENSHIFT_LOCK = threading.Lock()
+
+
+def openshift_client() -> OpenShift:
+    """Get the cluster client of this process, processes forked after the client was created inherit it."""
+    global _OPENSHIFT
+
+    with _OPENSHIFT_LOCK:
+        if _OPENSHIFT is None:
+            _OPENSHIFT = OpenShift()
+
+    return _OPENSHIFT
+
+
+def warm_up() -> OpenShift:
+    """Load cluster configuration and discover resources used, to be done once before processes are forked."""
+    openshift = openshift_client()
+    for api_version, kind in _RESOURCES:
+        try:
+            openshift.ocp_client.resources.get(api_version=api_version, kind=kind)
+        except Exception as exc:
+            _LOGGER.warning("Failed to discover resource %s %s: %s", api_version, kind, str(exc))
+
+    return openshift
+
+
+def _reset_connections() -> None:
+    """Drop connections inherited from the parent process, they cannot be shared across processes."""
+    global _OPENSHIFT_LOCK
+
+    _OPENSHIFT_LOCK = threading.Lock()
+    if _OPENSHIFT is not None:
+        _OPENSHIFT.ocp_client.client.rest_client.pool_manager.clear()
+
+
+os.register_at_fork(after_in_child=_reset_connections)
@@ -0,0 +1,114 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Coalescing of repeated watch events of the same build."""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from .cache import TTLCache
+from .fetcher import FetcherPool
+from .metrics import METRIC_BUILD_EVENTS_SUPPRESSED
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class EventCoalescer:
+    """Coalesce watch events of the same build so that each build is handed over to the fetcher pool only once.
+
+    The first event of a build suitable for analysis is held for the debounce window, descriptors of later events
+    of the same build (with a different resourceVersion) replace the held one. Once handed over, events of the build
+    are suppressed for as long as the build is remembered. Held events keep their position in the fetcher pool so
+    that the watch checkpoint does not advance past them.
+    """
+
+    def __init__(self, pool: FetcherPool, window: float = 5.0, max_size: int = 65536, ttl: float = 86400) -> None:
+        """Create the coalescer, the window set to 0 hands over builds immediately and only suppresses repeats."""
+        self.window = window
+        self._pool = pool
+        self._handed_over = TTLCache(max_size=max_size, ttl=ttl)
+        # Build UID mapped to [namespace, sequence, resourceVersion, descriptor, deadline].
+        self._pending: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._condition = threading.Condition()
+        if window > 0:
+            threading.Thread(target=self._flusher, name="event-coalescer", daemon=True).start()
+
+    def submit(
+        self, namespace: str, resource_version: Optional[str], descriptor: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Hand over an event, see FetcherPool.submit."""
+        build_uid = descriptor.get("build_uid") if descriptor else None
+        if not build_uid:
+            self._pool.submit(namespace, resource_version, descriptor)
+            return
+
+        with self._condition:
+            pending = self._pending.get(build_uid)
+            suppressed = pending is not None or build_uid in self._handed_over
+            if pending is not None and pending[2] != resource_version:
+                pending[2] = resource_version
+                pending[3] = descriptor
+            elif not suppressed:
+                self._handed_over.set(build_uid)
+                if self.window > 0:
+                    sequence = self._pool.defer(namespace, resource_version)
+                    deadline = time.monotonic() + self.window
+                    self._pending[build_uid] = [namespace, sequence, resource_version, descriptor, deadline]
+                    self._condition.notify()
+                    return
+
+        if not suppressed:
+            self._pool.submit(namespace, resource_version, descriptor)
+            return
+
+        METRIC_BUILD_EVENTS_SUPPRESSED.inc()
+        _LOGGER.debug(
+            "Suppressing event of build %r with resourceVersion %r, the build was already handed over",
+            descriptor.get("name"),
+            resource_version,
+        )
+        self._pool.submit(namespace, resource_version)
+
+    def reset(self, namespace: str) -> None:
+        """Reset the fetcher pool for the given namespace, held events are registered in the pool again."""
+        with self._condition:
+            self._pool.reset(namespace)
+            for pending in self._pending.values():
+                if pending[0] == namespace:
+                    pending[1] = self._pool.defer(namespace, pending[2])
+
+    def _flusher(self) -> None:
+        """Hand over held events once their debounce window elapses."""
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                build_uid, pending = next(iter(self._pending.items()))
+                delay = pending[4] - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                del self._pending[build_uid]
+
+            self._pool.release(pending[0], pending[1], pending[3])
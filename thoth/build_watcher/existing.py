@@ -0,0 +1,222 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Scan of images already present in image streams."""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue
+from multiprocessing.synchronize import Event
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from openshift.dynamic.exceptions import GoneError
+
+from .tracing import parse_timestamp
+
+_LOGGER = logging.getLogger(__name__)
+
+# Upper bound of the backoff between restarts of a namespace scan after its continue token expired.
+_RESTART_BACKOFF_MAX = 60.0
+
+
+class _RateLimiter:
+    """Space calls evenly so that at most the given number of calls per second is done across threads."""
+
+    def __init__(self, rate: float = 0.0) -> None:
+        """Create the limiter, rate set to 0 means no limit."""
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until the next call is allowed."""
+        if not self._interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            allowed = max(self._next, now)
+            self._next = allowed + self._interval
+
+        time.sleep(allowed - now)
+
+
+class ExistingImageScanner:
+    """Scan image streams page by page and queue images found for analysis, each image digest is queued once.
+
+    Progress of the scan is persisted after each page so that an interrupted scan is resumed. Once a scan completes,
+    subsequent scans queue only images created after the completed scan started.
+    """
+
+    def __init__(
+        self,
+        queue: Queue,
+        v1_imagestreams: Any,
+        *,
+        state_path: Optional[str] = None,
+        page_size: int = 100,
+        rate: float = 0.0,
+        history_depth: int = 1,
+        workers: int = 4,
+        max_restarts: int = 5,
+        restart_backoff: float = 1.0,
+        stop: Optional[Event] = None,
+    ) -> None:
+        """Configure the scanner, history_depth set to 0 queues all the images in the history of tags.
+
+        A namespace scan whose continue token expires is restarted with exponential backoff at most max_restarts
+        times, then it is left unfinished to be resumed by the next scan. Once stop is set, the scan is left
+        unfinished after the page being processed.
+        """
+        self.queue = queue
+        self.state_path = state_path
+        self.page_size = page_size
+        self.history_depth = history_depth
+        self.workers = workers
+        self.max_restarts = max_restarts
+        self.restart_backoff = restart_backoff
+        self.stop = stop
+        self._v1_imagestreams = v1_imagestreams
+        self._limiter = _RateLimiter(rate)
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._state: Dict[str, Any] = {}
+
+        if state_path and os.path.isfile(state_path):
+            try:
+                with open(state_path, "r") as state_file:
+                    self._state = json.load(state_file)
+            except (OSError, ValueError) as exc:
+                _LOGGER.warning("Failed to load state of existing images scan from %r: %s", state_path, str(exc))
+
+    def _persist(self) -> None:
+        """Atomically write state of the scan to disk."""
+        if not self.state_path:
+            return
+
+        tmp_path = f"{self.state_path}.tmp"
+        try:
+            with open(tmp_path, "w") as state_file:
+                json.dump(self._state, state_file)
+            os.replace(tmp_path, self.state_path)
+        except OSError as exc:
+            _LOGGER.warning("Failed to persist state of existing images scan to %r: %s", self.state_path, str(exc))
+
+    def run(self, namespaces: Optional[List[str]] = None) -> bool:
+        """Scan image streams in the given namespaces (all if None), return True if the scan was completed."""
+        scan = self._state.get("scan")
+        if scan:
+            _LOGGER.info("Resuming scan of existing images started at %s", time.ctime(scan["started"]))
+        else:
+            scan = self._state["scan"] = {"started": time.time(), "namespaces": {}}
+
+        since = self._state.get("last_completed")
+        if since:
+            _LOGGER.info("Queueing only existing images created after %s", time.ctime(since))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="existing-scan") as executor:
+            completed = all(executor.map(lambda key: self._scan(key, scan, since), namespaces or ["*"]))
+
+        if completed:
+            with self._lock:
+                self._state["last_completed"] = scan["started"]
+                self._state.pop("scan")
+                self._persist()
+
+        return completed
+
+    def _scan(self, key: str, scan: Dict[str, Any], since: Optional[float]) -> bool:
+        """Scan image streams in one namespace, return True if all the pages were processed."""
+        with self._lock:
+            progress = scan["namespaces"].setdefault(key, {"continue": None, "done": False})
+
+        namespace = None if key == "*" else key
+        restarts = 0
+        while not progress["done"]:
+            if self.stop is not None and self.stop.is_set():
+                _LOGGER.info("Scan of existing images in %r was stopped, it will be resumed on restart", key)
+                return False
+
+            try:
+                page = self._v1_imagestreams.get(
+                    namespace=namespace, limit=self.page_size, _continue=progress["continue"]
+                )
+            except GoneError:
+                if restarts >= self.max_restarts:
+                    _LOGGER.error(
+                        "Continue token of the scan in %r expired %d times, leaving the scan in %r unfinished",
+                        key,
+                        restarts + 1,
+                        key,
+                    )
+                    return False
+
+                restarts += 1
+                delay = min(_RESTART_BACKOFF_MAX, self.restart_backoff * 2 ** (restarts - 1))
+                _LOGGER.warning(
+                    "Continue token of the scan in %r expired, restarting the scan in %.1f seconds", key, delay
+                )
+                progress["continue"] = None
+                time.sleep(delay)
+                continue
+            except Exception as exc:
+                _LOGGER.exception("Failed to list image streams in %r, the scan will be resumed: %s", key, str(exc))
+                return False
+
+            for item in page.items or []:
+                self._queue_image_stream(item, since)
+
+            with self._lock:
+                progress["continue"] = page.metadata["continue"]
+                progress["done"] = not progress["continue"]
+                self._persist()
+
+        return True
+
+    def _queue_image_stream(self, item: Any, since: Optional[float]) -> None:
+        """Queue images referenced by tags of the given image stream."""
+        for tag in item.status.tags or []:
+            events = tag["items"] or []
+            if self.history_depth > 0:
+                events = events[: self.history_depth]
+
+            for event in events:
+                created = parse_timestamp(event.created)
+                if since and created and created < since:
+                    continue
+
+                with self._lock:
+                    if event.image in self._seen:
+                        continue
+                    self._seen.add(event.image)
+
+                self._limiter.wait()
+                _LOGGER.info("Queueing already existing image %r for analysis", event.dockerImageReference)
+                self.queue.put(
+                    {
+                        "output_reference": event.dockerImageReference,
+                        "output_digest": event.image,
+                        "namespace": item.metadata.namespace,
+                        "name": f"{item.metadata.name}:{tag.tag}",
+                    }
+                )
@@ -0,0 +1,150 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""A pool of build log fetchers decoupled from the build watch."""
+
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from .checkpoint import WatchCheckpoint
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class FetcherPool:
+    """Run the given fetch function on build descriptors emitted by the build watch concurrently.
+
+    The watch checkpoint is advanced only over events that were fully handed over to workers, events are
+    acknowledged in the order in which they were received from the watch even if fetches finish out of order.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[Dict[str, Any]], None],
+        workers: int,
+        checkpoint: WatchCheckpoint,
+        max_pending: Optional[int] = None,
+    ) -> None:
+        """Start the pool, at most max_pending descriptors wait for a fetcher before the watch is blocked."""
+        self._fetch = fetch
+        self._checkpoint = checkpoint
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="log-fetcher")
+        self._pending_slots = threading.BoundedSemaphore(max_pending or 4 * workers)
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        # Per namespace, sequence number of an event mapped to [resourceVersion, is bookmark, is done].
+        self._events: Dict[str, "OrderedDict[int, List[Any]]"] = {}
+        # Descriptors waiting for a fetcher per namespace of the build, namespaces take turns.
+        self._ready: "OrderedDict[str, deque]" = OrderedDict()
+        self._closed = False
+
+    def submit(
+        self,
+        namespace: str,
+        resource_version: Optional[str],
+        descriptor: Optional[Dict[str, Any]] = None,
+        *,
+        bookmark: bool = False,
+    ) -> None:
+        """Hand over an event, if no descriptor is given there is nothing to fetch and the event is done."""
+        self.release(namespace, self.defer(namespace, resource_version, bookmark=bookmark), descriptor)
+
+    def defer(self, namespace: str, resource_version: Optional[str], *, bookmark: bool = False) -> int:
+        """Register an event whose descriptor is handed over later, the checkpoint is not advanced past it meanwhile."""
+        sequence = next(self._sequence)
+        with self._lock:
+            self._events.setdefault(namespace, OrderedDict())[sequence] = [resource_version, bookmark, False]
+
+        return sequence
+
+    def release(self, namespace: str, sequence: int, descriptor: Optional[Dict[str, Any]] = None) -> None:
+        """Hand over descriptor of an event registered using defer."""
+        if descriptor is None:
+            self._done(namespace, sequence)
+            return
+
+        # Block the watch if fetchers cannot keep up, events are not lost as they stay unconsumed in the watch.
+        self._pending_slots.acquire()
+        with self._lock:
+            if self._closed:
+                # The checkpoint is not advanced past the event, it is received again after restart.
+                self._pending_slots.release()
+                return
+
+            self._ready.setdefault(descriptor.get("namespace") or namespace, deque()).append(
+                (namespace, sequence, descriptor)
+            )
+            self._executor.submit(self._run_next)
+
+    def shutdown(self) -> None:
+        """Wait for descriptors handed over to finish, descriptors handed over later are dropped."""
+        with self._lock:
+            self._closed = True
+
+        self._executor.shutdown(wait=True)
+
+    def reset(self, namespace: str) -> None:
+        """Forget events in flight for the given namespace and reset its checkpoint, used on watch expiry."""
+        with self._lock:
+            self._events.pop(namespace, None)
+            self._checkpoint.reset(namespace)
+
+    def _run_next(self) -> None:
+        """Fetch the next descriptor, descriptors are taken round-robin across namespaces of builds."""
+        with self._lock:
+            build_namespace, ready = next(iter(self._ready.items()))
+            namespace, sequence, descriptor = ready.popleft()
+            if ready:
+                self._ready.move_to_end(build_namespace)
+            else:
+                del self._ready[build_namespace]
+
+        self._run(namespace, sequence, descriptor)
+
+    def _run(self, namespace: str, sequence: int, descriptor: Dict[str, Any]) -> None:
+        """Fetch the given descriptor, the event is done even if the fetch fails."""
+        try:
+            self._fetch(descriptor)
+        except Exception as exc:
+            _LOGGER.exception("Failed to process build %r: %s", descriptor.get("name"), str(exc))
+        finally:
+            self._pending_slots.release()
+            self._done(namespace, sequence)
+
+    def _done(self, namespace: str, sequence: int) -> None:
+        """Mark the given event as done and advance the checkpoint over the events done so far."""
+        with self._lock:
+            events = self._events.get(namespace)
+            if events is None or sequence not in events:
+                # The watch was reset in the meanwhile.
+                return
+
+            events[sequence][2] = True
+            last = None
+            while events and next(iter(events.values()))[2]:
+                _, last = events.popitem(last=False)
+
+            if last is not None and last[0] is not None:
+                self._checkpoint.set(namespace, last[0], bookmark=last[1])
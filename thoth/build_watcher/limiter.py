@@ -0,0 +1,138 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Client side limits of requests done to Thoth User API."""
+
+import contextlib
+import logging
+import multiprocessing
+import threading
+import time
+from typing import Iterator
+from typing import Optional
+
+from .metrics import METRIC_ANALYSIS_CONCURRENCY_LIMIT
+from .workspool import is_transient
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Limit rate of calls while allowing bursts of the given size.
+
+    A shared bucket keeps its state in shared memory, it limits calls of all the processes forked after it was
+    created.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, shared: bool = False) -> None:
+        """Create the bucket, rate set to 0 means no limit."""
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # Number of tokens available and the time they were last updated at.
+        if shared:
+            self._state = multiprocessing.Array("d", [float(self.burst), time.monotonic()])
+            self._lock = self._state.get_lock()
+        else:
+            self._state = [float(self.burst), time.monotonic()]
+            self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, block until one is available."""
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate)
+                self._state[1] = now
+                if tokens >= 1:
+                    self._state[0] = tokens - 1
+                    return
+                self._state[0] = tokens
+                delay = (1 - tokens) / self.rate
+
+            time.sleep(delay)
+
+
+class AdaptiveLimiter:
+    """Limit concurrency of requests using additive increase/multiplicative decrease, on top of a token bucket.
+
+    The limit grows by one once a limit worth of requests finished in time and is cut whenever a request fails due
+    to overload (HTTP 429, 5xx or a connection error) or takes longer than the latency target. The limit is cut at
+    most once per latency target so that requests in flight when the backend got overloaded do not collapse it.
+    """
+
+    def __init__(
+        self,
+        rate: float = 0.0,
+        burst: int = 1,
+        *,
+        bucket: Optional[TokenBucket] = None,
+        min_limit: int = 1,
+        max_limit: int = 16,
+        latency_target: float = 10.0,
+        backoff: float = 0.5,
+    ) -> None:
+        """Create the limiter, the concurrency limit starts at the minimum and grows as requests succeed.
+
+        Rate of requests is limited by the given token bucket, e.g. one shared across workers, or by a bucket of
+        this limiter created based on rate and burst.
+        """
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.limit = float(self.min_limit)
+        self._bucket = bucket or TokenBucket(rate, burst)
+        self._in_flight = 0
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+        METRIC_ANALYSIS_CONCURRENCY_LIMIT.set(self.min_limit)
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        """Wait until a request can be sent, the outcome of the request adjusts the limit."""
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+        try:
+            self._bucket.acquire()
+            start = time.monotonic()
+            yield
+        except Exception as exc:
+            self._release(overloaded=is_transient(exc))
+            raise
+        else:
+            self._release(overloaded=time.monotonic() - start > self.latency_target)
+
+    def _release(self, overloaded: bool) -> None:
+        """Free the slot taken and adjust the limit based on the outcome of the request."""
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self._decreased >= self.latency_target:
+                    self._decreased = now
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    _LOGGER.warning("Thoth User API is overloaded, limiting concurrency to %d", int(self.limit))
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            METRIC_ANALYSIS_CONCURRENCY_LIMIT.set(int(self.limit))
+            self._condition.notify_all()
@@ -0,0 +1,233 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Metrics exposed by build-watcher."""
+
+import logging
+import os
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, push_to_gateway, start_http_server
+from prometheus_client.multiprocess import MultiProcessCollector
+
+_LOGGER = logging.getLogger(__name__)
+
+THOTH_METRICS_PUSHGATEWAY_URL = os.getenv("PROMETHEUS_PUSHGATEWAY_HOST")
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+METRICS_MODES = ("push", "flusher", "endpoint")
+_METRICS_MODE = "push"
+# Start of build-watcher, processes forked later inherit it.
+_STARTED = time.monotonic()
+
+prometheus_registry = CollectorRegistry()
+
+METRIC_IMAGES_SUBMITTED = Counter(
+    "build_watcher_image_submission_total",
+    "Number of images submitted for analysis.",
+    ["namespace"],
+    registry=prometheus_registry,
+)
+METRIC_IMAGES_PUSHED_REGISTRY = Counter(
+    "build_watcher_image_pushed_registry_total",
+    "Number of images push to external registry.",
+    ["namespace"],
+    registry=prometheus_registry,
+)
+METRIC_BUILD_LOGS_SUBMITTED = Counter(
+    "build_watcher_build_log_submission_total",
+    "Number of build logs submitted for analysis.",
+    ["namespace"],
+    registry=prometheus_registry,
+)
+METRIC_BUILDS_FAILED = Counter(
+    "build_watcher_builds_failed_total", "Number of builds failed.", ["namespace"], registry=prometheus_registry
+)
+METRIC_DEDUP_CACHE_HITS = Counter(
+    "build_watcher_dedup_cache_hits_total",
+    "Number of images and build logs not submitted as they were already submitted for analysis.",
+    ["kind"],
+    registry=prometheus_registry,
+)
+METRIC_DEDUP_CACHE_MISSES = Counter(
+    "build_watcher_dedup_cache_misses_total",
+    "Number of images and build logs not found in the cache of already submitted artifacts.",
+    ["kind"],
+    registry=prometheus_registry,
+)
+
+METRIC_PUSH_CACHE_HITS = Counter(
+    "build_watcher_push_cache_hits_total",
+    "Number of image pushes to external registry avoided as the image was already pushed.",
+    [],
+    registry=prometheus_registry,
+)
+METRIC_PUSHES_COALESCED = Counter(
+    "build_watcher_pushes_coalesced_total",
+    "Number of image pushes to external registry which waited for a push of the same image in flight.",
+    [],
+    registry=prometheus_registry,
+)
+
+METRIC_BUILD_EVENTS_SUPPRESSED = Counter(
+    "build_watcher_build_events_suppressed_total",
+    "Number of repeated build events not processed as the build was already handed over for analysis.",
+    [],
+    registry=prometheus_registry,
+)
+
+METRIC_SUBMISSION_RETRIES = Counter(
+    "build_watcher_submission_retries_total",
+    "Number of failed submissions scheduled for a retry from the work spool.",
+    [],
+    registry=prometheus_registry,
+)
+
+METRIC_DEAD_LETTERS = Counter(
+    "build_watcher_dead_letters_total",
+    "Number of submissions moved to the dead letter table of the work spool after exhausting retries.",
+    [],
+    registry=prometheus_registry,
+)
+METRIC_PROCESS_RESTARTS = Counter(
+    "build_watcher_process_restarts_total",
+    "Number of build-watcher processes restarted after they exited unexpectedly.",
+    ["process"],
+    registry=prometheus_registry,
+)
+
+METRIC_STAGE_DURATION = Histogram(
+    "build_watcher_stage_duration_seconds",
+    "Time spent in stages of the pipeline from build completion to analysis submission.",
+    ["stage"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+    registry=prometheus_registry,
+)
+METRIC_BUILD_LOG_REDUCTION_RATIO = Histogram(
+    "build_watcher_build_log_reduction_ratio",
+    "Size of reduced build logs relative to the build logs fetched.",
+    [],
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0),
+    registry=prometheus_registry,
+)
+METRIC_QUEUE_DEPTH = Gauge(
+    "build_watcher_queue_depth",
+    "Number of builds and images waiting in the work queue for a worker.",
+    [],
+    multiprocess_mode="max",
+    registry=prometheus_registry,
+)
+METRIC_WORKERS = Gauge(
+    "build_watcher_workers",
+    "Number of worker processes currently running.",
+    [],
+    multiprocess_mode="max",
+    registry=prometheus_registry,
+)
+METRIC_SUBMISSIONS_IN_FLIGHT = Gauge(
+    "build_watcher_submissions_in_flight",
+    "Number of submissions being pushed or submitted for analysis by workers.",
+    [],
+    multiprocess_mode="livesum",
+    registry=prometheus_registry,
+)
+METRIC_ANALYSIS_CONCURRENCY_LIMIT = Gauge(
+    "build_watcher_analysis_concurrency_limit",
+    "Number of concurrent requests to Thoth User API currently allowed by the adaptive limiter.",
+    [],
+    multiprocess_mode="livesum",
+    registry=prometheus_registry,
+)
+
+METRIC_STARTUP_DURATION = Gauge(
+    "build_watcher_startup_seconds",
+    "Number of seconds from start of build-watcher until the given startup phase was reached.",
+    ["phase"],
+    multiprocess_mode="max",
+    registry=prometheus_registry,
+)
+
+METRIC_SHARD_MEMBERS = Gauge(
+    "build_watcher_shard_members",
+    "Number of live build-watcher replicas splitting builds in the sharded mode.",
+    [],
+    multiprocess_mode="max",
+    registry=prometheus_registry,
+)
+
+
+def configure_metrics(mode: str = "push", *, push_interval: float = 30.0, port: int = 8080) -> None:
+    """Set up metrics pipeline in the main process before any other process is started.
+
+    In the push mode, each process pushes its own metrics on each change. Other modes aggregate metrics of all
+    the processes using prometheus_client's multiprocess mode - a background thread pushes them on an interval
+    (flusher) or they are exposed on a /metrics endpoint (endpoint). Files in PROMETHEUS_MULTIPROC_DIR are not
+    removed here as values of this process were already created in them on import, the directory needs to be
+    cleared by the caller before this module is imported.
+    """
+    global _METRICS_MODE
+
+    if mode not in METRICS_MODES:
+        raise ValueError(f"Unknown metrics mode {mode!r}, supported are: {', '.join(METRICS_MODES)}")
+
+    if mode != "push" and not PROMETHEUS_MULTIPROC_DIR:
+        raise ValueError(f"Metrics mode {mode!r} requires PROMETHEUS_MULTIPROC_DIR environment variable to be set")
+
+    _METRICS_MODE = mode
+    if mode == "push":
+        return
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    if mode == "endpoint":
+        _LOGGER.info("Exposing metrics on port %d", port)
+        start_http_server(port, registry=registry)
+        return
+
+    _LOGGER.info("Pushing metrics aggregated across processes each %g seconds", push_interval)
+    threading.Thread(target=_flusher, args=(registry, push_interval), name="metrics-flusher", daemon=True).start()
+
+
+def _flusher(registry: CollectorRegistry, push_interval: float) -> None:
+    """Push metrics of the given registry periodically."""
+    while True:
+        time.sleep(push_interval)
+        _push(registry)
+
+
+def _push(registry: CollectorRegistry) -> None:
+    """Push metrics of the given registry to Prometheus pushgateway, if configured."""
+    if not THOTH_METRICS_PUSHGATEWAY_URL:
+        _LOGGER.info("Not pushing metrics as Prometheus pushgateway was not provided")
+        return
+
+    try:
+        _LOGGER.info("Submitting metrics to Prometheus pushgateway %r", THOTH_METRICS_PUSHGATEWAY_URL)
+        push_to_gateway(THOTH_METRICS_PUSHGATEWAY_URL, job="build-watcher", registry=registry)
+    except Exception as e:
+        _LOGGER.exception(f"An error occurred pushing the metrics: {str(e)}")
+
+
+def observe_startup(phase: str) -> None:
+    """Record time from start of build-watcher until the given startup phase was reached."""
+    METRIC_STARTUP_DURATION.labels(phase=phase).set(time.monotonic() - _STARTED)
+
+
+def push_metrics() -> None:
+    """Push metrics of this process to Prometheus pushgateway, no-op if metrics are aggregated across processes."""
+    if _METRICS_MODE == "push":
+        _push(prometheus_registry)
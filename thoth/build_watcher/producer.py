@@ -0,0 +1,397 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Producers watching the cluster and queueing builds and images for analysis."""
+
+import logging
+import os
+import threading
+import time
+from multiprocessing import Queue
+from multiprocessing.synchronize import Event
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from kubernetes import watch
+from openshift.dynamic.exceptions import GoneError
+from openshift.dynamic.resource import ResourceInstance
+from requests.exceptions import HTTPError
+
+from .buildlog import BuildLogFetcher
+from .buildlog import buildlog_metadata
+from .cache import TTLCache
+from .checkpoint import WatchCheckpoint
+from .cluster import openshift_client
+from .coalescer import EventCoalescer
+from .existing import ExistingImageScanner
+from .fetcher import FetcherPool
+from .metrics import METRIC_BUILDS_FAILED
+from .metrics import observe_startup
+from .metrics import push_metrics
+from .profiling import track_in_flight
+from .recorder import record
+from .sharding import SHARD_CLAIM_ANNOTATION
+from .sharding import ShardCoordinator
+from .sharding import shard_membership
+from .tracing import observe
+from .tracing import parse_timestamp
+from .tracing import stage
+from .tracing import trace_context
+
+_LOGGER = logging.getLogger(__name__)
+
+# Watches are restarted after this number of seconds so that stopped watches do not hang on a quiet namespace.
+_WATCH_TIMEOUT = 300
+# Watches failing with other errors than an expired checkpoint are restarted with exponential backoff.
+_WATCH_RETRY_BACKOFF = 1.0
+_WATCH_RETRY_BACKOFF_MAX = 60.0
+# Phases in which builds are analyzed.
+_TERMINAL_PHASES = ("Complete", "Failed")
+# Builds which did not finish yet are filtered out by the API server if server-side filtering is enabled.
+_FINISHED_BUILDS_SELECTOR = "status!=New,status!=Pending,status!=Running"
+
+
+def _build_output_digest(build: Any) -> Optional[str]:
+    """Obtain manifest digest of the image produced by the given build."""
+    output = build.status.output
+    if not output or not output.to:
+        return None
+
+    return output.to.imageDigest
+
+
+def existing_producer(
+    queue: Queue,
+    namespaces: Optional[List[str]],
+    namespace_selector: Optional[str] = None,
+    scan_options: Optional[Dict[str, Any]] = None,
+    stop: Optional[Event] = None,
+) -> None:
+    """Query for existing images in image streams and queue them for analysis, see event_producer for namespaces."""
+    openshift = openshift_client()
+    if namespace_selector:
+        namespaces = _select_namespaces(openshift, namespace_selector)
+
+    v1_imagestreams = openshift.ocp_client.resources.get(api_version="image.openshift.io/v1", kind="ImageStream")
+    if ExistingImageScanner(queue, v1_imagestreams, stop=stop, **(scan_options or {})).run(namespaces):
+        _LOGGER.info("Queuing existing images for analyses has finished, all of them were scheduled for analysis")
+    else:
+        _LOGGER.warning("Queuing existing images for analyses was not finished, the scan will be resumed on restart")
+
+
+def _base_input_reference(strategy: Dict[str, Any]) -> Optional[str]:
+    """Obtain base image based upon the strategy of the build."""
+    if strategy.get("sourceStrategy"):
+        return strategy.get("sourceStrategy", {}).get("from", {}).get("name", None)
+    elif strategy.get("dockerStrategy") and strategy.get("dockerStrategy", {}).get("from", {}):
+        return strategy.get("dockerStrategy", {}).get("from", {}).get("name", None)
+
+    return None
+
+
+def _get_build(openshift, build_reference: Dict[str, Any], build_log_fetcher: BuildLogFetcher) -> dict:
+    """Gather Build log for the given build descriptor."""
+    name = build_reference["name"]
+    namespace = build_reference["namespace"]
+    self_link = build_reference.pop("self_link")
+    try:
+        build_reference["build_log_reference"] = build_log_fetcher.fetch(openshift, name, namespace, self_link)
+    except HTTPError as exc:
+        _LOGGER.warning("Failed to get the log for build %s: %s", name, str(exc))
+        build_reference["build_log_reference"] = buildlog_metadata()
+    except Exception as exc:
+        _LOGGER.exception("Failed to get the log for build %s: %s", name, str(exc))
+        build_reference["build_log_reference"] = buildlog_metadata()
+
+    return build_reference
+
+
+def _build_log_size(build_log_reference: Dict[str, Any]) -> int:
+    """Get size of the build log fetched, also if it was truncated, reduced or spooled."""
+    if build_log_reference.get("original_size"):
+        return build_log_reference["original_size"]
+
+    if build_log_reference.get("log_path"):
+        try:
+            return os.path.getsize(build_log_reference["log_path"])
+        except OSError:
+            return 0
+
+    return len(build_log_reference.get("log") or "")
+
+
+def _watch(
+    v1_build: Any,
+    namespace: Optional[str],
+    resource_version: Optional[str],
+    label_selector: Optional[str] = None,
+    server_side_filter: bool = False,
+) -> Iterator[Dict[str, Any]]:
+    """Stream Build events, optionally filtered by the API server to builds which finished, with bookmarks."""
+    if not label_selector and not server_side_filter:
+        yield from v1_build.watch(namespace=namespace, resource_version=resource_version, timeout=_WATCH_TIMEOUT)
+        return
+
+    # The dynamic client does not pass allowWatchBookmarks, query parameters are passed to the request directly.
+    for event in watch.Watch().stream(
+        v1_build.get,
+        namespace=namespace,
+        label_selector=label_selector,
+        field_selector=_FINISHED_BUILDS_SELECTOR if server_side_filter else None,
+        resource_version=resource_version,
+        serialize=False,
+        timeout_seconds=_WATCH_TIMEOUT,
+        query_params=[("allowWatchBookmarks", "true")] if server_side_filter else [],
+    ):
+        event["object"] = ResourceInstance(v1_build, event["object"])
+        yield event
+
+
+def _watch_builds(
+    v1_build: Any,
+    namespace: Optional[str],
+    checkpoint: WatchCheckpoint,
+    coalescer: EventCoalescer,
+    fetcher_pool: FetcherPool,
+    shard: Optional[ShardCoordinator] = None,
+    stop: Optional[threading.Event] = None,
+    watch_options: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Watch builds in the given namespace, or in all namespaces if None, until stopped.
+
+    Watch options are passed to _watch - a label selector and whether builds should be filtered server-side. The
+    watch is restarted from the checkpoint on any error, so that a namespace is not left unwatched.
+    """
+    # Position in the watch is tracked per watch, a cluster-wide watch has its own key.
+    watch_key = namespace or "*"
+    failures = 0
+    while not (stop and stop.is_set()):
+        resource_version = checkpoint.get(watch_key)
+        if resource_version:
+            _LOGGER.info("Resuming build watch in %r from resourceVersion %r", watch_key, resource_version)
+        else:
+            _LOGGER.info("Starting build watch in %r without a checkpoint, all builds will be listed", watch_key)
+
+        try:
+            for event in _watch(v1_build, namespace, resource_version, **(watch_options or {})):
+                if event["type"] == "ERROR":
+                    if event["raw_object"].get("code") == 410:
+                        _LOGGER.warning(
+                            "Watch checkpoint %r expired on the server side, falling back to a full relist: %s",
+                            resource_version,
+                            event["raw_object"].get("message"),
+                        )
+                        coalescer.reset(watch_key)
+                    else:
+                        _LOGGER.error("Build watch returned an error, restarting the watch: %r", event["raw_object"])
+                    break
+
+                failures = 0
+                if event["type"] == "BOOKMARK":
+                    fetcher_pool.submit(watch_key, event["object"].metadata.resourceVersion, bookmark=True)
+                    continue
+
+                descriptor = _handle_build_event(event)
+                if descriptor and shard and not shard.accept(descriptor):
+                    descriptor = None
+
+                coalescer.submit(watch_key, event["object"].metadata.resourceVersion, descriptor)
+                if stop and stop.is_set():
+                    break
+        except GoneError as exc:
+            _LOGGER.warning(
+                "Watch checkpoint %r expired on the server side, falling back to a full relist: %s",
+                resource_version,
+                str(exc),
+            )
+            coalescer.reset(watch_key)
+        except Exception as exc:
+            failures += 1
+            delay = min(_WATCH_RETRY_BACKOFF_MAX, _WATCH_RETRY_BACKOFF * 2 ** (failures - 1))
+            _LOGGER.exception(
+                "Build watch in %r failed (attempt %d), restarting it in %.0f seconds: %s",
+                watch_key,
+                failures,
+                delay,
+                str(exc),
+            )
+            if stop:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+
+    _LOGGER.info("Stopped build watch in %r", watch_key)
+
+
+def _select_namespaces(openshift: Any, namespace_selector: str) -> List[str]:
+    """List namespaces matching the given label selector."""
+    v1_namespace = openshift.ocp_client.resources.get(api_version="v1", kind="Namespace")
+    return [item.metadata.name for item in v1_namespace.get(label_selector=namespace_selector).items]
+
+
+def event_producer(
+    queue: Queue,
+    namespaces: Optional[List[str]],
+    build_log_fetcher: BuildLogFetcher,
+    checkpoint_path: Optional[str] = None,
+    log_fetchers: int = 4,
+    coalesce_window: float = 5.0,
+    sharding: Optional[Dict[str, Any]] = None,
+    namespace_selector: Optional[str] = None,
+    namespace_refresh_interval: float = 60.0,
+    watch_options: Optional[Dict[str, Any]] = None,
+    stop: Optional[Event] = None,
+) -> None:
+    """Accept events from the cluster and queue them into work queue processed by the main process.
+
+    Builds are watched in the given namespaces, in namespaces matching the namespace selector or, if neither is
+    given, in all namespaces using one cluster-wide watch. Once stop is set, watches are stopped and build logs
+    being fetched are queued before returning, the checkpoint is not advanced past events not queued.
+    """
+    _LOGGER.info("Starting event producer")
+    openshift = openshift_client()
+    v1_build = openshift.ocp_client.resources.get(api_version="build.openshift.io/v1", kind="Build")
+    checkpoint = WatchCheckpoint(checkpoint_path)
+    first_queued = threading.Event()
+    failed_builds = TTLCache(max_size=4096)
+
+    def fetch(build_reference: Dict[str, Any]) -> None:
+        name = build_reference["name"]
+        namespace = build_reference["namespace"]
+        if shard and not shard.claim(build_reference):
+            return
+
+        if build_reference.pop("failed", False) and build_reference["build_uid"] not in failed_builds:
+            # Repeated events and relists of the same build are counted once.
+            failed_builds.set(build_reference["build_uid"])
+            METRIC_BUILDS_FAILED.labels(namespace=namespace).inc()
+            push_metrics()
+
+        if build_reference["completion_time"]:
+            # Time from build completion until the build is picked by a fetcher, repeated events are not counted.
+            observe("watch", time.time() - build_reference["completion_time"], name)
+
+        with stage("log_fetch", name), track_in_flight("log_fetch", build_name=name, namespace=namespace):
+            build_reference = _get_build(openshift, build_reference, build_log_fetcher)
+            build_reference["trace_context"] = trace_context()
+
+        record(
+            "build",
+            name=name,
+            namespace=namespace,
+            output=bool(build_reference["output_reference"]),
+            base=bool(build_reference["base_input_reference"]),
+            log_size=_build_log_size(build_reference["build_log_reference"]),
+        )
+        build_reference["queued_at"] = time.time()
+        queue.put(build_reference)
+        _LOGGER.info("Queued build log based on build event %r for further processing", name)
+        if not first_queued.is_set():
+            first_queued.set()
+            observe_startup("first_event")
+            push_metrics()
+
+    # The watch only emits build descriptors, build logs are fetched concurrently by the pool - round-robin
+    # across namespaces so that a burst of builds in one namespace does not delay builds in others.
+    fetcher_pool = FetcherPool(fetch, log_fetchers, checkpoint)
+    # Repeated events of the same build (resyncs, updates after completion) are handed over only once.
+    coalescer = EventCoalescer(fetcher_pool, coalesce_window)
+
+    shard = None
+    if sharding:
+        # Builds of replicas which left are adopted outside of the watch, they do not affect the checkpoint.
+        shard = ShardCoordinator(
+            shard_membership(openshift=openshift, namespace=namespaces[0] if namespaces else None, **sharding),
+            lambda descriptor: fetcher_pool.submit(descriptor["namespace"], None, descriptor),
+        )
+
+    watches: Dict[Optional[str], threading.Event] = {}
+
+    def start_watch(namespace: Optional[str]) -> None:
+        watches[namespace] = threading.Event()
+        threading.Thread(
+            target=_watch_builds,
+            args=(v1_build, namespace, checkpoint, coalescer, fetcher_pool, shard, watches[namespace], watch_options),
+            name=f"watch-{namespace or '*'}",
+            daemon=True,
+        ).start()
+
+    stop = stop or threading.Event()
+    if not namespaces and not namespace_selector:
+        start_watch(None)
+        stop.wait()
+
+    while not stop.is_set():
+        try:
+            watched = set(namespaces or _select_namespaces(openshift, namespace_selector))
+        except Exception as exc:
+            _LOGGER.exception("Failed to list namespaces matching %r: %s", namespace_selector, str(exc))
+            watched = set(watches)
+
+        for namespace in watched - set(watches):
+            _LOGGER.info("Starting to watch builds in namespace %r", namespace)
+            start_watch(namespace)
+
+        for namespace in set(watches) - watched:
+            _LOGGER.info("Namespace %r no longer matches %r, stopping its build watch", namespace, namespace_selector)
+            watches.pop(namespace).set()
+
+        stop.wait(namespace_refresh_interval)
+
+    # Watches blocked on a quiet namespace are not waited for, they are daemon threads.
+    _LOGGER.info("Stopping event producer, waiting for build logs being fetched")
+    for watch_stop in watches.values():
+        watch_stop.set()
+    fetcher_pool.shutdown()
+    _LOGGER.info("Event producer stopped")
+
+
+def _handle_build_event(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Create a build descriptor for the given Build watch event, if the build is in a phase suitable for analysis."""
+    build = event["object"]
+    phase = build.status.phase
+    if event["type"] == "DELETED" or phase not in _TERMINAL_PHASES:
+        _LOGGER.debug("Ignoring %s event of build %r in phase %r", event["type"], build.metadata.name, phase)
+        return None
+
+    build_reference = {
+        "build_log_reference": buildlog_metadata(),
+        "base_input_reference": _base_input_reference(build.spec.strategy),
+        "output_reference": None,
+        "output_digest": _build_output_digest(build),
+        "build_uid": build.metadata.uid,
+        "name": build.metadata.name,
+        "namespace": build.metadata.namespace,
+        "self_link": build.metadata.selfLink,
+        "completion_time": parse_timestamp(build.status.completionTimestamp),
+        "claimed_by": (event["raw_object"]["metadata"].get("annotations") or {}).get(SHARD_CLAIM_ANNOTATION),
+    }
+    if phase == "Failed":
+        _LOGGER.debug("Submitting base image and build log of failed build %r", build_reference["name"])
+        build_reference["failed"] = True
+        return build_reference
+
+    _LOGGER.debug(
+        "New event of completed build %r in namespace %r, resourceVersion %r",
+        build_reference["name"],
+        build_reference["namespace"],
+        build.metadata.resourceVersion,
+    )
+    build_reference["output_reference"] = build.status.outputDockerImageReference
+    return build_reference
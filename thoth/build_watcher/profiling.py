@@ -0,0 +1,236 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Profiling of running processes triggered by signals."""
+
+import contextlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+# Signals starting a CPU profile and a memory profile, items in flight are dumped on both.
+CPU_PROFILE_SIGNAL = signal.SIGUSR1
+MEMORY_PROFILE_SIGNAL = signal.SIGUSR2
+
+_SAMPLING_INTERVAL = 0.01
+_TOP_ALLOCATIONS = 50
+_TRACEBACK_DEPTH = 25
+
+_PROFILE_DIR: Optional[str] = None
+_PROFILE_WINDOW = 30.0
+# Only one profile of each kind runs at a time in a process.
+_RUNNING: Dict[str, threading.Lock] = {"cpu": threading.Lock(), "memory": threading.Lock()}
+
+# Items being processed by this process, dumped on request.
+_IN_FLIGHT: Dict[int, Dict[str, Any]] = {}
+_IN_FLIGHT_KEYS = itertools.count()
+
+
+def configure_profiling(directory: Optional[str], window: float = 30.0) -> None:
+    """Write profiles to the given directory, to be done before processes are forked; None turns profiling off."""
+    global _PROFILE_DIR, _PROFILE_WINDOW
+
+    _PROFILE_DIR = directory
+    _PROFILE_WINDOW = window
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        _LOGGER.info(
+            "Profiles are written to %r, send signal %d for a CPU profile or %d for a memory profile",
+            directory,
+            CPU_PROFILE_SIGNAL,
+            MEMORY_PROFILE_SIGNAL,
+        )
+
+
+def profiling_enabled() -> bool:
+    """Check whether profiling was configured."""
+    return _PROFILE_DIR is not None
+
+
+@contextlib.contextmanager
+def track_in_flight(kind: str, **details: Any) -> Iterator[None]:
+    """Track an item being processed so that it is listed in dumps of items in flight."""
+    key = next(_IN_FLIGHT_KEYS)
+    _IN_FLIGHT[key] = {"kind": kind, "started": time.time(), "thread": threading.current_thread().name, **details}
+    try:
+        yield
+    finally:
+        _IN_FLIGHT.pop(key, None)
+
+
+def _profile_path(kind: str, extension: str) -> str:
+    """Compute path of a profile of the given kind taken by this process."""
+    process = multiprocessing.current_process().name
+    now = time.time()
+    timestamp = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}"
+    return os.path.join(_PROFILE_DIR, f"{kind}-{process}-{os.getpid()}-{timestamp}.{extension}")
+
+
+def dump_in_flight() -> str:
+    """Write items currently processed by this process as JSON, return path to the file written."""
+    now = time.time()
+    items = [dict(item, age=round(now - item["started"], 3)) for item in dict(_IN_FLIGHT).values()]
+    path = _profile_path("inflight", "json")
+    with open(path, "w") as dump_file:
+        json.dump(sorted(items, key=lambda item: item["started"]), dump_file, indent=2, default=str)
+
+    return path
+
+
+def _sample_cpu(window: float) -> str:
+    """Sample stacks of all the threads for the given number of seconds, write them in the collapsed stack format.
+
+    Each line holds frames of a stack separated by semicolons and the number of samples the stack was seen in, as
+    expected by flame graph tools.
+    """
+    samples: Counter = Counter()
+    me = threading.get_ident()
+    threads = {}
+    deadline = time.monotonic() + window
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            if ident not in threads:
+                threads = {thread.ident: thread.name for thread in threading.enumerate()}
+            stack.append(threads.get(ident, str(ident)))
+            samples[";".join(reversed(stack))] += 1
+
+        time.sleep(_SAMPLING_INTERVAL)
+
+    path = _profile_path("cpu", "collapsed")
+    with open(path, "w") as profile_file:
+        for stack, count in samples.most_common():
+            profile_file.write(f"{stack} {count}\n")
+
+    return path
+
+
+def _trace_memory(window: float) -> str:
+    """Trace memory allocations for the given number of seconds, write top allocators."""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(_TRACEBACK_DEPTH)
+        time.sleep(window)
+
+    try:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            )
+        )
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    path = _profile_path("memory", "txt")
+    with open(path, "w") as profile_file:
+        profile_file.write(f"Top {_TOP_ALLOCATIONS} allocations by line:\n")
+        for statistic in snapshot.statistics("lineno")[:_TOP_ALLOCATIONS]:
+            profile_file.write(f"{statistic}\n")
+
+        profile_file.write("\nTop 10 allocations by traceback:\n")
+        for statistic in snapshot.statistics("traceback")[:10]:
+            profile_file.write(f"\n{statistic}\n")
+            for line in statistic.traceback.format():
+                profile_file.write(f"{line}\n")
+
+    return path
+
+
+def _run_profile(kind: str, profile: Callable[[float], str]) -> None:
+    """Take a profile of the given kind in a background thread, unless one is already running."""
+    lock = _RUNNING[kind]
+    if not lock.acquire(blocking=False):
+        _LOGGER.warning("A %s profile is already being taken, ignoring the request", kind)
+        return
+
+    def run() -> None:
+        try:
+            _LOGGER.info("Taking %s profile for %.1f seconds", kind, _PROFILE_WINDOW)
+            _LOGGER.info("The %s profile was written to %r", kind, profile(_PROFILE_WINDOW))
+        except Exception as exc:
+            _LOGGER.exception("Failed to take %s profile: %s", kind, str(exc))
+        finally:
+            lock.release()
+
+    threading.Thread(target=run, name=f"{kind}-profiler", daemon=True).start()
+
+
+def _handle_signal(signum: int, _: Any) -> None:
+    """Dump items in flight and start the profile requested by the given signal."""
+    try:
+        _LOGGER.info("Items in flight were written to %r", dump_in_flight())
+    except OSError as exc:
+        _LOGGER.error("Failed to dump items in flight: %s", str(exc))
+
+    if signum == CPU_PROFILE_SIGNAL:
+        _run_profile("cpu", _sample_cpu)
+    else:
+        _run_profile("memory", _trace_memory)
+
+
+def install_profiling_handlers(forward: Optional[Callable[[int], None]] = None) -> None:
+    """Install signal handlers taking profiles of this process, if profiling is configured.
+
+    Signals received can be forwarded using the given callback, e.g. to child processes.
+    """
+    if not profiling_enabled():
+        return
+
+    def handler(signum: int, frame: Any) -> None:
+        if forward:
+            forward(signum)
+        _handle_signal(signum, frame)
+
+    for signum in (CPU_PROFILE_SIGNAL, MEMORY_PROFILE_SIGNAL):
+        signal.signal(signum, handler)
+
+
+def _reset_profiling() -> None:
+    """Drop state inherited from the parent process, items in flight and profiles belong to the parent."""
+    global _RUNNING
+
+    _IN_FLIGHT.clear()
+    _RUNNING = {"cpu": threading.Lock(), "memory": threading.Lock()}
+
+
+os.register_at_fork(after_in_child=_reset_profiling)
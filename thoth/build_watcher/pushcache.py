@@ -0,0 +1,170 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Memoization of image pushes to the push registry."""
+
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+from .cache import TTLCache
+from .metrics import METRIC_PUSH_CACHE_HITS
+from .metrics import METRIC_PUSHES_COALESCED
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PushCache:
+    """Remember images already pushed to the push registry and coalesce concurrent pushes of the same image.
+
+    If the cache is backed by a database, pushes of the same image are serialized across worker processes using
+    file locks stored next to the database so that only one process copies the image and the others reuse its
+    result. Within a process, pushes driven by an event loop or by threads wait on the push already in flight.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 86400, path: Optional[str] = None) -> None:
+        """Create the cache, entries are shared across processes if a path to the cache database is given."""
+        self._cache = TTLCache(max_size=max_size, ttl=ttl, path=path, table="pushed")
+        self._lock_dir = f"{path}.locks" if path else None
+        self._in_flight: Dict[str, "asyncio.Future[Optional[str]]"] = {}
+        self._in_flight_threads: Dict[str, "Future[Optional[str]]"] = {}
+        self._in_flight_threads_lock = threading.Lock()
+        if self._lock_dir:
+            os.makedirs(self._lock_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image: str, digest: Optional[str], push_registry: str) -> str:
+        """Construct cache key for the given source image pushed into the push registry."""
+        return f"push:{push_registry}:{image}@{digest or ''}"
+
+    def _hit(self, key: str) -> Optional[str]:
+        """Get reference of an image already pushed under the given key."""
+        pushed = self._cache.get(key)
+        if pushed:
+            METRIC_PUSH_CACHE_HITS.inc()
+            _LOGGER.info("Image %r was already pushed as %r, not pushing it again", key, pushed)
+        return pushed
+
+    @contextlib.contextmanager
+    def _file_lock(self, key: str) -> Iterator[None]:
+        """Hold an exclusive lock for the given key across worker processes, no-op if the cache is not shared."""
+        if not self._lock_dir:
+            yield
+            return
+
+        path = os.path.join(self._lock_dir, hashlib.sha256(key.encode()).hexdigest())
+        with open(path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def push(self, key: str, push: Callable[[], Optional[str]]) -> Optional[str]:
+        """Push an image using the given callable unless it was already pushed or is being pushed by another thread.
+
+        Return the pushed reference.
+        """
+        pushed = self._hit(key)
+        if pushed:
+            return pushed
+
+        with self._in_flight_threads_lock:
+            in_flight = self._in_flight_threads.get(key)
+            if in_flight is None:
+                future: "Future[Optional[str]]" = Future()
+                self._in_flight_threads[key] = future
+
+        if in_flight is not None:
+            METRIC_PUSHES_COALESCED.inc()
+            return in_flight.result()
+
+        pushed = None
+        try:
+            with self._file_lock(key):
+                # Another worker might have pushed the image while waiting for the lock.
+                pushed = self._hit(key)
+                if pushed:
+                    return pushed
+
+                pushed = push()
+                if pushed:
+                    self._cache.set(key, pushed)
+        finally:
+            with self._in_flight_threads_lock:
+                del self._in_flight_threads[key]
+            # Waiters treat a failed push as an image which cannot be pushed, the error is raised to the pusher only.
+            future.set_result(pushed)
+
+        return pushed
+
+    async def push_async(self, key: str, push: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """Push an image using the given coroutine function unless it was already pushed or is being pushed.
+
+        Lookups in the cache database and file locks block, they are done in an executor.
+        """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            METRIC_PUSHES_COALESCED.inc()
+            return await asyncio.shield(in_flight)
+
+        loop = asyncio.get_running_loop()
+        # Registered before the lookup so that pushes of the same image started meanwhile wait for this one.
+        future = self._in_flight[key] = loop.create_future()
+        pushed = None
+        try:
+            pushed = await loop.run_in_executor(None, self._hit, key)
+            if not pushed:
+                pushed = await self._push_locked(key, push)
+        finally:
+            del self._in_flight[key]
+            # Waiters treat a failed push as an image which cannot be pushed, the error is raised to the pusher only.
+            future.set_result(pushed)
+
+        return pushed
+
+    async def _push_locked(self, key: str, push: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """Push under the cross-process lock, the lock is acquired and released in an executor."""
+        loop = asyncio.get_running_loop()
+        lock = self._file_lock(key)
+        acquired = loop.run_in_executor(None, lock.__enter__)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            acquired.add_done_callback(lambda _: lock.__exit__(None, None, None))
+            raise
+
+        try:
+            pushed = await loop.run_in_executor(None, self._hit, key)
+            if pushed:
+                return pushed
+
+            pushed = await push()
+            if pushed:
+                await loop.run_in_executor(None, self._cache.set, key, pushed)
+            return pushed
+        finally:
+            await asyncio.shield(loop.run_in_executor(None, lock.__exit__, None, None, None))
@@ -0,0 +1,64 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Recording of build events and stage timings into a trace which can be replayed by benchmarks."""
+
+import json
+import logging
+import os
+import time
+from typing import Any
+from typing import Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+_TRACE_PATH: Optional[str] = None
+# File descriptor of the trace opened by this process, processes forked later open their own.
+_TRACE_FD: Optional[int] = None
+_TRACE_FD_PID: Optional[int] = None
+
+
+def configure_recording(path: Optional[str]) -> None:
+    """Record into the given trace file, to be done before processes are forked; None turns recording off."""
+    global _TRACE_PATH, _TRACE_FD, _TRACE_FD_PID
+
+    if _TRACE_FD is not None and _TRACE_FD_PID == os.getpid():
+        os.close(_TRACE_FD)
+    _TRACE_FD = _TRACE_FD_PID = None
+
+    _TRACE_PATH = path
+    if path:
+        _LOGGER.info("Recording build events and stage timings to %r", path)
+
+
+def record(kind: str, **fields: Any) -> None:
+    """Append a record of the given kind to the trace, if recording is configured.
+
+    Each record is written using a single append so that records of concurrent processes are not interleaved.
+    """
+    global _TRACE_FD, _TRACE_FD_PID
+
+    if not _TRACE_PATH:
+        return
+
+    line = json.dumps({"t": round(time.time(), 3), "kind": kind, **fields}, separators=(",", ":")) + "\n"
+    try:
+        if _TRACE_FD_PID != os.getpid():
+            _TRACE_FD = os.open(_TRACE_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            _TRACE_FD_PID = os.getpid()
+        os.write(_TRACE_FD, line.encode("utf-8"))
+    except OSError as exc:
+        _LOGGER.warning("Failed to write to trace %r: %s", _TRACE_PATH, str(exc))
@@ -0,0 +1,394 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""A layer-aware container image copy talking the OCI distribution API directly."""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_LOGGER = logging.getLogger(__name__)
+
+_MANIFEST_LIST_MEDIA_TYPES = frozenset(
+    (
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+    )
+)
+_MANIFEST_MEDIA_TYPES = frozenset(
+    (
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    )
+)
+_DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+_CHALLENGE_PARAMETER_RE = re.compile(r'(\w+)="([^"]*)"')
+# Lifetime of bearer tokens not stating expires_in, as defined by the distribution spec.
+_TOKEN_DEFAULT_EXPIRES_IN = 60
+# Tokens are refreshed this number of seconds before they expire (at most half of their lifetime).
+_TOKEN_EXPIRY_MARGIN = 10
+
+_CLIENTS: Dict[Tuple[str, Optional[str], Optional[str], bool], "RegistryClient"] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+class RegistryError(Exception):
+    """An error raised when communicating with a container image registry."""
+
+
+class UnsupportedManifestError(RegistryError):
+    """An error raised if manifest of the copied image cannot be handled."""
+
+
+def parse_reference(image: str) -> Tuple[str, str, str]:
+    """Parse the given image reference into registry, repository and tag or digest."""
+    name, _, digest = image.partition("@")
+    if not digest:
+        registry_part = name.rsplit("/", maxsplit=1)
+        if ":" in registry_part[-1]:
+            name, _, tag = name.rpartition(":")
+        else:
+            tag = "latest"
+
+    registry, _, repository = name.partition("/")
+    if not repository or ("." not in registry and ":" not in registry and registry != "localhost"):
+        registry, repository = _DOCKER_HUB_REGISTRY, name
+        if "/" not in repository:
+            repository = f"library/{repository}"
+
+    return registry, repository, digest or tag
+
+
+class RegistryClient:
+    """A client for one registry, connections and bearer tokens are reused across requests."""
+
+    def __init__(
+        self,
+        registry: str,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        verify_tls: bool = True,
+        pool_size: int = 16,
+    ) -> None:
+        """Create a client with a pool of connections to the given registry."""
+        self.registry = registry
+        self.verify_tls = verify_tls
+        self._credentials = (user or "build-watcher", password or "") if (user or password) else None
+        # Bearer tokens with the time they are refreshed at and the challenge they were obtained for, per scope.
+        self._tokens: Dict[str, Tuple[str, float, str]] = {}
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    @classmethod
+    def get(
+        cls, registry: str, user: Optional[str] = None, password: Optional[str] = None, verify_tls: bool = True
+    ) -> "RegistryClient":
+        """Get a client for the given registry shared in this process."""
+        key = (registry, user, password, verify_tls)
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = cls(registry, user, password, verify_tls)
+            return client
+
+    def _url(self, path: str) -> str:
+        """Construct URL to the registry API."""
+        scheme = "http" if self.registry.startswith("localhost") or self.registry.startswith("127.") else "https"
+        return f"{scheme}://{self.registry}/v2/{path}"
+
+    def _fetch_token(self, challenge: str, scopes: List[str]) -> Tuple[str, float, str]:
+        """Obtain a bearer token based on the authentication challenge provided by the registry.
+
+        Return the token, the time it needs to be refreshed at and the challenge to refresh it with.
+        """
+        parameters = dict(_CHALLENGE_PARAMETER_RE.findall(challenge))
+        query = [("service", parameters["service"])] if "service" in parameters else []
+        query.extend(("scope", scope) for scope in scopes)
+        response = self._session.get(
+            f"{parameters['realm']}?{urlencode(query)}", auth=self._credentials, verify=self.verify_tls
+        )
+        response.raise_for_status()
+        content = response.json()
+        expires_in = content.get("expires_in") or _TOKEN_DEFAULT_EXPIRES_IN
+        refresh_at = time.monotonic() + max(expires_in - _TOKEN_EXPIRY_MARGIN, expires_in / 2)
+        return content.get("token") or content["access_token"], refresh_at, challenge
+
+    def _token(self, scope_key: str, scopes: List[str]) -> Optional[str]:
+        """Get bearer token for the given scopes, a token about to expire is refreshed before it is used."""
+        entry = self._tokens.get(scope_key)
+        if entry is None:
+            return None
+
+        token, refresh_at, challenge = entry
+        if time.monotonic() >= refresh_at:
+            _LOGGER.debug("Refreshing bearer token for registry %r and scope %r", self.registry, scope_key)
+            token, refresh_at, challenge = self._tokens[scope_key] = self._fetch_token(challenge, scopes)
+
+        return token
+
+    def request(self, method: str, path_or_url: str, scopes: List[str], **kwargs: Any) -> requests.Response:
+        """Perform an authenticated request, authentication is negotiated on the first request for the given scope.
+
+        Requests rejected with 401 are retried once with a new token, except for requests streaming their body
+        from a file-like object - the body was consumed, the caller retries with a new one.
+        """
+        url = path_or_url if "://" in path_or_url else self._url(path_or_url)
+        scope_key = " ".join(scopes)
+        headers = kwargs.pop("headers", {})
+        replayable = not hasattr(kwargs.get("data"), "read")
+
+        for attempt in range(2):
+            auth = None
+            token = self._token(scope_key, scopes)
+            if token:
+                headers["Authorization"] = f"Bearer {token}"
+            elif self._credentials:
+                auth = self._credentials
+
+            response = self._session.request(method, url, headers=headers, auth=auth, verify=self.verify_tls, **kwargs)
+            if response.status_code != 401 or attempt > 0:
+                return response
+
+            challenge = response.headers.get("WWW-Authenticate", "")
+            if not challenge.lower().startswith("bearer"):
+                return response
+
+            self._tokens[scope_key] = self._fetch_token(challenge, scopes)
+            if not replayable:
+                return response
+
+        return response
+
+
+def _pull_scope(repository: str) -> str:
+    """Get authorization scope for pulling from the given repository."""
+    return f"repository:{repository}:pull"
+
+
+def _push_scope(repository: str) -> str:
+    """Get authorization scope for pushing into the given repository."""
+    return f"repository:{repository}:pull,push"
+
+
+def _get_manifest(client: RegistryClient, repository: str, reference: str) -> Tuple[bytes, str]:
+    """Obtain raw manifest and its media type, raw content is kept so that digests are preserved on copy."""
+    response = client.request(
+        "GET",
+        f"{repository}/manifests/{reference}",
+        [_pull_scope(repository)],
+        headers={"Accept": ", ".join(_MANIFEST_MEDIA_TYPES | _MANIFEST_LIST_MEDIA_TYPES)},
+    )
+    if response.status_code != 200:
+        raise RegistryError(f"Failed to obtain manifest {repository}:{reference}: HTTP {response.status_code}")
+
+    media_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+    if not media_type or media_type == "application/json":
+        media_type = json.loads(response.content).get("mediaType", "")
+
+    if media_type not in _MANIFEST_MEDIA_TYPES and media_type not in _MANIFEST_LIST_MEDIA_TYPES:
+        raise UnsupportedManifestError(f"Error determining manifest MIME type, unsupported type {media_type!r}")
+
+    return response.content, media_type
+
+
+class ImageCopy:
+    """Copy one image between registries skipping layers already present in the destination."""
+
+    def __init__(
+        self,
+        source: RegistryClient,
+        destination: RegistryClient,
+        src_repository: str,
+        dst_repository: str,
+        parallelism: int = 4,
+    ) -> None:
+        """Prepare copy of an image from the source repository to the destination repository."""
+        self.source = source
+        self.destination = destination
+        self.src_repository = src_repository
+        self.dst_repository = dst_repository
+        self.parallelism = parallelism
+        self.skipped = 0
+        self.mounted = 0
+        self.uploaded = 0
+        self._lock = threading.Lock()
+
+    def _count(self, attribute: str) -> None:
+        """Increment the given statistics counter."""
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def _copy_blob(self, descriptor: Dict[str, Any]) -> None:
+        """Copy one blob, existing blobs are skipped and cross-repository mounts are used where possible."""
+        digest = descriptor["digest"]
+        dst_scopes = [_push_scope(self.dst_repository)]
+        response = self.destination.request("HEAD", f"{self.dst_repository}/blobs/{digest}", dst_scopes)
+        if response.status_code == 200:
+            self._count("skipped")
+            return
+
+        upload_url = None
+        if self.source.registry == self.destination.registry:
+            response = self.destination.request(
+                "POST",
+                f"{self.dst_repository}/blobs/uploads/?" + urlencode({"mount": digest, "from": self.src_repository}),
+                dst_scopes + [_pull_scope(self.src_repository)],
+            )
+            if response.status_code == 201:
+                self._count("mounted")
+                return
+            if response.status_code == 202:
+                # The registry refused to mount the blob and started an upload session instead.
+                upload_url = response.headers["Location"]
+
+        if upload_url is None:
+            response = self.destination.request("POST", f"{self.dst_repository}/blobs/uploads/", dst_scopes)
+            if response.status_code != 202:
+                raise RegistryError(f"Failed to start upload of blob {digest}: HTTP {response.status_code}")
+            upload_url = response.headers["Location"]
+
+        if upload_url.startswith("/"):
+            upload_url = self.destination._url(upload_url[len("/v2/") :])
+
+        separator = "&" if "?" in upload_url else "?"
+        for attempt in range(2):
+            with self.source.request(
+                "GET", f"{self.src_repository}/blobs/{digest}", [_pull_scope(self.src_repository)], stream=True
+            ) as blob:
+                if blob.status_code != 200:
+                    raise RegistryError(f"Failed to download blob {digest}: HTTP {blob.status_code}")
+
+                response = self.destination.request(
+                    "PUT",
+                    f"{upload_url}{separator}{urlencode({'digest': digest})}",
+                    dst_scopes,
+                    data=blob.raw,
+                    headers={"Content-Type": "application/octet-stream", "Content-Length": str(descriptor["size"])},
+                )
+
+            # The token was rejected and the blob stream consumed, the blob is downloaded again for the retry.
+            if response.status_code != 401 or attempt > 0:
+                break
+
+        if response.status_code != 201:
+            raise RegistryError(f"Failed to upload blob {digest}: HTTP {response.status_code}")
+
+        self._count("uploaded")
+
+    def _put_manifest(self, reference: str, content: bytes, media_type: str) -> None:
+        """Push the given raw manifest to the destination."""
+        response = self.destination.request(
+            "PUT",
+            f"{self.dst_repository}/manifests/{reference}",
+            [_push_scope(self.dst_repository)],
+            data=content,
+            headers={"Content-Type": media_type},
+        )
+        if response.status_code not in (200, 201):
+            raise RegistryError(
+                f"Failed to push manifest {self.dst_repository}:{reference}: HTTP {response.status_code}"
+            )
+
+    def _copy_manifest(self, reference: str, dst_reference: str, executor: ThreadPoolExecutor) -> bytes:
+        """Copy manifest (and all the blobs or manifests it references) to the destination, return raw manifest."""
+        content, media_type = _get_manifest(self.source, self.src_repository, reference)
+        manifest = json.loads(content)
+
+        if media_type in _MANIFEST_LIST_MEDIA_TYPES:
+            for child in manifest.get("manifests", []):
+                self._copy_manifest(child["digest"], child["digest"], executor)
+        else:
+            blobs = [manifest["config"]] + manifest.get("layers", [])
+            for future in [executor.submit(self._copy_blob, blob) for blob in blobs]:
+                future.result()
+
+        self._put_manifest(dst_reference, content, media_type)
+        return content
+
+    def run(self, src_reference: str, dst_reference: str) -> str:
+        """Perform the copy, return digest of the copied manifest."""
+        with ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix="blob-copy") as executor:
+            content = self._copy_manifest(src_reference, dst_reference, executor)
+
+        return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+def copy_image(
+    image: str,
+    output: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+    parallelism: int = 4,
+) -> str:
+    """Copy the given image to the output reference, return digest of the copied manifest."""
+    src_registry, src_repository, src_reference = parse_reference(image)
+    dst_registry, dst_repository, dst_reference = parse_reference(output)
+
+    source = RegistryClient.get(src_registry, src_registry_user, src_registry_password, src_verify_tls)
+    destination = RegistryClient.get(dst_registry, dst_registry_user, dst_registry_password, dst_verify_tls)
+    image_copy = ImageCopy(source, destination, src_repository, dst_repository, parallelism)
+    digest = image_copy.run(src_reference, dst_reference)
+    _LOGGER.debug(
+        "Copied %r to %r (%s): %d blobs already present, %d mounted, %d uploaded",
+        image,
+        output,
+        digest,
+        image_copy.skipped,
+        image_copy.mounted,
+        image_copy.uploaded,
+    )
+    return digest
+
+
+def manifest_digest(
+    image: str, user: Optional[str] = None, password: Optional[str] = None, verify_tls: bool = True
+) -> str:
+    """Resolve digest of the manifest the given image reference points to without downloading it."""
+    registry, repository, reference = parse_reference(image)
+    if reference.startswith("sha256:"):
+        return reference
+
+    client = RegistryClient.get(registry, user, password, verify_tls)
+    response = client.request(
+        "HEAD",
+        f"{repository}/manifests/{reference}",
+        [_pull_scope(repository)],
+        headers={"Accept": ", ".join(_MANIFEST_MEDIA_TYPES | _MANIFEST_LIST_MEDIA_TYPES)},
+    )
+    digest = response.headers.get("Docker-Content-Digest")
+    if response.status_code != 200 or not digest:
+        raise RegistryError(f"Failed to resolve digest of {image}: HTTP {response.status_code}")
+
+    return digest
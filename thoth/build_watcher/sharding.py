@@ -0,0 +1,361 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Splitting of builds across multiple build-watcher replicas."""
+
+import bisect
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timezone
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from openshift.dynamic.exceptions import ConflictError
+from openshift.dynamic.exceptions import NotFoundError
+
+from .metrics import METRIC_SHARD_MEMBERS
+
+_LOGGER = logging.getLogger(__name__)
+
+SHARD_CLAIM_ANNOTATION = "thoth-station.ninja/build-watcher-claimed-by"
+SHARD_GROUP_LABEL = "thoth-station.ninja/build-watcher-group"
+
+_LEASE_NAME_RE = re.compile(r"[^a-z0-9.-]")
+_MICRO_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+_SERVICE_ACCOUNT_NAMESPACE_PATH = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+
+
+def _hash(value: str) -> int:
+    """Hash the given value onto the ring."""
+    return int(hashlib.sha1(value.encode()).hexdigest()[:16], 16)
+
+
+def shard_key(descriptor: Dict[str, Any]) -> str:
+    """Get key of the given build descriptor used to assign the build to a replica."""
+    return f"{descriptor.get('namespace')}/{descriptor.get('build_uid')}"
+
+
+class HashRing:
+    """A consistent hash ring, only keys of a joining or leaving member change their owner."""
+
+    def __init__(self, members: Iterable[str], replicas: int = 64) -> None:
+        """Create the ring, each member is placed on the ring the given number of times to spread keys evenly."""
+        self.members = frozenset(members)
+        self._ring: List[Tuple[int, str]] = sorted(
+            (_hash(f"{member}#{replica}"), member) for member in self.members for replica in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    def owner(self, key: str) -> Optional[str]:
+        """Get member owning the given key."""
+        if not self._ring:
+            return None
+
+        index = bisect.bisect(self._points, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class DirectoryMembership:
+    """A stand-in for Lease objects using files on a volume shared by all the replicas.
+
+    Each member keeps a file with its identity, the modification time of the file is its heartbeat. Builds are
+    claimed by exclusively creating a file named after the build.
+    """
+
+    # Claims are kept for this number of seconds.
+    _CLAIM_TTL = 7 * 86400
+
+    def __init__(self, directory: str, identity: str, lease_duration: float = 30) -> None:
+        """Create the membership, directories are created if they do not exist."""
+        self.identity = identity
+        self.lease_duration = lease_duration
+        self._members_dir = os.path.join(directory, "members")
+        self._claims_dir = os.path.join(directory, "claims")
+        self._last_cleanup = 0.0
+        os.makedirs(self._members_dir, exist_ok=True)
+        os.makedirs(self._claims_dir, exist_ok=True)
+
+    def renew(self) -> None:
+        """Renew membership of this replica."""
+        with open(os.path.join(self._members_dir, self.identity), "w") as member_file:
+            member_file.write(self.identity)
+
+        if time.time() - self._last_cleanup > 3600:
+            self._last_cleanup = time.time()
+            for entry in os.scandir(self._claims_dir):
+                if entry.stat().st_mtime < self._last_cleanup - self._CLAIM_TTL:
+                    os.remove(entry.path)
+
+    def members(self) -> List[str]:
+        """List identities of live members."""
+        deadline = time.time() - self.lease_duration
+        return [entry.name for entry in os.scandir(self._members_dir) if entry.stat().st_mtime > deadline]
+
+    def leave(self) -> None:
+        """Remove this replica from members."""
+        try:
+            os.remove(os.path.join(self._members_dir, self.identity))
+        except FileNotFoundError:
+            pass
+
+    def _claim_path(self, descriptor: Dict[str, Any]) -> str:
+        """Get path to the file claiming the given build."""
+        return os.path.join(self._claims_dir, hashlib.sha1(shard_key(descriptor).encode()).hexdigest())
+
+    def claimed(self, descriptor: Dict[str, Any]) -> bool:
+        """Check whether the given build was claimed by any replica."""
+        return os.path.exists(self._claim_path(descriptor))
+
+    def claim(self, descriptor: Dict[str, Any]) -> bool:
+        """Claim the given build for this replica, return False if the build was claimed by another replica."""
+        path = self._claim_path(descriptor)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            with open(path) as claim_file:
+                return claim_file.read() == self.identity
+
+        with os.fdopen(fd, "w") as claim_file:
+            claim_file.write(self.identity)
+        return True
+
+
+class LeaseMembership:
+    """Membership based on coordination.k8s.io Lease objects, builds are claimed by annotating them.
+
+    Each member renews its own Lease labeled with the group of replicas. A claim is a merge patch of the Build
+    annotation conditioned on the resourceVersion read, so that two replicas cannot claim the same build.
+    """
+
+    def __init__(
+        self,
+        openshift: Any,
+        namespace: Optional[str],
+        identity: str,
+        group: str = "build-watcher",
+        lease_duration: float = 30,
+    ) -> None:
+        """Create the membership in the given namespace, defaults to the namespace this replica runs in."""
+        self.identity = identity
+        self.lease_duration = lease_duration
+        if not namespace:
+            with open(_SERVICE_ACCOUNT_NAMESPACE_PATH) as namespace_file:
+                namespace = namespace_file.read().strip()
+        self.namespace = namespace
+        self.group = group
+        self._lease_name = _LEASE_NAME_RE.sub("-", f"{group}-{identity}".lower())[:253]
+        self._v1_lease = openshift.ocp_client.resources.get(api_version="coordination.k8s.io/v1", kind="Lease")
+        self._v1_build = openshift.ocp_client.resources.get(api_version="build.openshift.io/v1", kind="Build")
+
+    def renew(self) -> None:
+        """Renew membership of this replica, the Lease is created if it does not exist."""
+        now = datetime.now(timezone.utc).strftime(_MICRO_TIME_FORMAT)
+        body = {
+            "apiVersion": "coordination.k8s.io/v1",
+            "kind": "Lease",
+            "metadata": {"name": self._lease_name, "labels": {SHARD_GROUP_LABEL: self.group}},
+            "spec": {
+                "holderIdentity": self.identity,
+                "leaseDurationSeconds": int(self.lease_duration),
+                "renewTime": now,
+            },
+        }
+        try:
+            self._v1_lease.patch(body=body, namespace=self.namespace, content_type="application/merge-patch+json")
+        except NotFoundError:
+            body["spec"]["acquireTime"] = now
+            self._v1_lease.create(body=body, namespace=self.namespace)
+
+    def members(self) -> List[str]:
+        """List identities of live members."""
+        now = datetime.now(timezone.utc)
+        result = []
+        leases = self._v1_lease.get(namespace=self.namespace, label_selector=f"{SHARD_GROUP_LABEL}={self.group}")
+        for lease in leases.to_dict().get("items") or []:
+            spec = lease.get("spec") or {}
+            if not spec.get("holderIdentity") or not spec.get("renewTime"):
+                continue
+
+            renewed = datetime.strptime(spec["renewTime"], _MICRO_TIME_FORMAT).replace(tzinfo=timezone.utc)
+            if (now - renewed).total_seconds() < spec.get("leaseDurationSeconds", self.lease_duration):
+                result.append(spec["holderIdentity"])
+
+        return result
+
+    def leave(self) -> None:
+        """Remove Lease of this replica."""
+        try:
+            self._v1_lease.delete(name=self._lease_name, namespace=self.namespace)
+        except NotFoundError:
+            pass
+
+    @staticmethod
+    def claimed(descriptor: Dict[str, Any]) -> bool:
+        """Check whether the given build was claimed by any replica, claims are observed on build events."""
+        return bool(descriptor.get("claimed_by"))
+
+    def claim(self, descriptor: Dict[str, Any]) -> bool:
+        """Claim the given build for this replica, return False if the build was claimed by another replica."""
+        name, namespace = descriptor["name"], descriptor["namespace"]
+        for _ in range(3):
+            build = self._v1_build.get(name=name, namespace=namespace).to_dict()
+            claimed_by = (build["metadata"].get("annotations") or {}).get(SHARD_CLAIM_ANNOTATION)
+            if claimed_by:
+                return claimed_by == self.identity
+
+            body = {
+                "metadata": {
+                    "name": name,
+                    "resourceVersion": build["metadata"]["resourceVersion"],
+                    "annotations": {SHARD_CLAIM_ANNOTATION: self.identity},
+                }
+            }
+            try:
+                self._v1_build.patch(body=body, namespace=namespace, content_type="application/merge-patch+json")
+                return True
+            except ConflictError:
+                # The build was modified in the meanwhile, check the claim again.
+                continue
+
+        return False
+
+
+def shard_membership(
+    mode: str,
+    openshift: Any,
+    namespace: Optional[str],
+    identity: str,
+    *,
+    directory: Optional[str] = None,
+    group: str = "build-watcher",
+    lease_duration: float = 30,
+) -> Any:
+    """Create membership of this replica in the group of replicas based on the sharding mode."""
+    if mode == "lease":
+        return LeaseMembership(openshift, namespace, identity, group, lease_duration)
+
+    if mode == "directory":
+        if not directory:
+            raise ValueError("Sharding using a directory requires a shard directory to be configured")
+        return DirectoryMembership(os.path.join(directory, group), identity, lease_duration)
+
+    raise ValueError(f"Unknown sharding mode {mode!r}")
+
+
+class ShardCoordinator:
+    """Decide which replica handles which build using consistent hashing over live members.
+
+    All the replicas watch all the builds. Builds owned by other replicas are remembered for a grace period so
+    that they can be adopted if their owner leaves before claiming them. A build is handled only by the replica
+    which successfully claims it, so a build is not handled twice even while replicas join or leave.
+    """
+
+    def __init__(
+        self,
+        membership: Any,
+        adopt: Callable[[Dict[str, Any]], None],
+        *,
+        grace_period: Optional[float] = None,
+        max_deferred: int = 65536,
+    ) -> None:
+        """Join the group of replicas, adopted builds are handed over to the given callback."""
+        self.identity = membership.identity
+        self._membership = membership
+        self._adopt = adopt
+        self._grace_period = grace_period or 10 * membership.lease_duration
+        self._max_deferred = max_deferred
+        self._deferred: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._membership.renew()
+        self._ring = HashRing(set(self._membership.members()) | {self.identity})
+        _LOGGER.info("Joined shard group as %r, members are %r", self.identity, sorted(self._ring.members))
+        threading.Thread(target=self._heartbeat, name="shard-heartbeat", daemon=True).start()
+
+    def accept(self, descriptor: Dict[str, Any]) -> bool:
+        """Check whether this replica should handle the given build."""
+        key = shard_key(descriptor)
+        with self._lock:
+            if self._membership.claimed(descriptor):
+                self._deferred.pop(key, None)
+                return False
+
+            if self._ring.owner(key) == self.identity:
+                self._deferred.pop(key, None)
+                return True
+
+            self._deferred[key] = (descriptor, time.monotonic() + self._grace_period)
+            self._deferred.move_to_end(key)
+            while len(self._deferred) > self._max_deferred:
+                self._deferred.popitem(last=False)
+
+        return False
+
+    def claim(self, descriptor: Dict[str, Any]) -> bool:
+        """Claim the given build right before handling it, False if another replica claimed it."""
+        try:
+            claimed = self._membership.claim(descriptor)
+        except Exception as exc:
+            _LOGGER.exception("Failed to claim build %r, it is not handled: %s", descriptor.get("name"), str(exc))
+            return False
+
+        if not claimed:
+            _LOGGER.info("Build %r was claimed by another replica", descriptor.get("name"))
+        return claimed
+
+    def _heartbeat(self) -> None:
+        """Renew membership and rebalance builds on membership changes, periodically."""
+        while True:
+            time.sleep(self._membership.lease_duration / 3)
+            self._rebalance()
+
+    def _rebalance(self) -> None:
+        """Renew membership, rebuild the ring if members changed and adopt deferred builds this replica owns now."""
+        try:
+            self._membership.renew()
+            members = set(self._membership.members()) | {self.identity}
+        except Exception as exc:
+            _LOGGER.exception("Failed to renew membership in the shard group: %s", str(exc))
+            return
+
+        METRIC_SHARD_MEMBERS.set(len(members))
+        adopted = []
+        with self._lock:
+            if members != self._ring.members:
+                _LOGGER.info("Shard group members changed to %r", sorted(members))
+                self._ring = HashRing(members)
+
+            now = time.monotonic()
+            for key, (descriptor, deadline) in list(self._deferred.items()):
+                if deadline < now or self._membership.claimed(descriptor):
+                    del self._deferred[key]
+                elif self._ring.owner(key) == self.identity:
+                    del self._deferred[key]
+                    adopted.append(descriptor)
+
+        for descriptor in adopted:
+            _LOGGER.info("Adopting build %r of a replica which left", descriptor.get("name"))
+            self._adopt(descriptor)
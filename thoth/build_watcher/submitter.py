@@ -0,0 +1,985 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Push images to a push registry and submit them together with build logs to Thoth for analysis."""
+
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue
+from multiprocessing.synchronize import Event
+from queue import Empty
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from thamos.lib import build_analysis
+from thamos.config import config as configuration
+from thamos.swagger_client import ApiClient
+from thamos.swagger_client import Configuration
+from thoth.analyzer import run_command
+from thoth.analyzer import CommandError
+
+from .buildlog import BuildLogSpool
+from .buildlog import build_log_digest
+from .cache import TTLCache
+from .limiter import AdaptiveLimiter
+from .limiter import TokenBucket
+from .metrics import METRIC_BUILD_LOGS_SUBMITTED
+from .metrics import METRIC_DEDUP_CACHE_HITS
+from .metrics import METRIC_DEDUP_CACHE_MISSES
+from .metrics import METRIC_IMAGES_PUSHED_REGISTRY
+from .metrics import METRIC_IMAGES_SUBMITTED
+from .metrics import push_metrics
+from .pushcache import PushCache
+from .registry import manifest_digest
+from .supervisor import SubmissionStats
+from .tracing import stage
+from .tracing import submission_context
+from .workspool import WorkSpool
+from .workspool import is_transient
+from .registry import UnsupportedManifestError
+from .registry import copy_image
+
+_LOGGER = logging.getLogger(__name__)
+
+_HERE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_SKOPEO_EXEC_PATH = os.getenv("SKOPEO_EXEC_PATH", os.path.join(_HERE_DIR, "bin", "skopeo"))
+# How often a worker asked to stop checks whether there is still work queued, in seconds.
+_STOP_POLL_INTERVAL = 1.0
+
+_API_URL: Optional[str] = None
+_API_CLIENT: Optional[ApiClient] = None
+_API_CLIENT_LOCK = threading.Lock()
+
+
+def discover_thoth_api() -> str:
+    """Discover URL of Thoth User API once, processes forked afterwards inherit the result."""
+    global _API_URL
+
+    if _API_URL is None:
+        host = configuration.explicit_host
+        if not host:
+            configuration.load_config()
+            host = configuration.content.get("host") or Configuration().host
+        _API_URL = configuration.api_discovery(host)
+
+    return _API_URL
+
+
+def thoth_api_client() -> ApiClient:
+    """Get an API client with a connection pool shared by all the submissions done in this process."""
+    global _API_CLIENT
+
+    with _API_CLIENT_LOCK:
+        if _API_CLIENT is None:
+            config = Configuration()
+            config.host = discover_thoth_api()
+            config.verify_ssl = configuration.tls_verify
+            _API_CLIENT = ApiClient(configuration=config)
+
+    return _API_CLIENT
+
+
+def _reset_api_client() -> None:
+    """Drop the API client inherited from the parent process, its connections cannot be shared across processes."""
+    global _API_CLIENT, _API_CLIENT_LOCK
+
+    _API_CLIENT = None
+    _API_CLIENT_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_api_client)
+
+
+def image_digest(image: Optional[str], digest: Optional[str] = None) -> Optional[str]:
+    """Get a key identifying the given image in the cache of submitted artifacts, prefer manifest digest if known."""
+    if not image:
+        return None
+
+    if digest:
+        return digest
+
+    if "@" in image:
+        return image.rsplit("@", maxsplit=1)[1]
+
+    # The image is referenced by a tag, the TTL of cache entries limits for how long tag moves are not noticed.
+    return image
+
+
+def _dedup_cache_hit(dedup_cache: TTLCache, key: str, kind: str) -> bool:
+    """Check whether the given artifact was already submitted for analysis, track cache hits and misses."""
+    if key in dedup_cache:
+        METRIC_DEDUP_CACHE_HITS.labels(kind=kind).inc()
+        return True
+
+    METRIC_DEDUP_CACHE_MISSES.labels(kind=kind).inc()
+    return False
+
+
+def prepare_submission(
+    reference: Any,
+    dedup_cache: Optional[TTLCache] = None,
+    *,
+    no_base: bool = False,
+    no_output: bool = False,
+    no_build_log: bool = False,
+    force: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """Turn a reference obtained from the queue into a submission, None if there is nothing to submit."""
+    if isinstance(reference, dict):
+        build_log_reference = reference.get("build_log_reference") or {}
+        base_input_reference = reference.get("base_input_reference", None)
+        output_reference = reference.get("output_reference", None)
+        output_digest = reference.get("output_digest", None)
+        build_uid = reference.get("build_uid", None)
+        timing = {key: reference.get(key) for key in ("completion_time", "queued_at", "trace_context")}
+        timing["build_name"] = reference.get("name")
+        timing["namespace"] = reference.get("namespace")
+    else:
+        output_reference = reference
+        build_log_reference = {}
+        base_input_reference = None
+        output_digest = None
+        build_uid = None
+        timing = {}
+        _LOGGER.info("Handling analysis of image %r", reference)
+
+    output = output_reference if not no_output else None
+    build_log = build_log_reference if not no_build_log else None
+    base = base_input_reference if not no_base else None
+
+    if not build_log:
+        BuildLogSpool.discard(build_log_reference)
+
+    if not output and not build_log and not base:
+        _LOGGER.warning(
+            "Skipping %r as no input for build analysis would be sent based on limitations on "
+            "data to be sent; no base: %r, no output: %r, no build log: %r",
+            output_reference,
+            no_base,
+            no_output,
+            no_build_log,
+        )
+        return None
+
+    output_key = f"image:{image_digest(output, output_digest)}" if output else None
+    base_key = f"image:{image_digest(base)}" if base else None
+    build_log_key = f"buildlog:{build_uid}" if build_log and build_uid else None
+    if dedup_cache is not None and not force:
+        if output_key and _dedup_cache_hit(dedup_cache, output_key, "image"):
+            _LOGGER.info("Output image %r was already submitted for analysis, skipping it", output)
+            output = None
+        if base_key and _dedup_cache_hit(dedup_cache, base_key, "image"):
+            _LOGGER.info("Base image %r was already submitted for analysis, skipping it", base)
+            base = None
+        if build_log_key and _dedup_cache_hit(dedup_cache, build_log_key, "build_log"):
+            _LOGGER.info("Build log of build %r was already submitted for analysis, skipping it", build_uid)
+            BuildLogSpool.discard(build_log)
+            build_log = None
+
+        if not output and not build_log and not base:
+            _LOGGER.info("Skipping %r as all the inputs were already submitted for analysis", output_reference)
+            return None
+
+    build_log_content_key = None
+    if build_log:
+        # Large build logs are passed by reference, read them only when they are about to be submitted.
+        build_log = BuildLogSpool.load(build_log)
+        if build_log.get("log"):
+            build_log_content_key = f"buildlog-content:{build_log_digest(build_log['log'])}"
+
+    if build_log_content_key and dedup_cache is not None and not force:
+        if _dedup_cache_hit(dedup_cache, build_log_content_key, "build_log_content"):
+            _LOGGER.info(
+                "Build log of build %r matches build log document %r submitted earlier, skipping it",
+                build_uid,
+                dedup_cache.get(build_log_content_key),
+            )
+            build_log = None
+            if not output and not base:
+                _LOGGER.info("Skipping %r as all the inputs were already submitted for analysis", output_reference)
+                return None
+
+    return {
+        "output_reference": output_reference,
+        "output": output,
+        "build_log": build_log,
+        "base": base,
+        "output_key": output_key if output else None,
+        "base_key": base_key if base else None,
+        "build_log_key": build_log_key if build_log else None,
+        "build_log_content_key": build_log_content_key if build_log else None,
+        **timing,
+    }
+
+
+def record_submission(dedup_cache: Optional[TTLCache], submission: Dict[str, Any], analysis_response: Any) -> None:
+    """Remember artifacts successfully submitted for analysis so that they are not submitted again."""
+    if dedup_cache is None:
+        return
+
+    if submission["output_key"] and analysis_response.output_image_analysis:
+        dedup_cache.set(submission["output_key"], analysis_response.output_image_analysis.analysis_id or "")
+    if submission["base_key"] and analysis_response.base_image_analysis:
+        dedup_cache.set(submission["base_key"], analysis_response.base_image_analysis.analysis_id or "")
+    if submission["build_log_key"] and analysis_response.buildlog_document_id:
+        dedup_cache.set(submission["build_log_key"], analysis_response.buildlog_document_id)
+    if submission["build_log_content_key"] and analysis_response.buildlog_document_id:
+        dedup_cache.set(submission["build_log_content_key"], analysis_response.buildlog_document_id)
+
+
+def _poll(queue: Union[Queue, WorkSpool], timeout: Optional[float]) -> Optional[Tuple[Optional[int], Any]]:
+    """Get the next reference to submit with its entry id, wait at most timeout seconds (None waits forever)."""
+    if isinstance(queue, WorkSpool):
+        return queue.lease(timeout=timeout)
+
+    try:
+        return None, queue.get(timeout=timeout)
+    except Empty:
+        return None
+
+
+def _take(queue: Union[Queue, WorkSpool], stop: Optional[Event] = None) -> Optional[Tuple[Optional[int], Any]]:
+    """Get the next reference to submit, together with its entry id if it is taken from a work spool.
+
+    Once stop is set, None is returned as soon as there is nothing to take - the queue is drained first.
+    """
+    while True:
+        entry = _poll(queue, None if stop is None else _STOP_POLL_INTERVAL)
+        if entry is not None:
+            return entry
+
+        if stop.is_set():
+            return None
+
+
+def _take_batch(
+    queue: Union[Queue, WorkSpool], stop: Optional[Event], batch_size: int, batch_wait: float
+) -> List[Tuple[Optional[int], Any]]:
+    """Take up to batch_size references, wait at most batch_wait seconds for more once the first one is taken."""
+    entry = _take(queue, stop)
+    if entry is None:
+        return []
+
+    batch = [entry]
+    deadline = time.monotonic() + batch_wait
+    while len(batch) < batch_size:
+        entry = _poll(queue, max(0.0, deadline - time.monotonic()))
+        if entry is None:
+            break
+
+        batch.append(entry)
+
+    return batch
+
+
+def _settle(queue: Union[Queue, WorkSpool], entry_id: Optional[int], exc: Optional[Exception] = None) -> None:
+    """Acknowledge an entry taken from a work spool, entries which failed are retried if the failure is transient."""
+    if entry_id is None:
+        return
+
+    if exc is None:
+        queue.ack(entry_id)
+    else:
+        queue.fail(entry_id, f"{type(exc).__name__}: {exc}", retry=is_transient(exc))
+
+
+def _analysis_arguments(submission: Dict[str, Any], options: Dict[str, Any]) -> Dict[str, Any]:
+    """Compute arguments for build analysis of the given submission."""
+    base = submission["base"]
+    output = submission["output"]
+    return dict(
+        output_reference=output,
+        build_log_reference=submission["build_log"],
+        base_input_reference=base,
+        push_registry=options["push_registry"],
+        environment_type=options["environment_type"],
+        src_registry_user=options["src_registry_user"] if base else None,
+        src_registry_password=options["src_registry_password"] if base else None,
+        dst_registry_user=options["dst_registry_user"] if output else None,
+        dst_registry_password=options["dst_registry_password"] if output else None,
+        src_verify_tls=options["src_verify_tls"],
+        dst_verify_tls=options["dst_verify_tls"],
+        debug=options["debug"],
+        force=options["force"],
+        push_engine=options["push_engine"],
+        push_cache=options["push_cache"],
+        limiter=options["limiter"],
+        namespace=submission.get("namespace") or "",
+    )
+
+
+def submit_build_analysis(
+    output_reference: Optional[str] = None,
+    build_log_reference: Optional[Dict[str, Any]] = None,
+    base_input_reference: Optional[str] = None,
+    *,
+    environment_type: Optional[str] = None,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+    debug: bool = False,
+    force: bool = False,
+    shared_api_client: bool = False,
+    limiter: Optional[AdaptiveLimiter] = None,
+    namespace: str = "",
+) -> Any:
+    """Submit the given images and build log to Thoth for analysis, metrics are labeled with the build namespace."""
+    parameters = dict(
+        build_log=build_log_reference,
+        base_image=base_input_reference,
+        base_registry_password=src_registry_password,
+        base_registry_user=src_registry_user,
+        base_registry_verify_tls=src_verify_tls,
+        environment_type=environment_type,
+        nowait=True,
+        output_image=output_reference,
+        output_registry_password=dst_registry_password,
+        output_registry_user=dst_registry_user,
+        output_registry_verify_tls=dst_verify_tls,
+        force=force,
+        debug=debug,
+    )
+    with limiter.slot() if limiter else contextlib.nullcontext():
+        if shared_api_client:
+            # Avoid API discovery and a new connection pool on each request done by the thamos decorator.
+            analysis_response = build_analysis.__wrapped__(thoth_api_client(), **parameters)
+        else:
+            analysis_response = build_analysis(**parameters)
+
+    if analysis_response.base_image_analysis and analysis_response.base_image_analysis.analysis_id:
+        METRIC_IMAGES_SUBMITTED.labels(namespace=namespace).inc()
+    if analysis_response.buildlog_analysis and analysis_response.buildlog_analysis.analysis_id:
+        METRIC_BUILD_LOGS_SUBMITTED.labels(namespace=namespace).inc()
+    if analysis_response.output_image_analysis and analysis_response.output_image_analysis.analysis_id:
+        METRIC_IMAGES_SUBMITTED.labels(namespace=namespace).inc()
+
+    push_metrics()
+
+    _LOGGER.info(
+        "Successfully submitted %r, %r, build log, build log analysis to Thoth for analysis; "
+        "analysis ids respectively: %r, %r, %r, %r",
+        output_reference,
+        base_input_reference,
+        analysis_response.output_image_analysis.analysis_id if analysis_response.output_image_analysis else None,
+        analysis_response.base_image_analysis.analysis_id if analysis_response.base_image_analysis else None,
+        analysis_response.buildlog_document_id,
+        analysis_response.buildlog_analysis.analysis_id if analysis_response.buildlog_analysis else None,
+    )
+
+    return analysis_response
+
+
+def do_analyze_build(
+    output_reference: Optional[str] = None,
+    build_log_reference: Optional[Dict[str, Any]] = None,
+    base_input_reference: Optional[str] = None,
+    push_registry: Optional[str] = None,
+    *,
+    environment_type: Optional[str] = None,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+    debug: bool = False,
+    force: bool = False,
+    push_engine: str = "skopeo",
+    push_cache: Optional[PushCache] = None,
+    limiter: Optional[AdaptiveLimiter] = None,
+    namespace: str = "",
+) -> Any:
+    """Push images to the push registry, if configured, and submit them together with the build log to Thoth."""
+    if push_registry:
+        _LOGGER.info("Pushing output image %r to an external push registry %r", output_reference, push_registry)
+        output_reference = push_image(
+            output_reference,
+            push_registry,
+            src_registry_user,
+            src_registry_password,
+            dst_registry_user,
+            dst_registry_password,
+            src_verify_tls=src_verify_tls,
+            dst_verify_tls=dst_verify_tls,
+            push_engine=push_engine,
+        )
+        if output_reference:
+            METRIC_IMAGES_PUSHED_REGISTRY.labels(namespace=namespace).inc()
+            _LOGGER.info("Successfully pushed output image to %r", output_reference)
+
+        if base_input_reference:
+            _LOGGER.info("Pushing base image %r to an external push registry %r", base_input_reference, push_registry)
+            source_reference = base_input_reference
+
+            def push() -> Optional[str]:
+                # Images reused from the push cache are not pushed, they are counted as push cache hits.
+                pushed = push_image(
+                    source_reference,
+                    push_registry,
+                    src_registry_user,
+                    src_registry_password,
+                    dst_registry_user,
+                    dst_registry_password,
+                    src_verify_tls=src_verify_tls,
+                    dst_verify_tls=dst_verify_tls,
+                    push_engine=push_engine,
+                )
+                if pushed:
+                    METRIC_IMAGES_PUSHED_REGISTRY.labels(namespace=namespace).inc()
+                return pushed
+
+            if push_cache is not None:
+                key = base_push_key(
+                    base_input_reference, push_registry, src_registry_user, src_registry_password, src_verify_tls
+                )
+                base_input_reference = push_cache.push(key, push)
+            else:
+                base_input_reference = push()
+            if base_input_reference:
+                _LOGGER.info("Successfully pushed base image to %r", base_input_reference)
+
+    with stage("analysis"):
+        return submit_build_analysis(
+            output_reference,
+            build_log_reference,
+            base_input_reference,
+            environment_type=environment_type,
+            src_registry_user=src_registry_user,
+            src_registry_password=src_registry_password,
+            dst_registry_user=dst_registry_user,
+            dst_registry_password=dst_registry_password,
+            src_verify_tls=src_verify_tls,
+            dst_verify_tls=dst_verify_tls,
+            debug=debug,
+            force=force,
+            shared_api_client=True,
+            limiter=limiter,
+            namespace=namespace,
+        )
+
+
+def _skopeo_copy_command(
+    image: str,
+    push_registry: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+) -> Tuple[str, str]:
+    """Construct skopeo command copying the given image into the push registry, return command and output image."""
+    cmd = f"{_SKOPEO_EXEC_PATH} --insecure-policy copy "
+
+    if not src_verify_tls:
+        cmd += "--src-tls-verify=false "
+
+    if not dst_verify_tls:
+        cmd += "--dest-tls-verify=false "
+
+    if dst_registry_user or dst_registry_password:
+        dst_registry_user = dst_registry_user or "build-watcher"
+        cmd += f"--dest-creds={dst_registry_user}"
+
+        if dst_registry_password:
+            cmd += f":{dst_registry_password}"
+
+        cmd += " "
+
+    if src_registry_user or src_registry_password:
+        src_registry_user = src_registry_user or "build-watcher"
+        cmd += f"--src-creds={src_registry_user}"
+
+        if dst_registry_password:
+            cmd += f":{src_registry_password}"
+
+        cmd += " "
+
+    output = push_output_reference(image, push_registry)
+    _LOGGER.debug("Pushing image %r to registry %r, output is %r", image, push_registry, output)
+    cmd += f"docker://{image} docker://{output}"
+    return cmd, output
+
+
+def push_output_reference(image: str, push_registry: str) -> str:
+    """Compute reference of the given image once pushed into the push registry."""
+    image_name = image.rsplit("/", maxsplit=1)[1]
+    if "quay.io" in push_registry:
+        image_name = image_name.replace("@sha256", "")
+        return f"{push_registry}:{image_name.replace(':','-')}"
+
+    return f"{push_registry}/{image_name}"
+
+
+def _handle_push_error(image: str, stderr: str, error: str, *, exc_info: bool = False) -> bool:
+    """Log push error, return True if the pushed image cannot be used for analysis."""
+    if "Error determining manifest MIME type" in stderr:
+        # Manifest MIME type error is caused by the way image is build. we have no control over it.
+        _LOGGER.warning("Ignoring error caused by invalid manifest MIME type during push: %s", error)
+        return True
+
+    _LOGGER.error("Failed to push image %r to external registry: %s", image, error, exc_info=exc_info)
+    return False
+
+
+@stage("push")
+def push_image(
+    image: str,
+    push_registry: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+    push_engine: str = "skopeo",
+) -> Optional[str]:
+    """Push the given image (fully specified with registry info) into another registry."""
+    if push_engine == "native":
+        return _push_image_native(
+            image,
+            push_registry,
+            src_registry_user,
+            src_registry_password,
+            dst_registry_user,
+            dst_registry_password,
+            src_verify_tls,
+            dst_verify_tls,
+        )
+
+    cmd, output = _skopeo_copy_command(
+        image,
+        push_registry,
+        src_registry_user,
+        src_registry_password,
+        dst_registry_user,
+        dst_registry_password,
+        src_verify_tls,
+        dst_verify_tls,
+    )
+
+    _LOGGER.debug("Running: %s", cmd)
+    try:
+        command = run_command(cmd)
+        _LOGGER.debug("%s stdout:\n%s\n%s", _SKOPEO_EXEC_PATH, command.stdout, command.stderr)
+    except CommandError as exc:
+        if _handle_push_error(image, exc.stderr, str(exc), exc_info=True):
+            return None
+    return output
+
+
+def _push_image_native(
+    image: str,
+    push_registry: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+) -> Optional[str]:
+    """Push the given image into another registry talking to the registries directly, without skopeo."""
+    output = push_output_reference(image, push_registry)
+    _LOGGER.debug("Copying image %r to registry %r, output is %r", image, push_registry, output)
+    try:
+        copy_image(
+            image,
+            output,
+            src_registry_user,
+            src_registry_password,
+            dst_registry_user,
+            dst_registry_password,
+            src_verify_tls=src_verify_tls,
+            dst_verify_tls=dst_verify_tls,
+        )
+    except UnsupportedManifestError as exc:
+        _handle_push_error(image, str(exc), str(exc))
+        return None
+    except Exception as exc:
+        _handle_push_error(image, "", str(exc), exc_info=True)
+    return output
+
+
+async def push_image_async(
+    image: str,
+    push_registry: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+    push_engine: str = "skopeo",
+) -> Optional[str]:
+    """Push the given image into another registry, the skopeo subprocess is driven by the event loop."""
+    with stage("push"):
+        if push_engine == "native":
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None,
+                _push_image_native,
+                image,
+                push_registry,
+                src_registry_user,
+                src_registry_password,
+                dst_registry_user,
+                dst_registry_password,
+                src_verify_tls,
+                dst_verify_tls,
+            )
+
+        cmd, output = _skopeo_copy_command(
+            image,
+            push_registry,
+            src_registry_user,
+            src_registry_password,
+            dst_registry_user,
+            dst_registry_password,
+            src_verify_tls,
+            dst_verify_tls,
+        )
+
+        _LOGGER.debug("Running: %s", cmd)
+        process = await asyncio.create_subprocess_shell(
+            cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        _LOGGER.debug("%s stdout:\n%s\n%s", _SKOPEO_EXEC_PATH, stdout.decode(), stderr.decode())
+        if process.returncode != 0:
+            error = f"Command exited with return code {process.returncode}: {stderr.decode()}"
+            if _handle_push_error(image, stderr.decode(), error):
+                return None
+        return output
+
+
+def base_push_key(
+    image: str,
+    push_registry: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+) -> str:
+    """Compute key of the given base image in the push cache, the image is identified by its manifest digest."""
+    try:
+        digest = manifest_digest(image, src_registry_user, src_registry_password, src_verify_tls)
+    except Exception as exc:
+        # The image is identified by its reference, the TTL of cache entries limits for how long tag moves are
+        # not noticed.
+        _LOGGER.warning("Failed to resolve digest of base image %r: %s", image, str(exc))
+        digest = None
+
+    return PushCache.key(image, digest, push_registry)
+
+
+async def do_analyze_build_async(
+    output_reference: Optional[str] = None,
+    build_log_reference: Optional[Dict[str, Any]] = None,
+    base_input_reference: Optional[str] = None,
+    push_registry: Optional[str] = None,
+    *,
+    executor: ThreadPoolExecutor,
+    **analysis_kwargs: Any,
+) -> Any:
+    """Push images concurrently and submit them for analysis without blocking the event loop."""
+    push_engine = analysis_kwargs.pop("push_engine", "skopeo")
+    push_cache = analysis_kwargs.pop("push_cache", None)
+    namespace = analysis_kwargs.get("namespace", "")
+    loop = asyncio.get_running_loop()
+    if push_registry:
+        push_kwargs = dict(
+            src_registry_user=analysis_kwargs.get("src_registry_user"),
+            src_registry_password=analysis_kwargs.get("src_registry_password"),
+            dst_registry_user=analysis_kwargs.get("dst_registry_user"),
+            dst_registry_password=analysis_kwargs.get("dst_registry_password"),
+            src_verify_tls=analysis_kwargs.get("src_verify_tls", True),
+            dst_verify_tls=analysis_kwargs.get("dst_verify_tls", True),
+            push_engine=push_engine,
+        )
+        _LOGGER.info(
+            "Pushing images %r to an external push registry %r",
+            [image for image in (output_reference, base_input_reference) if image],
+            push_registry,
+        )
+        pushes = {}
+        if output_reference:
+            pushes["output"] = push_image_async(output_reference, push_registry, **push_kwargs)
+        if base_input_reference:
+            source_reference = base_input_reference
+
+            async def base_push() -> Optional[str]:
+                # Images reused from the push cache are not pushed, they are counted as push cache hits.
+                pushed = await push_image_async(source_reference, push_registry, **push_kwargs)
+                if pushed:
+                    METRIC_IMAGES_PUSHED_REGISTRY.labels(namespace=namespace).inc()
+                return pushed
+
+            if push_cache is not None:
+                key = await loop.run_in_executor(
+                    executor,
+                    base_push_key,
+                    base_input_reference,
+                    push_registry,
+                    push_kwargs["src_registry_user"],
+                    push_kwargs["src_registry_password"],
+                    push_kwargs["src_verify_tls"],
+                )
+                base_push = functools.partial(push_cache.push_async, key, base_push)
+            pushes["base"] = base_push()
+
+        pushed = dict(zip(pushes, await asyncio.gather(*pushes.values())))
+        if pushed.get("output"):
+            METRIC_IMAGES_PUSHED_REGISTRY.labels(namespace=namespace).inc()
+
+        output_reference = pushed.get("output")
+        base_input_reference = pushed.get("base")
+
+    with stage("analysis"):
+        return await loop.run_in_executor(
+            executor,
+            functools.partial(
+                submit_build_analysis,
+                output_reference,
+                build_log_reference,
+                base_input_reference,
+                shared_api_client=True,
+                **analysis_kwargs,
+            ),
+        )
+
+
+async def _async_submit(
+    submission: Dict[str, Any],
+    dedup_cache: Optional[TTLCache],
+    options: Dict[str, Any],
+    executor: ThreadPoolExecutor,
+    queue: Union[Queue, WorkSpool],
+    entry_id: Optional[int],
+    stats: Optional[SubmissionStats] = None,
+) -> None:
+    """Submit one item in the async worker mode."""
+    loop = asyncio.get_running_loop()
+    arguments = _analysis_arguments(submission, options)
+    started = time.monotonic()
+    try:
+        with submission_context(submission):
+            analysis_response = await do_analyze_build_async(
+                arguments.pop("output_reference"),
+                arguments.pop("build_log_reference"),
+                arguments.pop("base_input_reference"),
+                arguments.pop("push_registry"),
+                executor=executor,
+                **arguments,
+            )
+    except Exception as exc:
+        _LOGGER.exception(
+            "Failed to submit image %r for analysis to Thoth: %s", submission["output_reference"], str(exc)
+        )
+        await loop.run_in_executor(executor, _settle, queue, entry_id, exc)
+        return
+    finally:
+        if stats is not None:
+            stats.record(time.monotonic() - started)
+
+    await loop.run_in_executor(executor, record_submission, dedup_cache, submission, analysis_response)
+    await loop.run_in_executor(executor, _settle, queue, entry_id)
+
+
+async def _async_submitter(
+    queue: Union[Queue, WorkSpool],
+    dedup_cache: Optional[TTLCache],
+    options: Dict[str, Any],
+    limits: Dict[str, bool],
+    max_in_flight: int,
+    stop: Optional[Event] = None,
+    stats: Optional[SubmissionStats] = None,
+) -> None:
+    """Read messages from queue and submit up to max_in_flight of them concurrently on one event loop."""
+    loop = asyncio.get_running_loop()
+    queue_reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="queue-reader")
+    executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="submitter")
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+
+    while True:
+        await in_flight.acquire()
+        entry = await loop.run_in_executor(queue_reader, _take, queue, stop)
+        if entry is None:
+            break
+
+        entry_id, reference = entry
+        # Cache lookups, reading spooled build logs and digesting them block, they are kept off the event loop.
+        submission = await loop.run_in_executor(
+            executor, functools.partial(prepare_submission, reference, dedup_cache, force=options["force"], **limits)
+        )
+        if submission is None:
+            await loop.run_in_executor(executor, _settle, queue, entry_id)
+            in_flight.release()
+            continue
+
+        task = loop.create_task(_async_submit(submission, dedup_cache, options, executor, queue, entry_id, stats))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda _: in_flight.release())
+
+    _LOGGER.info("Stopping submitter, waiting for %d submissions in flight", len(tasks))
+    await asyncio.gather(*tasks)
+
+
+def _submit(
+    submission: Dict[str, Any],
+    entry_id: Optional[int],
+    queue: Union[Queue, WorkSpool],
+    dedup_cache: Optional[TTLCache],
+    options: Dict[str, Any],
+    stats: Optional[SubmissionStats] = None,
+) -> None:
+    """Submit one item in the process worker mode."""
+    started = time.monotonic()
+    try:
+        with submission_context(submission):
+            analysis_response = do_analyze_build(**_analysis_arguments(submission, options))
+    except Exception as exc:
+        _LOGGER.exception(
+            "Failed to submit image %r for analysis to Thoth: %s", submission["output_reference"], str(exc)
+        )
+        _settle(queue, entry_id, exc)
+        return
+    finally:
+        if stats is not None:
+            stats.record(time.monotonic() - started)
+
+    record_submission(dedup_cache, submission, analysis_response)
+    _settle(queue, entry_id)
+
+
+def submitter(
+    queue: Union[Queue, WorkSpool],
+    push_registry: str,
+    environment_type: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    no_src_registry_tls_verify: bool = False,
+    no_dst_registry_tls_verify: bool = False,
+    no_base: bool = False,
+    no_output: bool = False,
+    no_build_log: bool = False,
+    debug: bool = False,
+    force: bool = False,
+    dedup_cache_size: int = 4096,
+    dedup_cache_ttl: int = 86400,
+    dedup_cache_path: Optional[str] = None,
+    worker_mode: str = "process",
+    max_in_flight: int = 16,
+    push_engine: str = "skopeo",
+    push_cache_size: int = 1024,
+    push_cache_ttl: int = 86400,
+    api_bucket: Optional[TokenBucket] = None,
+    api_max_concurrency: int = 16,
+    api_latency_target: float = 10.0,
+    batch_size: int = 1,
+    batch_wait: float = 0.05,
+    stop: Optional[Event] = None,
+    stats: Optional[SubmissionStats] = None,
+) -> None:
+    """Read messages from queue and submit each message with image to Thoth for analysis.
+
+    In the process worker mode, up to batch_size messages taken within batch_wait seconds are submitted
+    concurrently. If stop is given, the submitter returns once it is set and there is no more work queued.
+
+    Concurrency of requests to Thoth User API adapts up to api_max_concurrency in the async worker mode and up to
+    the batch size in the process worker mode, a process submitting one message at a time is limited only by rate.
+    """
+    dedup_cache = None
+    if dedup_cache_size > 0:
+        dedup_cache = TTLCache(max_size=dedup_cache_size, ttl=dedup_cache_ttl, path=dedup_cache_path, table="submitted")
+
+    api_concurrency = api_max_concurrency if worker_mode == "async" else min(batch_size, api_max_concurrency)
+    if api_concurrency <= 1:
+        _LOGGER.info(
+            "Concurrency of requests to Thoth User API is not adapted, run workers in the async mode or submit "
+            "in batches to adapt it"
+        )
+
+    options = dict(
+        push_registry=push_registry,
+        environment_type=environment_type,
+        src_registry_user=src_registry_user,
+        src_registry_password=src_registry_password,
+        dst_registry_user=dst_registry_user,
+        dst_registry_password=dst_registry_password,
+        src_verify_tls=not no_src_registry_tls_verify,
+        dst_verify_tls=not no_dst_registry_tls_verify,
+        debug=debug,
+        force=force,
+        push_engine=push_engine,
+        push_cache=PushCache(push_cache_size, push_cache_ttl, dedup_cache_path) if push_cache_size > 0 else None,
+        limiter=AdaptiveLimiter(
+            bucket=api_bucket,
+            max_limit=api_concurrency,
+            latency_target=api_latency_target,
+        ),
+    )
+    limits = dict(no_base=no_base, no_output=no_output, no_build_log=no_build_log)
+
+    if worker_mode == "async":
+        _LOGGER.info("Starting asynchronous submitter with up to %d submissions in flight", max_in_flight)
+        asyncio.run(_async_submitter(queue, dedup_cache, options, limits, max_in_flight, stop, stats))
+        return
+
+    if batch_size > 1:
+        _LOGGER.info("Submitting batches of up to %d items collected within %.3f seconds", batch_size, batch_wait)
+    executor = ThreadPoolExecutor(max_workers=batch_size, thread_name_prefix="submitter") if batch_size > 1 else None
+    while True:
+        batch = _take_batch(queue, stop, batch_size, batch_wait)
+        if not batch:
+            _LOGGER.info("Stopping submitter, no more work queued")
+            return
+
+        submissions = []
+        for entry_id, reference in batch:
+            submission = prepare_submission(reference, dedup_cache, force=force, **limits)
+            if submission is None:
+                _settle(queue, entry_id)
+            else:
+                submissions.append((entry_id, submission))
+
+        if executor is None or len(submissions) < 2:
+            for entry_id, submission in submissions:
+                _submit(submission, entry_id, queue, dedup_cache, options, stats)
+            continue
+
+        # Thoth User API has no bulk endpoint, requests of a batch share connections of the per-process API client.
+        futures = [
+            executor.submit(_submit, submission, entry_id, queue, dedup_cache, options, stats)
+            for entry_id, submission in submissions
+        ]
+        for future in futures:
+            future.result()
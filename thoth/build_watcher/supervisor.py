@@ -0,0 +1,281 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Supervision of producer and worker processes."""
+
+import logging
+import math
+import os
+import signal
+import time
+from multiprocessing import Event
+from multiprocessing import Process
+from multiprocessing import Value
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from .metrics import METRIC_PROCESS_RESTARTS
+from .metrics import METRIC_QUEUE_DEPTH
+from .metrics import METRIC_WORKERS
+from .metrics import observe_startup
+from .profiling import install_profiling_handlers
+
+_LOGGER = logging.getLogger(__name__)
+
+# A process running at least this number of seconds is considered healthy, its restart backoff is reset.
+_HEALTHY_AFTER = 60.0
+
+
+class SubmissionStats:
+    """Number and duration of submissions done by workers, shared across worker processes."""
+
+    def __init__(self) -> None:
+        """Create counters in shared memory, to be done before workers are started."""
+        self._count = Value("L", 0)
+        self._busy = Value("d", 0.0)
+
+    def record(self, duration: float) -> None:
+        """Record one submission which took the given number of seconds."""
+        with self._count.get_lock():
+            self._count.value += 1
+            self._busy.value += duration
+
+    def snapshot(self) -> Tuple[int, float]:
+        """Get number of submissions done so far and the total time spent on them."""
+        with self._count.get_lock():
+            return self._count.value, self._busy.value
+
+
+def _run(target: Callable[..., Any], args: Sequence[Any], kwargs: Dict[str, Any]) -> None:
+    """Run the given target in a supervised process, signal handling of the supervisor is not inherited."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    install_profiling_handlers()
+    target(*args, **kwargs)
+
+
+class _Child:
+    """A process managed by the supervisor."""
+
+    def __init__(self, name: str, target: Callable[..., Any], args: Sequence[Any], restart: bool = True) -> None:
+        """Describe the process, it is started by the supervisor."""
+        self.name = name
+        self.target = target
+        self.args = args
+        self.restart = restart
+        self.process: Optional[Process] = None
+        self.stop = Event()
+        self.started = 0.0
+        self.failures = 0
+        self.restart_at: Optional[float] = None
+        self.retiring = False
+
+    def start(self, kwargs: Dict[str, Any]) -> None:
+        """Start the process."""
+        self.process = Process(target=_run, args=(self.target, self.args, kwargs), name=self.name)
+        self.process.start()
+        self.started = time.monotonic()
+        self.restart_at = None
+        _LOGGER.info("Started %s with PID: %d", self.name, self.process.pid)
+
+
+class Supervisor:
+    """Keep producers and workers running, scale workers based on the load and drain them on SIGTERM.
+
+    Processes which exit unexpectedly are restarted with exponential backoff. Every scale interval, a worker is
+    added if the backlog in the work queue would not be processed within the latency target by the current workers
+    (based on the observed duration of submissions) and a worker is retired if the queue is empty and workers are
+    mostly idle. On SIGTERM, producers are asked to stop and are given the stop timeout to queue the work in
+    progress, then workers finish the work taken and exit once the work queue is empty. Processes not done by the
+    drain timeout are terminated.
+    """
+
+    def __init__(
+        self,
+        queue: Any,
+        *,
+        min_workers: int = 1,
+        max_workers: int = 1,
+        worker_concurrency: int = 1,
+        scale_interval: float = 30.0,
+        latency_target: float = 60.0,
+        restart_backoff: float = 1.0,
+        restart_backoff_max: float = 300.0,
+        drain_timeout: float = 25.0,
+        stop_timeout: float = 10.0,
+    ) -> None:
+        """Configure the supervisor, the pool of workers is not scaled if min_workers equals max_workers."""
+        self.queue = queue
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(max_workers, self.min_workers)
+        self.worker_concurrency = max(worker_concurrency, 1)
+        self.scale_interval = scale_interval
+        self.latency_target = latency_target
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+        self.drain_timeout = drain_timeout
+        self.stop_timeout = stop_timeout
+        self.stats = SubmissionStats()
+        self._services: List[_Child] = []
+        self._workers: List[_Child] = []
+        self._worker_target: Optional[Callable[..., Any]] = None
+        self._worker_args: Sequence[Any] = ()
+        self._worker_index = 0
+        self._stopping = False
+
+    def add_service(self, name: str, target: Callable[..., Any], args: Sequence[Any], restart: bool = True) -> None:
+        """Register a process which runs alongside workers, it is restarted on failure and optionally on exit.
+
+        The target is called with the given arguments and an event set once the process should stop.
+        """
+        self._services.append(_Child(name, target, args, restart))
+
+    def _add_worker(self) -> None:
+        """Start a new worker."""
+        self._worker_index += 1
+        worker = _Child(f"worker-{self._worker_index}", self._worker_target, self._worker_args)
+        worker.start({"stop": worker.stop, "stats": self.stats})
+        self._workers.append(worker)
+
+    def _check(self, child: _Child, kwargs: Dict[str, Any]) -> bool:
+        """Restart the given process if it exited unexpectedly, return False if it exited for good."""
+        if child.process.is_alive():
+            return True
+
+        now = time.monotonic()
+        if child.restart_at is None:
+            exitcode = child.process.exitcode
+            if child.retiring or (exitcode == 0 and not child.restart):
+                _LOGGER.info("Process %s (PID %d) finished", child.name, child.process.pid)
+                return False
+
+            child.failures = 1 if now - child.started >= _HEALTHY_AFTER else child.failures + 1
+            delay = min(self.restart_backoff_max, self.restart_backoff * 2 ** (child.failures - 1))
+            child.restart_at = now + delay
+            METRIC_PROCESS_RESTARTS.labels(process=child.name.split("-")[0]).inc()
+            _LOGGER.error(
+                "Process %s (PID %d) exited with code %s, restarting it in %.1f seconds",
+                child.name,
+                child.process.pid,
+                exitcode,
+                delay,
+            )
+
+        if now >= child.restart_at:
+            child.start(kwargs)
+
+        return True
+
+    def _scale(self, previous: Tuple[int, float], interval: float) -> None:
+        """Add or retire a worker based on the backlog and observed duration of submissions."""
+        count, busy = self.stats.snapshot()
+        submitted, busy = count - previous[0], busy - previous[1]
+        try:
+            depth = self.queue.qsize()
+        except NotImplementedError:
+            return
+
+        active = [worker for worker in self._workers if not worker.retiring]
+        capacity = len(active) * self.worker_concurrency
+        latency = busy / submitted if submitted else None
+        if depth and len(active) < self.max_workers:
+            # Nothing finished in the last interval although there is a backlog - workers are saturated.
+            backlog_time = depth * latency / capacity if latency is not None else math.inf
+            if backlog_time > self.latency_target:
+                _LOGGER.info("Scaling workers up to %d, %d items are waiting in the work queue", len(active) + 1, depth)
+                self._add_worker()
+        elif not depth and len(active) > self.min_workers and busy < 0.5 * interval * capacity:
+            worker = active[-1]
+            _LOGGER.info("Scaling workers down to %d, retiring %s", len(active) - 1, worker.name)
+            worker.retiring = True
+            worker.stop.set()
+
+    def _handle_sigterm(self, signum: int, _: Any) -> None:
+        """Start draining on SIGTERM."""
+        _LOGGER.info("Received signal %d, draining workers", signum)
+        self._stopping = True
+
+    def _forward_signal(self, signum: int) -> None:
+        """Send the given signal to all the processes running, used to profile all of them at once."""
+        for child in self._services + self._workers:
+            if child.process is not None and child.process.is_alive():
+                os.kill(child.process.pid, signum)
+
+    def run(self, worker_target: Callable[..., Any], worker_args: Sequence[Any]) -> None:
+        """Start all the processes and supervise them until SIGTERM is received and workers are drained."""
+        self._worker_target = worker_target
+        self._worker_args = worker_args
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        install_profiling_handlers(forward=self._forward_signal)
+
+        for service in self._services:
+            service.start({"stop": service.stop})
+        for _ in range(self.min_workers):
+            self._add_worker()
+        observe_startup("ready")
+
+        previous = self.stats.snapshot()
+        last_scaled = time.monotonic()
+        while not self._stopping:
+            self._services = [service for service in self._services if self._check(service, {"stop": service.stop})]
+            self._workers = [
+                worker for worker in self._workers if self._check(worker, {"stop": worker.stop, "stats": self.stats})
+            ]
+            METRIC_WORKERS.set(len(self._workers))
+
+            try:
+                METRIC_QUEUE_DEPTH.set(self.queue.qsize())
+            except NotImplementedError:
+                # Not available on all platforms.
+                pass
+
+            now = time.monotonic()
+            if self.max_workers > self.min_workers and now - last_scaled >= self.scale_interval:
+                self._scale(previous, now - last_scaled)
+                previous = self.stats.snapshot()
+                last_scaled = now
+
+            time.sleep(1)
+
+        self._drain()
+
+    @staticmethod
+    def _join(children: List[_Child], deadline: float) -> None:
+        """Wait for the given processes to exit, terminate the ones not done by the deadline."""
+        for child in children:
+            child.process.join(max(0.0, deadline - time.monotonic()))
+            if child.process.is_alive():
+                _LOGGER.warning("Process %s did not finish in time, terminating it", child.name)
+                child.process.terminate()
+                child.process.join()
+
+    def _drain(self) -> None:
+        """Stop producers, let workers finish the work queued and terminate the processes not done in time."""
+        deadline = time.monotonic() + self.drain_timeout
+        for service in self._services:
+            service.stop.set()
+        self._join(self._services, min(deadline, time.monotonic() + self.stop_timeout))
+
+        # Workers are stopped only after producers so that the work queued by producers while stopping is done.
+        for worker in self._workers:
+            worker.stop.set()
+        self._join(self._workers, deadline)
+
+        _LOGGER.info("All the processes were stopped")
@@ -0,0 +1,152 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Latency of pipeline stages, recorded as histograms and optionally as OpenTelemetry spans."""
+
+import contextlib
+import contextvars
+import logging
+import re
+import time
+from datetime import datetime
+from datetime import timezone
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+from .metrics import METRIC_STAGE_DURATION
+from .metrics import METRIC_SUBMISSIONS_IN_FLIGHT
+from .profiling import track_in_flight
+from .recorder import record
+
+try:
+    from opentelemetry import propagate
+    from opentelemetry import trace
+except ImportError:
+    propagate = None
+    trace = None
+
+_LOGGER = logging.getLogger(__name__)
+
+_TRACER = trace.get_tracer(__name__) if trace else None
+# Names and values of exemplar labels can have at most this number of characters in total.
+_EXEMPLAR_MAX_LENGTH = 128
+_LABEL_NAME = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*")
+# Build being submitted in the current thread or asyncio task.
+_CURRENT_BUILD: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("build", default=None)
+
+
+def parse_timestamp(timestamp: Optional[str]) -> Optional[float]:
+    """Convert a Kubernetes timestamp into seconds since epoch."""
+    if not timestamp:
+        return None
+
+    try:
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        _LOGGER.warning("Failed to parse timestamp %r", timestamp)
+        return None
+
+
+def _exemplar(build_name: Optional[str]) -> Optional[Dict[str, str]]:
+    """Construct an exemplar naming the given build, None if there is none or the collector would reject it."""
+    if not build_name:
+        return None
+
+    exemplar = {"build_name": build_name[:100]}
+    # The collector validates exemplars only after the observation is counted, invalid ones are dropped upfront.
+    if not all(_LABEL_NAME.fullmatch(name) for name in exemplar) or (
+        sum(len(name) + len(value) for name, value in exemplar.items()) > _EXEMPLAR_MAX_LENGTH
+    ):
+        _LOGGER.debug("Dropping invalid exemplar %r", exemplar)
+        return None
+
+    return exemplar
+
+
+def observe(stage: str, duration: float, build_name: Optional[str] = None) -> None:
+    """Record duration of the given stage, the build name is attached as an exemplar and written to the trace."""
+    histogram = METRIC_STAGE_DURATION.labels(stage=stage)
+    try:
+        histogram.observe(duration, exemplar=_exemplar(build_name))
+    except TypeError:
+        # Collectors not supporting exemplars reject the argument before the duration is counted.
+        histogram.observe(duration)
+
+    record("stage", name=build_name, stage=stage, duration=round(duration, 4))
+
+
+def trace_context() -> Dict[str, str]:
+    """Serialize the current trace context so that it can be passed to another process with a build."""
+    carrier: Dict[str, str] = {}
+    if propagate:
+        propagate.inject(carrier)
+    return carrier
+
+
+def _span(name: str, build_name: Optional[str], carrier: Optional[Dict[str, str]] = None) -> Any:
+    """Start a span if OpenTelemetry is available, the parent is taken from the carrier if given."""
+    if not _TRACER:
+        return contextlib.nullcontext()
+
+    context = propagate.extract(carrier) if carrier else None
+    return _TRACER.start_as_current_span(name, context=context, attributes={"build.name": build_name or ""})
+
+
+@contextlib.contextmanager
+def stage(name: str, build_name: Optional[str] = None) -> Iterator[None]:
+    """Measure the given stage of the pipeline, the build defaults to the one being submitted."""
+    if build_name is None:
+        build_name = (_CURRENT_BUILD.get() or {}).get("build_name")
+
+    start = time.monotonic()
+    with _span(name, build_name):
+        try:
+            yield
+        finally:
+            observe(name, time.monotonic() - start, build_name)
+
+
+@contextlib.contextmanager
+def submission_context(submission: Dict[str, Any]) -> Iterator[None]:
+    """Track the given submission, stages measured inside are attributed to its build.
+
+    Time spent in the work queue is recorded when entering and time since the build completion is recorded once
+    the submission finishes successfully.
+    """
+    build_name = submission.get("build_name")
+    if submission.get("queued_at"):
+        observe("queue_wait", time.time() - submission["queued_at"], build_name)
+
+    token = _CURRENT_BUILD.set(submission)
+    try:
+        with METRIC_SUBMISSIONS_IN_FLIGHT.track_inprogress(), _span(
+            "submission", build_name, submission.get("trace_context")
+        ), track_in_flight(
+            "submission",
+            build_name=build_name,
+            namespace=submission.get("namespace"),
+            output_reference=submission.get("output_reference"),
+            base=submission.get("base"),
+            build_log_size=len((submission.get("build_log") or {}).get("log") or ""),
+        ):
+            yield
+    finally:
+        _CURRENT_BUILD.reset(token)
+
+    if submission.get("completion_time"):
+        observe("end_to_end", time.time() - submission["completion_time"], build_name)
@@ -0,0 +1,307 @@
+# thoth-build-watcher
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Durable work queue between producers and submitters."""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import requests
+import urllib3
+
+from .buildlog import BuildLogSpool
+from .metrics import METRIC_DEAD_LETTERS
+from .metrics import METRIC_SUBMISSION_RETRIES
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# Errors of connections to Thoth worth retrying, regardless of the HTTP client raising them.
+_TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    asyncio.TimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    urllib3.exceptions.MaxRetryError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.TimeoutError,
+)
+
+
+def is_transient(exc: Exception) -> bool:
+    """Check whether the given submission error is worth retrying - connection errors, timeouts, 5xx and 429.
+
+    Other errors, such as client errors reported by Thoth or errors caused by the submitted data, are not retried.
+    """
+    status = getattr(exc, "status", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if isinstance(status, int) and status > 0:
+        return status in (408, 429) or status >= 500
+
+    return isinstance(exc, _TRANSIENT_ERRORS)
+
+
+class WorkSpool:
+    """A work queue stored in an SQLite database, shared by producers and submitters and surviving restarts.
+
+    Submitters lease entries and remove them only once acknowledged; entries leased by a submitter which died are
+    handed out again once their lease expires (at-least-once delivery). Failed entries are retried with exponential
+    backoff and jitter and are moved to a dead letter table once they run out of attempts.
+    """
+
+    # Number of seconds to wait before looking for new entries again when there is nothing to lease.
+    _POLL_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        lease_duration: float = 900.0,
+        max_attempts: int = 8,
+        backoff_base: float = 10.0,
+        backoff_max: float = 3600.0,
+    ) -> None:
+        """Create the spool, the database on the given path is created if it does not exist."""
+        self.path = path
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._connection_pid: Optional[int] = None
+
+    def _db(self) -> sqlite3.Connection:
+        """Get a connection to the database, connections are not shared across forked processes."""
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, reference TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, available REAL NOT NULL, leased_until REAL NOT NULL DEFAULT 0, "
+                "error TEXT, created REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letter (id INTEGER PRIMARY KEY, reference TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL, error TEXT, created REAL NOT NULL, failed REAL NOT NULL)"
+            )
+            self._connection_pid = os.getpid()
+
+        return self._connection
+
+    def put(self, reference: Any) -> None:
+        """Store the given reference, build logs passed through the build log spool are stored inline."""
+        build_log_reference = reference.get("build_log_reference") if isinstance(reference, dict) else None
+        if build_log_reference and build_log_reference.get("log_path"):
+            reference = dict(reference, build_log_reference=BuildLogSpool.load(build_log_reference))
+
+        now = time.time()
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO spool (reference, available, created) VALUES (?, ?, ?)", (json.dumps(reference), now, now)
+            )
+
+    def qsize(self) -> int:
+        """Get number of entries waiting in the spool, including the ones leased and waiting for a retry."""
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def _lease_next(self, now: float) -> Tuple[Optional[Tuple[Any, ...]], Optional[Tuple[Any, ...]]]:
+        """Lease the oldest entry available in a write transaction, return it and an entry moved to dead letters."""
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT id, reference, attempts, created FROM spool WHERE available <= ? AND leased_until <= ? "
+                    "ORDER BY id LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                exhausted = None
+                if row and row[2] >= self.max_attempts:
+                    exhausted, row = row, None
+                    db.execute(
+                        "INSERT INTO dead_letter (id, reference, attempts, error, created, failed) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (exhausted[0], exhausted[1], exhausted[2], "Worker exited while processing", exhausted[3], now),
+                    )
+                    db.execute("DELETE FROM spool WHERE id = ?", (exhausted[0],))
+                elif row:
+                    db.execute(
+                        "UPDATE spool SET leased_until = ?, attempts = attempts + 1 WHERE id = ?",
+                        (now + self.lease_duration, row[0]),
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+        return row, exhausted
+
+    def lease(self, timeout: Optional[float] = None) -> Optional[Tuple[int, Any]]:
+        """Lease the oldest entry available, the entry id and the reference are returned.
+
+        Block until there is an entry, or at most timeout seconds if given (None is returned then). Each lease counts
+        as an attempt - an entry whose worker died on each of its attempts is moved to the dead letter table.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            now = time.time()
+            row = exhausted = None
+            with self._lock:
+                # Idle workers only read, the write transaction is started once there is an entry to lease.
+                ready = (
+                    self._db()
+                    .execute("SELECT 1 FROM spool WHERE available <= ? AND leased_until <= ? LIMIT 1", (now, now))
+                    .fetchone()
+                )
+
+            if ready:
+                row, exhausted = self._lease_next(now)
+
+            if exhausted:
+                METRIC_DEAD_LETTERS.inc()
+                _LOGGER.error(
+                    "Entry %d was not processed in %d attempts, moved to the dead letter table",
+                    exhausted[0],
+                    exhausted[2],
+                )
+                continue
+
+            if row:
+                return row[0], json.loads(row[1])
+
+            if deadline is None:
+                time.sleep(self._POLL_INTERVAL)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            time.sleep(min(self._POLL_INTERVAL, remaining))
+
+    def ack(self, entry_id: int) -> None:
+        """Remove the given entry once it was processed."""
+        with self._lock:
+            self._db().execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+
+    def fail(self, entry_id: int, error: str, retry: bool = True) -> None:
+        """Schedule the given entry for a retry, or move it to the dead letter table if it should not be retried."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT attempts, reference, created FROM spool WHERE id = ?", (entry_id,)).fetchone()
+                if row is None:
+                    db.execute("COMMIT")
+                    return
+
+                attempts = row[0]
+                if retry and attempts < self.max_attempts:
+                    delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+                    # Equal jitter - spread retries of entries which failed together, but keep backing off.
+                    delay = delay / 2 + random.uniform(0, delay / 2)
+                    db.execute(
+                        "UPDATE spool SET attempts = ?, available = ?, leased_until = 0, error = ? WHERE id = ?",
+                        (attempts, now + delay, error, entry_id),
+                    )
+                else:
+                    db.execute(
+                        "INSERT INTO dead_letter (id, reference, attempts, error, created, failed) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (entry_id, row[1], attempts, error, row[2], now),
+                    )
+                    db.execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+        if retry and attempts < self.max_attempts:
+            METRIC_SUBMISSION_RETRIES.inc()
+            _LOGGER.warning("Entry %d failed (attempt %d), retrying in %.0f seconds", entry_id, attempts, delay)
+        else:
+            METRIC_DEAD_LETTERS.inc()
+            _LOGGER.error("Entry %d failed (attempt %d), moved to the dead letter table", entry_id, attempts)
+
+    def recover(self) -> int:
+        """Release all the leases, to be called on start before any submitter runs; number of entries is returned."""
+        with self._lock:
+            return self._db().execute("UPDATE spool SET leased_until = 0 WHERE leased_until > 0").rowcount
+
+    def dead_letter_count(self) -> int:
+        """Get number of entries in the dead letter table."""
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+
+    def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """List entries in the dead letter table, the most recently failed first."""
+        with self._lock:
+            rows = (
+                self._db()
+                .execute(
+                    "SELECT id, reference, attempts, error, created, failed FROM dead_letter "
+                    "ORDER BY failed DESC LIMIT ?",
+                    (limit,),
+                )
+                .fetchall()
+            )
+
+        return [
+            dict(id=row[0], reference=json.loads(row[1]), attempts=row[2], error=row[3], created=row[4], failed=row[5])
+            for row in rows
+        ]
+
+    def replay(self, entry_ids: Optional[List[int]] = None) -> int:
+        """Move the given entries (all if None) from the dead letter table back to the spool, return their number."""
+        condition, parameters = "", ()
+        if entry_ids is not None:
+            condition, parameters = f"WHERE id IN ({', '.join('?' * len(entry_ids))})", tuple(entry_ids)
+
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                replayed = db.execute(
+                    f"INSERT INTO spool (reference, available, created) "
+                    f"SELECT reference, ?, created FROM dead_letter {condition} ORDER BY id",
+                    (now, *parameters),
+                ).rowcount
+                db.execute(f"DELETE FROM dead_letter {condition}", parameters)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+        return replayed